@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+"""
+MAVLink FTP benchmark
+=====================
+Runs LogFileDownloader (listing, downloading, sync) and FlightEnvChanger
+(check, download, upload) against simulated PX4 endpoints (px4_sim.py) and
+reports ops/s, MB/s and p50/p99 latency per FTP request.
+
+Example:
+    bench/bench_ftp.py --latency 0.01 --loss 0.01 --json bench-ftp.json
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+
+from download_px4_logfile import LogFileDownloader
+from flight_env_config import FlightEnvChanger
+from mav_metrics import Metrics
+
+
+class Sim:
+    '''px4_sim.py in a subprocess'''
+
+    def __init__(self, port, args):
+        self.port = port
+        self.args = args
+        self.proc = None
+
+    def __enter__(self):
+        cmd = [sys.executable, os.path.join(SRC_DIR, 'px4_sim.py'), '--port', str(self.port),
+               '--days', str(self.args.days), '--logs-per-day', str(self.args.logs_per_day),
+               '--log-size', str(self.args.log_size), '--latency', str(self.args.latency),
+               '--loss', str(self.args.loss), '--bandwidth', str(self.args.bandwidth)]
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return self
+
+    def __exit__(self, *exc):
+        self.proc.terminate()
+        self.proc.wait()
+
+
+@contextlib.contextmanager
+def quiet(enabled):
+    # the tools print progress, keep the benchmark output readable
+    if enabled:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+    else:
+        yield
+
+
+async def bench_logs(args, timings, workdir):
+    with Sim(args.port, args):
+        downloader = LogFileDownloader()
+        downloader.metrics = timings
+        downloader.args = downloader.parse_args(['-a', f'udp://:{args.port}', '-d', workdir, '--json'])
+        with quiet(not args.verbose):
+            await downloader.initialize()
+
+        for _ in range(args.repeat):
+            # Every tool invocation starts with an empty listing cache
+            downloader.catalog.entries.clear()
+            downloader.ftp.invalidate_all()
+            start = time.perf_counter()
+            with quiet(not args.verbose):
+                await downloader.list_logfiles()
+            timings.record("list_logfiles", time.perf_counter() - start)
+
+        os.chdir(workdir)
+        for index in range(len(downloader.log_list)):
+            start = time.perf_counter()
+            with quiet(not args.verbose):
+                size = await downloader.download_file(downloader.log_list[index].datafile,
+                                                      downloader.log_list[index].date, workdir)
+            timings.record("download_logfile", time.perf_counter() - start, size)
+
+
+def bench_sync(args, timings, workdir):
+    with Sim(args.port + 2, args):
+        downloader = LogFileDownloader()
+        downloader.metrics = timings
+        syncdir = os.path.join(workdir, "sync")
+        downloader.args = downloader.parse_args(['-a', f'udp://:{args.port + 2}', '-d', syncdir, '--sync'])
+        for label in ("full", "up to date"):
+            start = time.perf_counter()
+            with quiet(not args.verbose):
+                downloader.sync_logfiles()
+            nbytes = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(syncdir) for f in files)
+            timings.record(label, time.perf_counter() - start, nbytes if label == "full" else 0)
+
+
+async def bench_config(args, timings, workdir):
+    with Sim(args.port + 1, args):
+        config_file = os.path.join(workdir, "config.txt")
+        changer = FlightEnvChanger()
+        changer.metrics = timings
+        changer.mavsdk_server_port = 50052
+        changer.args = changer.parse_args(['check', '-a', f'udp://:{args.port + 1}', '-f', config_file,
+                                           '--cache-dir', os.path.join(workdir, "config-cache")])
+        with quiet(not args.verbose):
+            await changer.initialize()
+            changer.init_cache()
+
+        async def check_uncached():
+            changer.args.no_cache = True
+            try:
+                await changer.check_current_config()
+            finally:
+                changer.args.no_cache = False
+
+        for command, method in (("check_uncached", check_uncached),
+                                ("check", changer.check_current_config),
+                                ("download", changer.download_config_file),
+                                ("upload", changer.upload_config_file)):
+            for _ in range(args.repeat):
+                changer.ftp.invalidate_all()
+                start = time.perf_counter()
+                with quiet(not args.verbose):
+                    await method()
+                timings.record(command, time.perf_counter() - start)
+
+
+def print_report(rows):
+    print("operation".ljust(36) + "count".rjust(7) + "ops/s".rjust(9) + "MB/s".rjust(9) + "p50 ms".rjust(10) + "p99 ms".rjust(10))
+    for row in rows:
+        print(row["op"].ljust(36) + str(row["count"]).rjust(7) + f"{row['ops_per_s']:9.1f}" +
+              f"{row['mb_per_s']:9.2f}" + f"{row['p50_ms']:10.1f}" + f"{row['p99_ms']:10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('-p', '--port', action="store", type=int, help='First UDP port used for the simulators (default 14600)', default=14600)
+    parser.add_argument('--days', action="store", type=int, help='Log date directories on the simulated SD card (default 3)', default=3)
+    parser.add_argument('--logs-per-day', action="store", type=int, help='Logs per date directory (default 2)', default=2)
+    parser.add_argument('--log-size', action="store", help='Size of each log (default 256k)', default='256k')
+    parser.add_argument('--latency', action="store", type=float, help='Simulated one way latency in seconds (default 0.005)', default=0.005)
+    parser.add_argument('--loss', action="store", type=float, help='Simulated packet loss probability (default 0)', default=0.0)
+    parser.add_argument('--bandwidth', action="store", help='Simulated link bandwidth in bytes/s (default 2M)', default='2M')
+    parser.add_argument('-r', '--repeat', action="store", type=int, help='Repetitions of listing and config operations (default 5)', default=5)
+    parser.add_argument('--json', action="store", metavar='FILE', help='Write the results as JSON into FILE')
+    parser.add_argument('--min-mbps', action="store", type=float, help='Exit with an error if a log download is slower than this (MB/s)')
+    parser.add_argument('-v', '--verbose', action="store_true", help='Show the output of the tools')
+    args = parser.parse_args()
+
+    # The tools record their own FTP requests, connection setup etc. in
+    # these, the benchmark adds the timing of whole operations.
+    logs_metrics = Metrics("download_px4_logfile")
+    sync_metrics = Metrics("download_px4_logfile")
+    config_metrics = Metrics("flight_env_config")
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="bench_ftp_") as workdir:
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(bench_logs(args, logs_metrics, workdir))
+        loop.run_until_complete(bench_config(args, config_metrics, workdir))
+        bench_sync(args, sync_metrics, workdir)
+        os.chdir(cwd)
+
+    rows = []
+    # The log downloads --min-mbps applies to
+    download_rows = []
+    for prefix, metrics in (("logs", logs_metrics), ("sync", sync_metrics), ("config", config_metrics)):
+        for row in metrics.summary():
+            if (prefix, row["op"]) in (("logs", "download_logfile"), ("sync", "full")):
+                download_rows.append(row)
+            row["op"] = prefix + " " + row["op"]
+            rows.append(row)
+    print_report(rows)
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump({"params": vars(args), "results": rows}, fh, indent=2)
+
+    if args.min_mbps is not None:
+        if not download_rows:
+            print("FAIL: no log download measured for --min-mbps")
+            sys.exit(1)
+        for row in download_rows:
+            if row["mb_per_s"] < args.min_mbps:
+                print(f"FAIL: {row['op']} {row['mb_per_s']:.2f} MB/s < {args.min_mbps} MB/s")
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
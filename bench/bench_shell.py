@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+"""
+MAVLink shell benchmark
+=======================
+Runs mavlink_shell.py (MavlinkSerialPort and BatchShell, in this process)
+against the nsh stand-in of a simulated PX4 (px4_sim.py) and reports the
+keystroke round trip (until the echo arrives), the command round trip
+(until the next prompt), bulk output MB/s and the CPU time the shell spends
+per received byte.
+
+Example:
+    bench/bench_shell.py --latency 0.005 --output-size 2M --json bench-shell.json
+"""
+
+import argparse
+import json
+import os
+import select
+import subprocess
+import sys
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+
+from fog_args import parse_size
+from mavlink_shell import BatchShell, MavlinkSerialPort, command_output
+from mav_metrics import Metrics, percentile
+
+
+def read_bytes(shell, n):
+    '''at least n bytes from the shell, fewer if none arrive within the timeout'''
+    data = bytearray()
+    deadline = time.perf_counter() + shell.timeout
+    while len(data) < n and time.perf_counter() < deadline:
+        data += shell.port.read_all()
+        if len(data) < n:
+            shell.heartbeat()
+            select.select([shell.port], [], [], 0.1)
+    return bytes(data)
+
+
+def row(op, durations, nbytes=0, cpu=0.0, lost=0):
+    seconds = sum(durations)
+    return {
+        "op": op,
+        "count": len(durations),
+        "p50_ms": percentile(durations, 50) * 1000 if durations else None,
+        "p99_ms": percentile(durations, 99) * 1000 if durations else None,
+        "bytes": nbytes,
+        "mb_per_s": nbytes / seconds / 1e6 if nbytes and seconds > 0 else None,
+        "cpu_ns_per_byte": cpu / nbytes * 1e9 if nbytes else None,
+        "lost_bytes": lost,
+    }
+
+
+def measure_keystrokes(shell, count):
+    # A character, then a backspace to keep the command line empty
+    durations = []
+    lost = 0
+    for _ in range(count):
+        start = time.perf_counter()
+        shell.port.write(b'x')
+        if read_bytes(shell, 1):
+            durations.append(time.perf_counter() - start)
+        else:
+            lost += 1
+        shell.port.write(b'\x7f')
+        read_bytes(shell, len(b'\b \b'))
+    return row("keystroke echo", durations, lost=lost)
+
+
+def measure_commands(shell, count):
+    results = shell.run(["echo bench"] * count) or []
+    return row("command (echo bench)", [r["seconds"] for r in results if not r["timed_out"]])
+
+
+def measure_output(shell, size, repeat):
+    command = f"output {size}"
+    durations = []
+    received = 0
+    lost = 0
+    cpu = 0.0
+    for _ in range(repeat):
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        shell.port.write(command + '\n')
+        data, ok = shell.read_until_prompt()
+        durations.append(time.perf_counter() - start)
+        cpu += time.process_time() - cpu_start
+        output = len(command_output(command, data).encode())
+        received += output
+        lost += max(0, size - output)
+        if not ok:
+            # Prompt lost, don't mix the next run into this one
+            break
+    return row(f"output {size} bytes", durations, received, cpu, lost)
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('-p', '--port', action="store", type=int, help='UDP port of the simulator (default 14660)', default=14660)
+    parser.add_argument('--keystrokes', action="store", type=int, help='Keystrokes to time (default 200)', default=200)
+    parser.add_argument('--commands', action="store", type=int, help='Commands to time (default 50)', default=50)
+    parser.add_argument('--output-size', action="store", type=parse_size, help='Bytes of bulk output per run, suffixes k, M (default 1M)', default='1M')
+    parser.add_argument('-r', '--repeat', action="store", type=int, help='Bulk output runs (default 5)', default=5)
+    parser.add_argument('--latency', action="store", type=float, help='Simulated one way latency in seconds (default 0)', default=0.0)
+    parser.add_argument('--loss', action="store", type=float, help='Simulated packet loss probability (default 0)', default=0.0)
+    parser.add_argument('--bandwidth', action="store", help='Simulated link bandwidth in bytes/s, 0 = unlimited (default 500k)', default='500k')
+    parser.add_argument('--timeout', action="store", type=float, help='Seconds to wait for an echo or prompt (default 10)', default=10)
+    parser.add_argument('--max-echo-ms', action="store", type=float, help='Exit with an error if the p50 keystroke echo exceeds this')
+    parser.add_argument('--min-mbps', action="store", type=float, help='Exit with an error if bulk output is slower than this (MB/s)')
+    parser.add_argument('--max-cpu-ns', action="store", type=float, help='Exit with an error if the shell uses more CPU ns per output byte')
+    parser.add_argument('--json', action="store", metavar='FILE', help='Write the results as JSON into FILE')
+    args = parser.parse_args()
+
+    sim = subprocess.Popen([sys.executable, os.path.join(SRC_DIR, 'px4_sim.py'), '--port', str(args.port),
+                            '--latency', str(args.latency), '--loss', str(args.loss), '--bandwidth', args.bandwidth],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        port = MavlinkSerialPort(f'udpin:127.0.0.1:{args.port}', 57600, devnum=10, timeout=30)
+        shell = BatchShell(port, Metrics("bench_shell"), args.timeout)
+        if shell.run([]) is None:
+            sys.exit(1)
+        rows = [measure_keystrokes(shell, args.keystrokes),
+                measure_commands(shell, args.commands),
+                measure_output(shell, args.output_size, args.repeat)]
+        port.close()
+    finally:
+        sim.terminate()
+        sim.wait()
+
+    def fmt(value, spec):
+        return format(value, spec) if value is not None else "-".rjust(len(format(0, spec)))
+
+    print("operation".ljust(28) + "count".rjust(6) + "p50 ms".rjust(10) + "p99 ms".rjust(10) +
+          "MB/s".rjust(8) + "CPU ns/B".rjust(10) + "lost B".rjust(10))
+    for r in rows:
+        print(r["op"].ljust(28) + str(r["count"]).rjust(6) + fmt(r["p50_ms"], "10.2f") + fmt(r["p99_ms"], "10.2f") +
+              fmt(r["mb_per_s"], "8.2f") + fmt(r["cpu_ns_per_byte"], "10.0f") + str(r["lost_bytes"]).rjust(10))
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump({"params": vars(args), "results": rows}, fh, indent=2)
+
+    keystroke, _, output = rows
+    failures = []
+    if args.max_echo_ms is not None and (keystroke["p50_ms"] is None or keystroke["p50_ms"] > args.max_echo_ms):
+        failures.append(f"keystroke echo p50 {keystroke['p50_ms']} ms > {args.max_echo_ms} ms")
+    if args.min_mbps is not None and (output["mb_per_s"] or 0) < args.min_mbps:
+        failures.append(f"bulk output {output['mb_per_s']} MB/s < {args.min_mbps} MB/s")
+    if args.max_cpu_ns is not None and (output["cpu_ns_per_byte"] is None or output["cpu_ns_per_byte"] > args.max_cpu_ns):
+        failures.append(f"shell CPU {output['cpu_ns_per_byte']} ns/byte > {args.max_cpu_ns} ns/byte")
+    for failure in failures:
+        print("FAIL: " + failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+"""
+Startup time benchmark
+======================
+Measures the wall time of fresh tool processes: `--help` of the MAVLink
+tools (argument parsing only, no heavy imports) and a complete
+`flight_env_config.py check` against a simulated PX4 (px4_sim.py), both
+connecting directly and through mav_broker.py.
+
+Example:
+    bench/bench_startup.py --help-budget-ms 300 --check-budget-ms 3000
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+
+from mav_metrics import percentile
+
+HELP_TOOLS = ("download_px4_logfile.py", "flight_env_config.py", "mavlink_shell.py")
+
+
+def run_tool(args):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable] + args, cwd=SRC_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"{' '.join(args)} exited with {result.returncode}")
+    return elapsed
+
+
+def measure(op, args, repeat):
+    durations = [run_tool(args) for _ in range(repeat)]
+    return {
+        "op": op,
+        "count": len(durations),
+        "min_ms": min(durations) * 1000,
+        "p50_ms": percentile(durations, 50) * 1000,
+        "p90_ms": percentile(durations, 90) * 1000,
+    }
+
+
+def measure_broker(args):
+    sock = os.path.join(tempfile.mkdtemp(prefix="bench_startup_"), "broker.sock")
+    broker = subprocess.Popen([sys.executable, os.path.join(SRC_DIR, 'mav_broker.py'), '-a', f'udp://:{args.port}', '-s', sock],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 30
+        while not os.path.exists(sock):
+            if time.monotonic() > deadline or broker.poll() is not None:
+                raise RuntimeError("mav_broker.py did not start")
+            time.sleep(0.1)
+        return measure("flight_env_config.py check --broker",
+                       ['flight_env_config.py', 'check', '--broker', sock], args.repeat)
+    finally:
+        broker.terminate()
+        broker.wait()
+        os.rmdir(os.path.dirname(sock))
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('-p', '--port', action="store", type=int, help='UDP port of the simulator (default 14650)', default=14650)
+    parser.add_argument('-r', '--repeat', action="store", type=int, help='Runs per measurement (default 10)', default=10)
+    parser.add_argument('--no-check', action="store_true", help='Skip the flight_env_config.py check measurement')
+    parser.add_argument('--help-budget-ms', action="store", type=float, help='Exit with an error if the p50 of a --help run exceeds this')
+    parser.add_argument('--check-budget-ms', action="store", type=float, help='Exit with an error if the p50 of check exceeds this')
+    parser.add_argument('--json', action="store", metavar='FILE', help='Write the results as JSON into FILE')
+    args = parser.parse_args()
+
+    rows = [measure("python -c pass", ['-c', 'pass'], args.repeat)]
+    for tool in HELP_TOOLS:
+        rows.append(measure(f"{tool} --help", [tool, '--help'], args.repeat))
+
+    if not args.no_check:
+        sim = subprocess.Popen([sys.executable, os.path.join(SRC_DIR, 'px4_sim.py'), '--port', str(args.port)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            rows.append(measure("flight_env_config.py check",
+                                ['flight_env_config.py', 'check', '-a', f'udp://:{args.port}'], args.repeat))
+            rows.append(measure_broker(args))
+        finally:
+            sim.terminate()
+            sim.wait()
+
+    print("operation".ljust(36) + "runs".rjust(6) + "min ms".rjust(10) + "p50 ms".rjust(10) + "p90 ms".rjust(10))
+    for row in rows:
+        print(row["op"].ljust(36) + str(row["count"]).rjust(6) + f"{row['min_ms']:10.1f}" +
+              f"{row['p50_ms']:10.1f}" + f"{row['p90_ms']:10.1f}")
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump({"params": vars(args), "results": rows}, fh, indent=2)
+
+    failed = False
+    for row in rows:
+        budget = args.help_budget_ms if row["op"].endswith("--help") else args.check_budget_ms
+        if row["op"] != "python -c pass" and budget is not None and row["p50_ms"] > budget:
+            print(f"FAIL: {row['op']} {row['p50_ms']:.1f} ms > {budget} ms")
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
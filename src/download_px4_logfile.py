@@ -1,106 +1,202 @@
 #!/usr/bin/env python3
 
 import asyncio
-import importlib.util
 import sys, os
 
-# For arm64, the docker image does not have mavsdk installed since qemu emulation is slow
-# Installing during runtime should be faster
-if importlib.util.find_spec('mavsdk') is None:
-    os.system('pip3 install mavsdk==2.1.0')
-
-from mavsdk import System
+from mav_metrics import Metrics, InstrumentedFtp
+from fog_args import parse_size
+from ftp_session import FtpSession
 import argparse
 import tempfile
+import shutil
 import datetime
+import time
+import json
+import contextlib
+import copy
+import signal
+import threading
+from mav_fleet import current_vehicle, VehicleOutput, parse_fleet_file, vehicle_dir_name
+from mavsdk_bootstrap import require_mavsdk
 
 class LogFile:
-    enc = False
-    date = None
-    time = None
-    datafile = None
-    size = 0.0
-    keyfile = None
+    __slots__ = ('date', 'time', 'enc', 'datafile', 'keyfile', 'size')
+
+    def __init__(self, date, time):
+        self.date = date
+        self.time = time
+        self.enc = False
+        self.datafile = None
+        self.keyfile = None
+        # bytes
+        self.size = 0
+
+    def key(self):
+        # Date and time have fixed width formats, so the key sorts by timestamp
+        return (self.date, self.time)
+
+    def timestamp(self):
+        try:
+            return datetime.datetime.strptime(self.date + " " + self.time, "%Y-%m-%d %H_%M_%S")
+        except ValueError:
+            return None
+
+    def size_str(self):
+        if self.size > 999999:
+            return ("{:.2f}".format(self.size/1024/1024)).rjust(8) + " MB"
+        return ("{:.2f}".format(self.size/1024)).rjust(8) + " kB"
+
+    def as_dict(self):
+        timestamp = self.timestamp()
+        return {
+            "date": self.date,
+            "time": self.time,
+            "timestamp": timestamp.isoformat() if timestamp is not None else None,
+            "size": self.size,
+            "encrypted": self.enc,
+            "datafile": self.datafile,
+            "keyfile": self.keyfile,
+        }
+
+
+class LogCatalog:
+    # Log entries keyed by (date, time)
+
+    def __init__(self):
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def entry(self, date, time):
+        key = (date, time)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = LogFile(date, time)
+            self.entries[key] = entry
+        return entry
+
+    def query(self, since=None, until=None, min_size=None, encrypted_only=False):
+        # Matching entries, oldest first
+        result = []
+        for entry in self.entries.values():
+            if since is not None and entry.date < since:
+                continue
+            if until is not None and entry.date > until:
+                continue
+            if min_size is not None and entry.size < min_size:
+                continue
+            if encrypted_only and not entry.enc:
+                continue
+            result.append(entry)
+        result.sort(key=LogFile.key)
+        return result
 
 
 class LogFileDownloader:
 
     mav = None
+    # FTP plugin of mav, replaceable with a wrapper with the same interface
+    ftp = None
+    # gRPC port of the mavsdk_server spawned for this instance
+    mavsdk_server_port = 50051
     root_dir = "/fs/microsd"
     log_root_dir = "log"
+    # Per file "N %" progress output, off in fleet mode
+    show_progress = True
+    # Semaphore shared by the vehicles of a fleet, limits concurrent transfers
+    transfer_slots = None
 
     log_dir_path = ""
 
-    # Dictionary of dictionaries
-    log_list = []
-
-    def GetEntry(self, k_date, k_time, search):
-        if search:
-            for entry in self.log_list:
-                if entry.date == k_date and entry.time == k_time:
-                    return entry
-
-        return LogFile()
-
-    def UpdateEntry(self, entry, search):
-        index = None
-        if search:
-            for idx, e in enumerate(self.log_list):
-                if e.date == entry.date and e.time == entry.time:
-                    index = idx
-
-        if index is not None:
-            self.log_list[index] = entry
-        else:
-            self.log_list.append(entry)
-
+    def __init__(self):
+        self.catalog = LogCatalog()
+        # Catalog entries matching the query flags, oldest first
+        self.log_list = []
+        self.archive = None
+        self.vehicle = None
+        self.metrics = Metrics("download_px4_logfile")
+        self.downloaded_logs = 0
+        self.downloaded_bytes = 0
 
     async def initialize(self):
         self.log_dir_path = os.path.join(self.root_dir, self.log_root_dir)
-
-        self.mav = System()
+        if self.args.broker:
+            await self.attach_broker()
+            return
+        # mavsdk and pymavlink take a while to import, not needed for --help
+        require_mavsdk()
+        from mavsdk import System
+        from mavlink_ftp import probe_heartbeat
 
         print("Connecting to px4...")
+        if self.args.connect_timeout is not None:
+            # mavsdk_server does not serve before it has seen a vehicle and
+            # can't be cancelled cleanly, look for a heartbeat first
+            with self.metrics.timed("probe", target=self.args.address):
+                found = await asyncio.to_thread(probe_heartbeat, self.args.address, self.args.connect_timeout)
+            if not found:
+                raise TimeoutError(f"no heartbeat from {self.args.address} in {self.args.connect_timeout:g} s")
+
+        self.mav = System(port=self.mavsdk_server_port)
         # Connect
-        await self.mav.connect(system_address=self.args.address)
+        with self.metrics.timed("connect", target=self.args.address):
+            await self.mav.connect(system_address=self.args.address)
         # This waits till a mavlink based drone is connected
-        async for state in self.mav.core.connection_state():
-            if state.is_connected:
-                print(".. Connected to px4!")
-                break
+        with self.metrics.timed("wait_connected"):
+            async for state in self.mav.core.connection_state():
+                if state.is_connected:
+                    print(".. Connected to px4!")
+                    break
+        print()
+        self.ftp = FtpSession(InstrumentedFtp(self.mav.ftp, self.metrics), metrics=self.metrics)
+
+    async def attach_broker(self):
+        # The broker holds the vehicle connection, see mav_broker.py
+        from mav_broker import BrokerSystem
+        self.mav = BrokerSystem(self.args.broker)
+        print(f"Connecting to broker {self.args.broker}...")
+        with self.metrics.timed("connect", target=self.args.broker):
+            await self.mav.connect()
+        print(".. Connected to px4!")
         print()
+        self.ftp = FtpSession(InstrumentedFtp(self.mav.ftp, self.metrics), metrics=self.metrics)
+
+    async def vehicle_id(self):
+        # Hardware UID of the autopilot, falls back to the connection address
+        try:
+            identification = await self.mav.info.get_identification()
+            if identification.hardware_uid:
+                return identification.hardware_uid
+        except Exception:
+            pass
+        return self.args.address
 
     async def check_dir(self, path):
-        if path.startswith('/'):
-            path = path[1:]
-        if path.endswith('/'):
-            path = path[:-1]
-        req_dirs = path.split('/')
-
-        new_path = "/"
-        dirs = await self.mav.ftp.list_directory(new_path)
-
-        for dir in req_dirs:
-            if ("D"+dir) in dirs:
-                new_path = os.path.join(new_path, dir)
-                dirs = await self.mav.ftp.list_directory(new_path)
-            else:
-                return 0
-        return 1
+        with self.metrics.timed("check_dir", target=path):
+            return await self.ftp.dir_exists(path)
 
     async def validate_log_path(self):
-        # Check if log directory structure exists
-        ret = await self.check_dir(self.root_dir)
-        if ret == 0:
+        # Check if log directory structure exists. The log directory implies
+        # the SD card, the root is probed only to tell the errors apart.
+        if await self.check_dir(self.log_dir_path):
+            return True
+        if not await self.check_dir(self.root_dir):
             print(f"ERROR: Directory {self.root_dir} not found")
             print(f"Verify that SD-card exists in the drone!")
             return False
+        print(f"ERROR: Directory {self.log_dir_path} not found")
+        return False
 
-        ret = await self.check_dir(self.log_dir_path)
-        if ret == 0:
-            print(f"ERROR: Directory {self.log_dir_path} not found")
-            return False
-        return True
+    def is_bulk(self):
+        return self.args.all or self.args.since is not None or self.args.until is not None or self.args.count is not None
+
+    def unattended(self):
+        return self.args.latest or self.args.json or self.is_bulk()
+
+    def query(self):
+        return self.catalog.query(since=self.args.since, until=self.args.until,
+                                  min_size=self.args.min_size, encrypted_only=self.args.encrypted_only)
 
     def is_valid_date(self, now, date):
         try:
@@ -124,84 +220,189 @@ class LogFileDownloader:
             return False
         return True
 
+    def add_log_files(self, now, log_date, log_files):
+        log_date_path = os.path.join(self.log_dir_path, log_date)
+        for file in log_files:
+            if file.startswith('F'):
+                fields = file[1:].split()
+                filename = fields[0]
+                log_time,file_ext = filename.split('.')
+                if self.unattended() and not self.is_valid_time(now, log_date, log_time):
+                    continue
+
+                path = os.path.join(log_date_path,filename)
+                enc = False
+                if file_ext == "ulgk" or file_ext == "ulgc":
+                    enc = True
+                entry = self.catalog.entry(log_date, log_time)
+                entry.enc = enc
+
+                if file_ext == "ulgk":
+                    entry.keyfile = path
+                else:
+                    entry.size = int(fields[1])
+                    entry.datafile = path
+
+    async def scan_date_dirs(self, log_dates):
+        # Keep up to 'scan_concurrency' list requests in flight. Results are
+        # returned in the same order as log_dates.
+        sem = asyncio.Semaphore(max(1, self.args.scan_concurrency))
+
+        async def list_date_dir(log_date):
+            async with sem:
+                return await self.ftp.list_directory(os.path.join(self.log_dir_path, log_date))
+
+        return await asyncio.gather(*[list_date_dir(d) for d in log_dates])
+
     async def list_logfiles(self):
         now = datetime.datetime.now()
         if await self.validate_log_path():
-            date_dirs = await self.mav.ftp.list_directory(self.log_dir_path)
+            scan_start = time.monotonic()
+            date_dirs = await self.ftp.list_directory(self.log_dir_path)
+            log_dates = []
             for dir in date_dirs:
                 if dir.startswith('D'):
                     log_date = dir[1:]
-                    if self.args.latest and not self.is_valid_date(now, log_date):
+                    if self.unattended() and not self.is_valid_date(now, log_date):
                         continue
-
-                    log_date_path = os.path.join(self.log_dir_path, log_date)
-                    log_files = await self.mav.ftp.list_directory(log_date_path)
-                    for file in log_files:
-                        if file.startswith('F'):
-                            fields = file[1:].split()
-                            filename = fields[0]
-                            log_time,file_ext = filename.split('.')
-                            if self.args.latest and not self.is_valid_time(now, log_date, log_time):
-                                continue
-
-                            path = os.path.join(log_date_path,filename)
-                            enc = False
-                            if file_ext == "ulgk" or file_ext == "ulgc":
-                                enc = True
-                            entry = self.GetEntry(log_date, log_time, enc)
-                            entry.time = log_time
-                            entry.date = log_date
-                            entry.enc = enc
-
-                            if file_ext == "ulgk":
-                                entry.keyfile = path
-                            else:
-                                #entry.size = round(float(fields[1])/1000, 2)
-                                size = float(fields[1])
-                                if size > 999999.0:
-                                    entry.size = ("{:.2f}".format(size/1024/1024)).rjust(8) + " MB"
-                                else:
-                                    entry.size = ("{:.2f}".format(size/1024)).rjust(8) + " kB"
-                                entry.datafile = path
-                            self.UpdateEntry(entry, enc)
+                    log_dates.append(log_date)
+
+            scanned = 0
+            if self.args.latest:
+                # Newest date directories first, stop as soon as a batch yields a log.
+                # Dates are validated above so string order equals date order.
+                log_dates.sort(reverse=True)
+                batch_size = max(1, self.args.scan_concurrency)
+                for start in range(0, len(log_dates), batch_size):
+                    batch = log_dates[start:start + batch_size]
+                    results = await self.scan_date_dirs(batch)
+                    scanned += len(batch)
+                    for log_date, log_files in zip(batch, results):
+                        self.add_log_files(now, log_date, log_files)
+                    if len(self.query()) > 0:
+                        break
+            else:
+                results = await self.scan_date_dirs(log_dates)
+                scanned = len(log_dates)
+                for log_date, log_files in zip(log_dates, results):
+                    self.add_log_files(now, log_date, log_files)
+
+            scan_time = time.monotonic() - scan_start
+            self.metrics.record("scan", scan_time, target=self.log_dir_path)
+            print(f"Scanned {scanned}/{len(log_dates)} date directories in {scan_time:.2f} s (concurrency {self.args.scan_concurrency})")
+        self.log_list = self.query()
         index = 0
-        if self.args.latest:
+        if self.args.json:
+            index = None
+        elif self.is_bulk():
+            index = self.select_bulk()
+            print(f"selected {len(index)} logs:")
+            for idx in index:
+                print(self.log_list[idx].date + "/" + self.log_list[idx].time)
+        elif self.args.latest:
+            downloadable = [idx for idx, entry in enumerate(self.log_list) if entry.datafile is not None]
+            if len(downloadable) == 0:
+                print("No logs found")
+                return None
             print("latest:")
-            for idx, entry in enumerate(self.log_list):
-                if entry.date > self.log_list[index].date:
-                    index = idx
-                elif entry.date == self.log_list[index].date:
-                    if entry.time > self.log_list[index].time:
-                        index = idx
+            index = downloadable[-1]
             print(self.log_list[index].date + "/" + self.log_list[index].time)
+            if self.is_archived(self.log_list[index]):
+                print("already in the archive")
+                return None
         else:
             # Interactive selection
             print("logs:")
             for idx, entry in enumerate(self.log_list):
-                output = str(idx).rjust(5) + ": " + (entry.date+"/"+entry.time).ljust(25) + " " + str(entry.size)
+                output = str(idx).rjust(5) + ": " + (entry.date+"/"+entry.time).ljust(25) + " " + entry.size_str()
                 if entry.enc:
                     output = output + " (encrypted)"
                     if entry.keyfile is None:
                         output = output + " KEYFILE MISSING"
+                if entry.datafile is not None and self.is_archived(entry):
+                    output = output + " (archived)"
                 print(output)
             index = input("\nSelect log file to download: ")
         return index
 
-    async def download_file(self, file, date, dir):
+    def select_bulk(self):
+        # Indexes of the selected logs with a datafile, oldest first
+        selected = [idx for idx, entry in enumerate(self.log_list) if entry.datafile is not None]
+        if self.args.count is not None:
+            selected = selected[-self.args.count:] if self.args.count > 0 else []
+        if self.archive is not None:
+            archived = [idx for idx in selected if self.is_archived(self.log_list[idx])]
+            if len(archived) > 0:
+                print(f"skipping {len(archived)} logs already in the archive")
+            selected = [idx for idx in selected if idx not in archived]
+        return selected
+
+    async def fetch_file(self, file, dir):
+        if self.transfer_slots is not None:
+            async with self.transfer_slots:
+                return await self.transfer_file(file, dir)
+        return await self.transfer_file(file, dir)
+
+    async def transfer_file(self, file, dir):
         previous_progress = 0
-        async for progress in self.mav.ftp.download(file, dir, False):
+        async for progress in self.ftp.download(file, dir, False):
             new_progress = round((progress.bytes_transferred/progress.total_bytes)*100)
-            if new_progress != previous_progress:
+            if new_progress != previous_progress and self.show_progress:
                 sys.stdout.write(f"\r{new_progress} %")
                 sys.stdout.flush()
             previous_progress = new_progress
-        print()
-        filename = [f for f in os.listdir(dir) if os.path.isfile(os.path.join(dir, f))]
-        infilebase, infileext = filename[0].split('.')
+        if self.show_progress:
+            print()
+        return os.path.join(dir, os.path.basename(file))
+
+    def summarize_file(self, path):
+        # Imported here, numpy is only needed with --summarize
+        from ulog_index import ULogIndex, ULogError, print_summary
+        try:
+            with ULogIndex(path) as ulog:
+                print_summary(ulog.summary())
+        except ULogError as e:
+            print(f"WARNING: {e}")
+
+    def finalize_file(self, path, date):
+        if self.args.summarize and path.endswith(".ulg"):
+            self.summarize_file(path)
+        if self.archive is not None:
+            return self.archive_file(path, date)
+        infilebase, infileext = os.path.basename(path).split('.')
         outfile = "log-" + date + "T" + infilebase.replace('_', '-') + "Z." + infileext
+        size = os.path.getsize(path)
+        # shutil.move, the temporary directory may be on another filesystem than --dir
+        shutil.move(path, os.path.join(self.args.dir, outfile))
         print("file: " + outfile)
-        os.rename(os.path.join(dir, filename[0]), os.path.join(self.args.dir, outfile))
+        return size
+
+    def archive_file(self, path, date):
+        name = os.path.basename(path)
+        size = os.path.getsize(path)
+        digest, stored_size, new_object = self.archive.add_file(path, self.vehicle, date, name.split('.')[0], name)
+        os.remove(path)
+        if new_object:
+            ratio = size / stored_size if stored_size else 0.0
+            print(f"archived: {date}/{name} {digest[:12]} ({ratio:.1f}x)")
+        else:
+            print(f"archived: {date}/{name} {digest[:12]} (duplicate)")
+        return size
 
+    def is_archived(self, entry):
+        # A key file without its log is never archived
+        return self.archive is not None and entry.datafile is not None and \
+            self.archive.has_log(self.vehicle, entry.date, entry.time, os.path.basename(entry.datafile))
+
+    def finalize_files(self, paths, date):
+        with self.metrics.timed("finalize"):
+            size = sum(self.finalize_file(path, date) for path in paths)
+        self.downloaded_bytes += size
+        return size
+
+    async def download_file(self, file, date, dir):
+        path = await self.fetch_file(file, dir)
+        return self.finalize_files([path], date)
 
     async def download_logfile(self, index):
         with tempfile.TemporaryDirectory(prefix=".part_", dir=".") as tmpdir:
@@ -209,26 +410,317 @@ class LogFileDownloader:
             await self.download_file(entry.datafile, entry.date, tmpdir)
             if entry.keyfile is not None:
                 await self.download_file(entry.keyfile, entry.date, tmpdir)
+            self.downloaded_logs += 1
+
+    async def download_logfiles(self, indexes):
+        # Download several logs in one session. Finalizing (moving into --dir)
+        # of the previous log runs in a worker thread while the next transfer
+        # is already in progress.
+        start = time.monotonic()
+        total_bytes = 0
+        with tempfile.TemporaryDirectory(prefix=".part_", dir=".") as tmpdir:
+            pending = None
+            for n, index in enumerate(indexes):
+                entry = self.log_list[index]
+                print(f"[{n+1}/{len(indexes)}] {entry.date}/{entry.time}")
+                # Logs of different days can have the same name, don't overwrite
+                # the previous one while it is being finalized
+                entry_dir = os.path.join(tmpdir, entry.date)
+                os.makedirs(entry_dir, exist_ok=True)
+                paths = [await self.fetch_file(entry.datafile, entry_dir)]
+                if entry.keyfile is not None:
+                    paths.append(await self.fetch_file(entry.keyfile, entry_dir))
+                if pending is not None:
+                    total_bytes += await pending
+                # to_thread keeps the context, i.e. the fleet output prefix
+                pending = asyncio.ensure_future(asyncio.to_thread(self.finalize_files, paths, entry.date))
+                self.downloaded_logs += 1
+            if pending is not None:
+                total_bytes += await pending
+        elapsed = time.monotonic() - start
+        rate = total_bytes / 1024 / 1024 / elapsed if elapsed > 0 else 0.0
+        print(f"Downloaded {len(indexes)} logs, {total_bytes/1024/1024:.2f} MB in {elapsed:.2f} s ({rate:.2f} MB/s)")
+
+    def print_progress(self, transferred, total):
+        if total and self.show_progress:
+            progress = round(transferred / total * 100)
+            if progress != self.previous_progress:
+                sys.stdout.write(f"\r{progress} %")
+                sys.stdout.flush()
+            self.previous_progress = progress
+
+    def sync_file(self, ftp, remote, local, size):
+        # Returns (status, bytes transferred). Whatever is already on disk is
+        # treated as a prefix of the remote file and only the rest is fetched;
+        # the CRC32 check at the end catches a wrong guess.
+        from mavlink_ftp import FtpError, file_crc32
+        part = local + ".part"
+        if os.path.exists(local):
+            if os.path.getsize(local) == size and file_crc32(local) == ftp.calc_crc32(remote):
+                return "skipped", 0
+            os.replace(local, part)
+
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        if offset > size:
+            offset = 0
+        os.makedirs(os.path.dirname(local), exist_ok=True)
+        with open(part, 'r+b' if offset > 0 else 'wb') as fh:
+            fh.truncate(offset)
+            self.previous_progress = None
+            ftp.read_file(remote, fh, offset, self.print_progress)
+            transferred = fh.seek(0, os.SEEK_END) - offset
+        if self.show_progress:
+            print()
+
+        if file_crc32(part) != ftp.calc_crc32(remote):
+            os.remove(part)
+            if offset == 0:
+                raise FtpError(f"CRC32 mismatch after downloading {remote}")
+            print(f"WARNING: {remote} changed since the partial download, fetching it again")
+            status, transferred_again = self.sync_file(ftp, remote, local, size)
+            return "downloaded", transferred + transferred_again
+
+        os.replace(part, local)
+        return ("resumed" if offset > 0 else "downloaded"), transferred
+
+    def sync_logfiles(self):
+        # Mirror log_dir_path into --dir/<date>/<file>. Uses the MAVLink FTP
+        # client directly, mavsdk can neither resume a download nor report the
+        # CRC32 of a remote file.
+        from mavlink_ftp import MavlinkFtpClient, FtpError, probe_heartbeat
+        self.log_dir_path = os.path.join(self.root_dir, self.log_root_dir)
+        # Turn SIGTERM into SystemExit so that a partial file is cut back to a
+        # valid resume offset before exiting (only possible in the main thread,
+        # fleet sync runs one thread per vehicle)
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+        print("Connecting to px4...")
+        if self.args.connect_timeout is not None and not probe_heartbeat(self.args.address, self.args.connect_timeout):
+            raise TimeoutError(f"no heartbeat from {self.args.address} in {self.args.connect_timeout:g} s")
+        with self.metrics.timed("connect", target=self.args.address):
+            ftp = InstrumentedFtp(MavlinkFtpClient.connect(self.args.address), self.metrics)
+        print(".. Connected to px4!")
+        print()
 
-    async def run(self):
+        start = time.monotonic()
+        counts = {"skipped": 0, "resumed": 0, "downloaded": 0}
+        total_bytes = 0
+        try:
+            date_dirs = ftp.list_directory(self.log_dir_path)
+            for dir in sorted(date_dirs):
+                if not dir.startswith('D'):
+                    continue
+                log_date = dir[1:]
+                log_date_path = os.path.join(self.log_dir_path, log_date)
+                for file in sorted(ftp.list_directory(log_date_path)):
+                    if not file.startswith('F'):
+                        continue
+                    fields = file[1:].split()
+                    filename = fields[0]
+                    size = int(fields[1])
+                    print(f"{log_date}/{filename}")
+                    file_start = time.perf_counter()
+                    status, transferred = self.sync_file(ftp, os.path.join(log_date_path, filename),
+                                                         os.path.join(self.args.dir, log_date, filename), size)
+                    self.metrics.record("sync." + status, time.perf_counter() - file_start, transferred,
+                                        target=os.path.join(log_date_path, filename))
+                    counts[status] += 1
+                    total_bytes += transferred
+                    if status != "skipped":
+                        self.downloaded_logs += 1
+                        self.downloaded_bytes += transferred
+                    if status != "downloaded":
+                        print(f"  {status}")
+        except FtpError as e:
+            print()
+            print(f"ERROR: {e}")
+            print("Partial files are kept, run sync again to resume")
+            return False
+        finally:
+            ftp.close()
+
+        elapsed = time.monotonic() - start
+        rate = total_bytes / 1024 / 1024 / elapsed if elapsed > 0 else 0.0
+        print(f"Sync done: {counts['downloaded']} downloaded, {counts['resumed']} resumed, {counts['skipped']} up to date")
+        print(f"Transferred {total_bytes/1024/1024:.2f} MB in {elapsed:.2f} s ({rate:.2f} MB/s)")
+        return True
+
+    def parse_args(self, argv=None):
         workdir = os.getcwd()
         parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,description=__doc__)
         parser.add_argument('-a', '--address', action="store", help='Address to connect. (e.g serial:///dev/ttyACM0, udp:192.168.200.101:14540, tcp://:5760)', default='udp://:15761')
         parser.add_argument('-d', '--dir', action="store", help='Output directory (default .)', default=workdir)
         parser.add_argument('-l', '--latest', action="store_true", help='Fetch latest logfile and skip interactive selection')
-        self.args = parser.parse_args()
-        self.args.dir = os.path.realpath(self.args.dir)
-
+        parser.add_argument('--all', action="store_true", help='Download all logfiles in one session')
+        parser.add_argument('--since', action="store", metavar='YYYY-MM-DD', help='Download all logfiles from this date on')
+        parser.add_argument('--until', action="store", metavar='YYYY-MM-DD', help='Download all logfiles up to this date')
+        parser.add_argument('-n', '--count', action="store", type=int, help='Download only the N newest of the selected logfiles')
+        parser.add_argument('--min-size', action="store", type=parse_size, metavar='SIZE', help='Only logs of at least SIZE bytes (suffixes k, M, G)')
+        parser.add_argument('--encrypted-only', action="store_true", help='Only encrypted logs')
+        parser.add_argument('--json', action="store_true", help='Print the matching logs as JSON and exit')
+        parser.add_argument('--archive', action="store", metavar='DIR', help='Store downloaded logs compressed and deduplicated in a log archive (see log_archive.py) instead of --dir')
+        parser.add_argument('--vehicle', action="store", help='Vehicle name recorded in the archive (default: autopilot hardware UID)')
+        parser.add_argument('--summarize', action="store_true", help='Print a summary (duration, dropouts, topic rates) of every downloaded log, see ulog_index.py')
+        parser.add_argument('-s', '--sync', action="store_true", help='Mirror the PX4 log directory into --dir, skipping up to date files and resuming partial ones')
+        parser.add_argument('-j', '--scan-concurrency', action="store", type=int, help='Number of directory list requests kept in flight while scanning (1 = sequential, default 4)', default=4)
+        parser.add_argument('--fleet', action="store", nargs='+', metavar='ADDRESS', help='Collect logs from several vehicles concurrently, one subdirectory of --dir per vehicle')
+        parser.add_argument('--fleet-file', action="store", metavar='FILE', help='Fleet vehicles from FILE, one "ADDRESS [NAME]" per line')
+        parser.add_argument('--fleet-concurrency', action="store", type=int, help='Maximum number of log transfers in progress across the fleet (default 4)', default=4)
+        parser.add_argument('--connect-timeout', action="store", type=float, metavar='SECONDS', help='Give up if the vehicle does not connect in time (default: wait forever, 30 s in fleet mode)')
+        parser.add_argument('--broker', action="store", nargs='?', const=True, metavar='SOCKET', help='Use the vehicle connection of a running mav_broker.py (default the socket it serves by default) instead of connecting to --address')
+        parser.add_argument('--profile', action="store_true", help='Print a timing breakdown of all MAVLink operations at exit')
+        parser.add_argument('--metrics-file', action="store", metavar='FILE', help='Append a JSON line per MAVLink operation to FILE')
+        args = parser.parse_args(argv)
+        args.dir = os.path.realpath(args.dir)
+        if args.broker and (args.sync or args.fleet or args.fleet_file):
+            parser.error("--broker can't be combined with --sync or fleet mode")
+        if args.broker is True:
+            from mav_broker import DEFAULT_SOCKET
+            args.broker = DEFAULT_SOCKET
+        if args.fleet or args.fleet_file:
+            if args.json:
+                parser.error("--json is not supported in fleet mode")
+            if args.fleet_concurrency < 1:
+                parser.error("--fleet-concurrency must be at least 1")
+        return args
+
+    async def collect(self):
         await self.initialize()
+        if self.args.archive:
+            # Imported here, sqlite3 is only needed with --archive
+            from log_archive import LogArchive
+            self.archive = LogArchive(self.args.archive)
+            self.vehicle = self.args.vehicle if self.args.vehicle else await self.vehicle_id()
+            print(f"Archiving to {self.archive.root} as vehicle '{self.vehicle}'")
         index = await self.list_logfiles()
-        if str(index).isnumeric():
+        if isinstance(index, list):
+            await self.download_logfiles(index)
+        elif str(index).isnumeric():
             await self.download_logfile(int(index))
 
+    def fleet_vehicles(self):
+        # [(address, name)], names default to the address
+        vehicles = [(address, None) for address in self.args.fleet or []]
+        if self.args.fleet_file:
+            vehicles += parse_fleet_file(self.args.fleet_file)
+        if not vehicles:
+            raise ValueError("no vehicles in the fleet")
+        names = [name if name else vehicle_dir_name(address) for address, name in vehicles]
+        if len(set(names)) != len(names):
+            raise ValueError("fleet vehicle names are not unique")
+        return [(address, name, given is not None) for (address, given), name in zip(vehicles, names)]
+
+    def fleet_downloader(self, n, address, name, named):
+        downloader = LogFileDownloader()
+        downloader.args = copy.copy(self.args)
+        downloader.args.address = address
+        downloader.args.dir = os.path.join(self.args.dir, name)
+        if named:
+            downloader.args.vehicle = name
+        if downloader.args.connect_timeout is None:
+            downloader.args.connect_timeout = 30
+        # Every System spawns its own mavsdk_server
+        downloader.mavsdk_server_port = self.mavsdk_server_port + n
+        downloader.metrics = self.metrics
+        downloader.show_progress = False
+        downloader.transfer_slots = self.transfer_slots
+        os.makedirs(downloader.args.dir, exist_ok=True)
+        return downloader
+
+    async def collect_vehicle(self, downloader, name):
+        current_vehicle.set(name)
+        start = time.monotonic()
+        try:
+            if self.args.sync:
+                # The sync client is blocking, run it in a thread. The whole
+                # vehicle takes a transfer slot, the reads are not interleaved.
+                async with self.transfer_slots:
+                    ok = await asyncio.to_thread(downloader.sync_logfiles)
+                status = "ok" if ok else "incomplete"
+            else:
+                await downloader.collect()
+                status = "ok"
+        except TimeoutError as e:
+            status = f"not connected: {e}"
+        except Exception as e:
+            status = f"ERROR: {e}"
+        finally:
+            if downloader.archive is not None:
+                downloader.archive.close()
+        if status != "ok":
+            print(status)
+        return name, status, downloader.downloaded_logs, downloader.downloaded_bytes, time.monotonic() - start
+
+    async def run_fleet(self):
+        try:
+            vehicles = self.fleet_vehicles()
+        except (OSError, ValueError) as e:
+            print(f"ERROR: {e}")
+            return False
+        if not self.unattended() and not self.args.sync:
+            # No interactive selection with several vehicles
+            self.args.latest = True
+        self.transfer_slots = asyncio.Semaphore(self.args.fleet_concurrency)
+        downloaders = [self.fleet_downloader(n, address, name, named)
+                       for n, (address, name, named) in enumerate(vehicles)]
+        print(f"Collecting from {len(vehicles)} vehicles, {self.args.fleet_concurrency} transfers at a time")
+
+        start = time.monotonic()
+        with contextlib.redirect_stdout(VehicleOutput(sys.stdout)):
+            results = await asyncio.gather(*[self.collect_vehicle(downloader, name)
+                                             for downloader, (_, name, _) in zip(downloaders, vehicles)])
+        elapsed = time.monotonic() - start
+
+        print()
+        print("vehicle".ljust(24) + "logs".rjust(6) + "MB".rjust(10) + "time s".rjust(9) + "  status")
+        for name, status, logs, nbytes, vehicle_elapsed in results:
+            print(name.ljust(24) + str(logs).rjust(6) + f"{nbytes/1024/1024:10.2f}" + f"{vehicle_elapsed:9.2f}" + "  " + status)
+        total_bytes = sum(result[3] for result in results)
+        rate = total_bytes / 1024 / 1024 / elapsed if elapsed > 0 else 0.0
+        print(f"Fleet done in {elapsed:.2f} s (vehicles took {sum(result[4] for result in results):.2f} s in total), "
+              f"{total_bytes/1024/1024:.2f} MB ({rate:.2f} MB/s)")
+        return all(result[1] == "ok" for result in results)
+
+    async def run(self):
+        self.args = self.parse_args()
+        self.metrics = Metrics("download_px4_logfile", self.args.metrics_file)
+        # mav_broker is only imported with --broker
+        errors = (TimeoutError,)
+        if self.args.broker:
+            from mav_broker import BrokerError
+            errors += (BrokerError,)
+        try:
+            if self.args.fleet or self.args.fleet_file:
+                return await self.run_fleet()
+
+            if self.args.sync:
+                return self.sync_logfiles()
+
+            if self.args.json:
+                # Keep stdout clean for the JSON document
+                with contextlib.redirect_stdout(sys.stderr):
+                    await self.initialize()
+                    await self.list_logfiles()
+                json.dump([entry.as_dict() for entry in self.log_list], sys.stdout, indent=2)
+                print()
+                return True
+
+            await self.collect()
+            return True
+        except errors as e:
+            print(f"ERROR: {e}")
+            return False
+        finally:
+            if self.args.profile:
+                self.metrics.print_profile(sys.stderr if self.args.json else sys.stdout)
+            self.metrics.close()
+
 
 def main():
     downloader = LogFileDownloader()
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(downloader.run())
+    ok = loop.run_until_complete(downloader.run())
+    sys.exit(0 if ok else 1)
 
 if __name__ == "__main__":
     main()
@@ -12,26 +12,38 @@ Command description:
  - upload    : To upload new config.txt to px4
  - remove    : To remove the config.txt from the px4
  - reboot    : To restart px4
+ - wait      : To wait until px4 is connected again after reboot
+ - verify    : To compare the CRC32 of config.txt in px4 with the local file
+ - diff      : To list the `param set` lines of the local file that differ from px4
+ - apply     : To set the differing parameters in px4 right away, without reboot
+
+Several commands run in order over one connection, e.g.
+    flight_env_config.py upload reboot wait verify check -f indoor.txt
 """
 
 import asyncio
-import importlib.util
 import sys, os
+import json
+import math
 
-# For arm64, the docker image does not have mavsdk installed since qemu emulation is slow
-# Installing during runtime should be faster
-if importlib.util.find_spec('mavsdk') is None:
-    os.system('pip3 install mavsdk==2.1.0')
-
-from mavsdk import System
+from mav_metrics import Metrics, InstrumentedFtp
+from ftp_session import FtpSession
+from mavsdk_bootstrap import require_mavsdk
+from mav_broker import BrokerSystem, BrokerError, DEFAULT_SOCKET
 import re
 import argparse
 import shutil
+import tempfile
+import time
 
 
 class FlightEnvChanger:
 
     mav = None
+    # FTP plugin of mav, replaceable with a wrapper with the same interface
+    ftp = None
+    # gRPC port of the mavsdk_server spawned for this instance
+    mavsdk_server_port = 50051
 
     default_env = "outdoor"
     environment = "[unknown]"
@@ -45,40 +57,209 @@ class FlightEnvChanger:
     config_dir_path = ""
     config_file_path = ""
     tmp_file = "/tmp/" + config_file_name
+    # Last known config.txt per vehicle, reused while its size and CRC32
+    # match the file on px4
+    default_cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "fog-tools", "config")
+    vehicle_cache_dir = ""
+    vehicle_address = ""
+    # Set by reboot, wait then expects the connection to drop first
+    rebooted = False
+    # A chain stops when one of these fails
+    required_steps = ("upload", "wait", "verify", "apply")
+
+    def __init__(self):
+        self.metrics = Metrics("flight_env_config")
 
     async def initialize(self):
         self.config_dir_path = os.path.join(self.root_dir, self.config_dir)
         self.config_file_path = os.path.join(self.config_dir_path, self.config_file_name)
+        if self.args.broker:
+            await self.attach_broker()
+            return
+        # mavsdk takes a while to import, not needed for --help
+        require_mavsdk()
+        from mavsdk import System
 
-        self.mav = System()
+        self.mav = System(port=self.mavsdk_server_port)
+        self.vehicle_address = self.args.address
 
         print("Connecting to px4...")
         # Connect
-        await self.mav.connect(system_address=self.args.address)
+        with self.metrics.timed("connect", target=self.args.address):
+            await self.mav.connect(system_address=self.args.address)
         # This waits till a mavlink based drone is connected
-        async for state in self.mav.core.connection_state():
-            if state.is_connected:
-                print(".. Connected to px4!")
-                break
+        with self.metrics.timed("wait_connected"):
+            async for state in self.mav.core.connection_state():
+                if state.is_connected:
+                    print(".. Connected to px4!")
+                    break
+        print()
+        self.ftp = FtpSession(InstrumentedFtp(self.mav.ftp, self.metrics), metrics=self.metrics)
+
+    async def attach_broker(self):
+        # The broker holds the vehicle connection, see mav_broker.py
+        self.mav = BrokerSystem(self.args.broker)
+        print(f"Connecting to broker {self.args.broker}...")
+        with self.metrics.timed("connect", target=self.args.broker):
+            status = await self.mav.connect()
+        self.vehicle_address = status.address
+        print(".. Connected to px4!")
         print()
+        self.ftp = FtpSession(InstrumentedFtp(self.mav.ftp, self.metrics), metrics=self.metrics)
+
+    def init_cache(self):
+        # Keyed by the vehicle address, not by the hardware UID: once the info
+        # plugin is used, mavsdk_server does not reconnect after px4 reboots.
+        # A wrong guess only costs a transfer, size and CRC32 are checked.
+        vehicle = re.sub(r'[^A-Za-z0-9_.-]+', '_', self.vehicle_address).strip('_')
+        self.vehicle_cache_dir = os.path.join(self.args.cache_dir, vehicle)
+        os.makedirs(self.vehicle_cache_dir, exist_ok=True)
+
+    def cache_file(self):
+        return os.path.join(self.vehicle_cache_dir, self.config_file_name)
+
+    def store_cache(self, path):
+        # Through a temporary file, a concurrent check must not read half a file
+        fd, tmp_path = tempfile.mkstemp(dir=self.vehicle_cache_dir)
+        os.close(fd)
+        shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, self.cache_file())
+
+    async def cached_config_file(self):
+        '''path of the cached config.txt if it matches the one on px4, else None'''
+        if self.args.no_cache:
+            return None
+        path = self.cache_file()
+        # The size comes with the directory listing, the CRC32 is calculated
+        # by px4 and costs one request
+        size = await self.ftp.file_size(self.config_file_path)
+        if not os.path.isfile(path) or os.path.getsize(path) != size:
+            return None
+        try:
+            if await self.ftp.are_files_identical(path, self.config_file_path):
+                return path
+        except Exception as e:
+            print(f"WARNING: CRC32 check of {self.config_file_path} failed: {e}")
+        return None
+
+    async def fetch_config_file(self, logging=True):
+        '''download config.txt from px4 into the cache, returns the cached path'''
+        if logging:
+            sys.stdout.write("Download")
+        tmp_dir = tempfile.mkdtemp(dir=self.vehicle_cache_dir)
+        try:
+            progress = self.ftp.download(self.config_file_path, tmp_dir, False)
+            async for p in progress:
+                if logging:
+                    sys.stdout.write(".")
+                    sys.stdout.flush()
+            os.replace(os.path.join(tmp_dir, self.config_file_name), self.cache_file())
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        if logging:
+            print()
+            print("Done")
+        return self.cache_file()
+
+    def params_file(self):
+        return os.path.join(self.vehicle_cache_dir, "params.json")
+
+    def store_params(self, params, fetched):
+        fd, tmp_path = tempfile.mkstemp(dir=self.vehicle_cache_dir)
+        with os.fdopen(fd, 'w') as fh:
+            json.dump({"fetched": fetched, "params": params}, fh)
+        os.replace(tmp_path, self.params_file())
+
+    def drop_params(self):
+        if self.vehicle_cache_dir and os.path.exists(self.params_file()):
+            os.remove(self.params_file())
+
+    async def vehicle_params(self):
+        '''name -> ["int" | "float", value] of all px4 parameters'''
+        path = self.params_file()
+        if not self.args.no_cache and os.path.exists(path):
+            with open(path) as fh:
+                snapshot = json.load(fh)
+            age = time.time() - snapshot["fetched"]
+            if age < self.args.param_cache_ttl:
+                self.metrics.record("param_cache.hit", 0.0)
+                print(f"Using the parameter snapshot from {age:.0f} s ago")
+                return snapshot["params"]
+        fetched = time.time()
+        with self.metrics.timed("param.get_all_params"):
+            all_params = await self.mav.param.get_all_params()
+        params = {p.name: ["int", p.value] for p in all_params.int_params}
+        params.update({p.name: ["float", p.value] for p in all_params.float_params})
+        print(f"Fetched {len(params)} parameters from px4")
+        self.store_params(params, fetched)
+        return params
+
+    def read_config_params(self, path):
+        '''name -> value text of the "param set" lines in a config file'''
+        params = {}
+        with open(path, "r") as fh:
+            for line in fh:
+                match = re.match(r'\s*param\s+set\s+(\S+)\s+(\S+)', line)
+                if match:
+                    params[match.group(1)] = match.group(2)
+        return params
+
+    async def param_changes(self):
+        '''[(name, type, current, new)] of the config file parameters that differ from px4'''
+        if not os.path.exists(self.args.file):
+            print(f"Config file not found: '{self.args.file}'")
+            return None
+        wanted = self.read_config_params(self.args.file)
+        params = await self.vehicle_params()
+        changes = []
+        for name, text in wanted.items():
+            if name not in params:
+                print(f"WARNING: {name} is not a px4 parameter")
+                continue
+            kind, current = params[name]
+            try:
+                value = int(float(text)) if kind == "int" else float(text)
+            except ValueError:
+                print(f"WARNING: invalid value for {name}: '{text}'")
+                continue
+            # px4 stores floats with single precision
+            if kind == "int" and value != current or \
+                    kind == "float" and not math.isclose(value, current, rel_tol=1e-6, abs_tol=1e-9):
+                changes.append((name, kind, current, value))
+        for name, _, current, value in changes:
+            print(f"  {name}: {current:g} -> {value:g}")
+        print(f"{len(changes)} of {len(wanted)} parameters in '{self.args.file}' differ from px4")
+        return changes
+
+    async def diff_config_params(self):
+        return await self.param_changes() is not None
+
+    async def apply_config_params(self):
+        changes = await self.param_changes()
+        if not changes:
+            return changes is not None
+        start = time.perf_counter()
+        # Sent together, px4 answers every PARAM_SET with the new value
+        results = await asyncio.gather(*[self.mav.param.set_param_int(name, value) if kind == "int"
+                                         else self.mav.param.set_param_float(name, value)
+                                         for name, kind, _, value in changes], return_exceptions=True)
+        self.metrics.record("param.set", time.perf_counter() - start, target=f"{len(changes)} parameters")
+        failed = [(name, result) for (name, _, _, _), result in zip(changes, results) if isinstance(result, Exception)]
+        for name, error in failed:
+            print(f"ERROR: setting {name} failed: {error}")
+        if os.path.exists(self.params_file()):
+            with open(self.params_file()) as fh:
+                snapshot = json.load(fh)
+            for (name, kind, _, value), result in zip(changes, results):
+                if not isinstance(result, Exception):
+                    snapshot["params"][name] = [kind, value]
+            self.store_params(snapshot["params"], snapshot["fetched"])
+        print(f"Applied {len(changes) - len(failed)} parameters in {time.perf_counter() - start:.2f} s")
+        return not failed
 
     async def check_dir(self, path):
-        if path.startswith('/'):
-            path = path[1:]
-        if path.endswith('/'):
-            path = path[:-1]
-        req_dirs = path.split('/')
-
-        new_path = "/"
-        dirs = await self.mav.ftp.list_directory(new_path)
-
-        for dir in req_dirs:
-            if ("D"+dir) in dirs:
-                new_path = os.path.join(new_path, dir)
-                dirs = await self.mav.ftp.list_directory(new_path)
-            else:
-                return 0
-        return 1
+        with self.metrics.timed("check_dir", target=path):
+            return await self.ftp.dir_exists(path)
 
     def read_config_type(self, path):
         fh = open(path, "r")
@@ -92,28 +273,24 @@ class FlightEnvChanger:
         return "[unknown]"
 
     async def validate_config_path(self):
-        # Check if config directory structure exists
-        ret = await self.check_dir(self.root_dir)
-        if ret == 0:
+        # Check if config directory structure exists. The config directory
+        # implies the SD card, the root is probed only when it is missing.
+        if await self.check_dir(self.config_dir_path):
+            return True
+        if not await self.check_dir(self.root_dir):
             print(f"ERROR: Directory {self.root_dir} not found!")
             return False
-
-        ret = await self.check_dir(self.config_dir_path)
-        if ret == 0:
-            print(f"config directory {self.config_dir_path} missing, creating..")
-            await self.mav.ftp.create_directory(self.config_dir_path)
+        print(f"config directory {self.config_dir_path} missing, creating..")
+        await self.ftp.create_directory(self.config_dir_path)
         return True
 
     async def validate_config_file(self):
-        # Check if config file exists
+        # Check if config file exists, the directory listing is cached by
+        # validate_config_path
         if await self.validate_config_path():
-            files = await self.mav.ftp.list_directory(self.config_dir_path)
-            for file in files:
-                file=file[1:]
-                file=file.split('\t')[0]
-                if self.config_file_name == file:
-                    # File found
-                    return True
+            if await self.ftp.file_exists(self.config_file_path):
+                # File found
+                return True
         # File not found
         self.environment = self.default_env
         return False
@@ -129,34 +306,33 @@ class FlightEnvChanger:
                 self.environment = self.read_config_type(self.tmp_file)
                 print(f"upload new config file '{self.args.file}' -- env: {self.environment}")
                 sys.stdout.write("Upload")
-                progress = self.mav.ftp.upload(self.tmp_file, self.config_dir_path)
+                progress = self.ftp.upload(self.tmp_file, self.config_dir_path)
                 async for p in progress:
                     sys.stdout.write(".")
                     sys.stdout.flush()
                 print()
                 print("Done")
+                self.store_cache(self.tmp_file)
                 os.remove(self.tmp_file)
+                return True
+            return False
         else:
             print(f"Config file not found: '{self.args.file}'")
+            return False
 
     async def download_config_file(self, copyfile=True, logging=True):
         if await self.validate_config_file():
-            if logging:
-                sys.stdout.write("Download")
-            progress = self.mav.ftp.download(self.config_file_path, '/tmp', False)
-            async for p in progress:
+            path = await self.cached_config_file()
+            if path is not None:
+                self.metrics.record("config_cache.hit", 0.0, target=self.config_file_path)
                 if logging:
-                    sys.stdout.write(".")
-                    sys.stdout.flush()
-                else:
-                    pass
-            if logging:
-                print()
-                print("Done")
-            self.environment = self.read_config_type(self.tmp_file)
+                    print("Config file unchanged, using the cached copy")
+            else:
+                self.metrics.record("config_cache.miss", 0.0, target=self.config_file_path)
+                path = await self.fetch_config_file(logging)
+            self.environment = self.read_config_type(path)
             if copyfile:
-                shutil.copyfile(self.tmp_file, self.args.file)
-            os.remove(self.tmp_file)
+                shutil.copyfile(path, self.args.file)
             if logging:
                 print(f"Config file downloaded: '{self.args.file}' -- env: {self.environment}")
             return True
@@ -166,13 +342,16 @@ class FlightEnvChanger:
     async def clear_hitl_param(self):
         print(f"Clear SYS_HITL in case set by config")
         await self.mav.param.set_param_int("SYS_HITL", 0)
+        self.drop_params()
 
     async def remove_config_file(self):
         if await self.validate_config_file():
             self.environment = self.default_env
             # Remove the file from px4 sdcard
             print(f"Remove file from PX4 path: '{self.config_file_path}'")
-            await self.mav.ftp.remove_file(self.config_file_path)
+            await self.ftp.remove_file(self.config_file_path)
+            if os.path.exists(self.cache_file()):
+                os.remove(self.cache_file())
             # Clear SYS_HITL definition, in case set by config.txt
             await self.clear_hitl_param()
             return True
@@ -180,36 +359,116 @@ class FlightEnvChanger:
             await self.clear_hitl_param()
             return False
 
+    async def verify_config_file(self):
+        if not os.path.exists(self.args.file):
+            print(f"Config file not found: '{self.args.file}'")
+            return False
+        if not await self.validate_config_file():
+            print(f"Verify failed: {self.config_file_path} not found in px4")
+            return False
+        # px4 calculates the CRC32 of its file, nothing is transferred
+        if not await self.ftp.are_files_identical(self.args.file, self.config_file_path):
+            print(f"Verify failed: {self.config_file_path} differs from '{self.args.file}'")
+            return False
+        print(f"Verified: {self.config_file_path} matches '{self.args.file}'")
+        return True
+
     async def reboot(self):
         print(f"Reboot PX4")
         await self.mav.action.reboot()
+        self.rebooted = True
+        # px4 applies config.txt while booting
+        self.drop_params()
+
+    async def wait_connection(self):
+        # After a reboot the link has to go down before the next connected
+        # state means px4 is back
+        lost = not self.rebooted
+        async for state in self.mav.core.connection_state():
+            if not state.is_connected:
+                lost = True
+            elif lost:
+                return
+
+    async def wait_for_px4(self):
+        print("Waiting for px4...")
+        try:
+            await asyncio.wait_for(self.wait_connection(), self.args.wait_timeout)
+        except asyncio.TimeoutError:
+            print(f"px4 did not come back within {self.args.wait_timeout} s")
+            return False
+        self.rebooted = False
+        # px4 restarted, what was listed before may have changed
+        self.ftp.invalidate_all()
+        print(".. Connected to px4!")
+        return True
 
+    async def run_commands(self, commands):
+        steps = {
+            "check": self.check_current_config,
+            "download": self.download_config_file,
+            "upload": self.upload_config_file,
+            "remove": self.remove_config_file,
+            "reboot": self.reboot,
+            "wait": self.wait_for_px4,
+            "verify": self.verify_config_file,
+            "diff": self.diff_config_params,
+            "apply": self.apply_config_params,
+        }
+        durations = []
+        for index, command in enumerate(commands):
+            start = time.perf_counter()
+            ok = await steps[command]()
+            durations.append((command, time.perf_counter() - start))
+            self.metrics.record(f"step.{command}", durations[-1][1], ok=ok is not False)
+            if ok is False and command in self.required_steps:
+                skipped = commands[index + 1:]
+                if skipped:
+                    print(f"ERROR: {command} failed, skipping: {' '.join(skipped)}")
+                return False
+        if len(commands) > 1:
+            print(", ".join(f"{command} {duration:.2f} s" for command, duration in durations) +
+                  f" -- total {sum(d for _, d in durations):.2f} s")
+        return True
 
-    async def run(self):
+
+    def parse_args(self, argv=None):
         parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,description=__doc__)
-        parser.add_argument('COMMAND', choices=['check', 'download', 'upload', 'remove', 'reboot'], help='Command to execute',)
+        parser.add_argument('COMMAND', nargs='+', choices=['check', 'download', 'upload', 'remove', 'reboot', 'wait', 'verify', 'diff', 'apply'], help='Commands to execute, in order',)
         parser.add_argument('-f', '--file', action="store", help='Path to local config file to be read/write', default='./config.txt')
         parser.add_argument('-a', '--address', action="store", help='Address to connect. (e.g serial:///dev/ttyACM0, udp://192.168.200.101:14540, tcp://:5760)', default='udp://:5760')
-        self.args = parser.parse_args()
+        parser.add_argument('--broker', action="store", nargs='?', const=DEFAULT_SOCKET, metavar='SOCKET', help=f'Use the vehicle connection of a running mav_broker.py (default socket {DEFAULT_SOCKET}) instead of connecting to --address')
+        parser.add_argument('--wait-timeout', action="store", type=float, metavar='SECONDS', help='How long wait waits for px4 to come back (default 60)', default=60)
+        parser.add_argument('--cache-dir', action="store", metavar='DIR', help=f'Directory of the per vehicle config.txt cache (default {FlightEnvChanger.default_cache_dir})', default=FlightEnvChanger.default_cache_dir)
+        parser.add_argument('--no-cache', action="store_true", help='Always transfer config.txt and fetch the parameters from px4 instead of using the cached copies')
+        parser.add_argument('--param-cache-ttl', action="store", type=float, metavar='SECONDS', help='How long diff and apply reuse the parameter snapshot of a vehicle (default 300)', default=300)
+        parser.add_argument('--profile', action="store_true", help='Print a timing breakdown of all MAVLink operations at exit')
+        parser.add_argument('--metrics-file', action="store", metavar='FILE', help='Append a JSON line per MAVLink operation to FILE')
+        return parser.parse_args(argv)
 
-        await self.initialize()
-
-        if self.args.COMMAND == "check":
-            await self.check_current_config()
-        elif self.args.COMMAND == "download":
-            await self.download_config_file()
-        elif self.args.COMMAND == "upload":
-            await self.upload_config_file()
-        elif self.args.COMMAND == "remove":
-            await self.remove_config_file()
-        elif self.args.COMMAND == "reboot":
-            await self.reboot()
+    async def run(self):
+        self.args = self.parse_args()
+        self.metrics = Metrics("flight_env_config", self.args.metrics_file)
+        ok = False
+        try:
+            await self.initialize()
+            if set(self.args.COMMAND) & {"check", "download", "upload", "remove", "diff", "apply"}:
+                self.init_cache()
+            ok = await self.run_commands(self.args.COMMAND)
+        except BrokerError as e:
+            print(f"ERROR: {e}")
+        finally:
+            if self.args.profile:
+                self.metrics.print_profile()
+            self.metrics.close()
+        return ok
 
 
 def main():
     changer = FlightEnvChanger()
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(changer.run())
+    if not loop.run_until_complete(changer.run()):
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
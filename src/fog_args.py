@@ -0,0 +1,14 @@
+#!/usr/bin/env python3
+
+"""
+Command line argument types shared by the tools.
+"""
+
+
+def parse_size(value):
+    # "2000", "500k", "1.5M" -> bytes
+    units = {'k': 1024, 'm': 1024 * 1024, 'g': 1024 * 1024 * 1024}
+    value = value.strip().lower().rstrip('b')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
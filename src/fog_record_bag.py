@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+
+"""
+Bounded ROS 2 bag recorder
+==========================
+Records topics into a rosbag2 bag through rosbag2_py, without filling the
+disk of the mission computer:
+ - topics are chosen with --include / --exclude glob patterns (default all)
+ - --rate PATTERN=HZ keeps at most HZ messages per second of a topic
+ - the bag is split every --max-bag-size bytes and compressed with zstd,
+   a split file is compressed as soon as it is closed
+ - recording stops when the bag reaches --max-total or the disk has less
+   than --min-free left
+
+With --ring MINUTES nothing is written continuously: the last MINUTES of
+messages are kept in memory and written into a new bag in the output
+directory on SIGUSR1 or a call of the ~/snapshot service (std_srvs/Trigger).
+
+The message rate, disk write rate, bag size and CPU use are printed every
+--interval seconds. Topics are looked up every few seconds, so topics
+that appear later are recorded too.
+
+Examples:
+    fog_record_bag.py --exclude '/camera/*' --rate '/fmu/out/sensor_combined=10'
+    fog_record_bag.py --ring 5 -o /tools-data/snapshots &
+    kill -USR1 $!
+"""
+
+import argparse
+import collections
+import fnmatch
+import os
+import shutil
+import signal
+import sys
+import threading
+import time
+
+from fog_args import parse_size
+
+DEFAULT_OUTPUT = "fog_bag_%Y%m%d_%H%M%S"
+
+
+def parse_rate(value):
+    # "/fmu/*=10" -> ("/fmu/*", 10.0)
+    pattern, sep, hz = value.rpartition('=')
+    try:
+        if not sep or not pattern or float(hz) <= 0:
+            raise ValueError
+        return pattern, float(hz)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected PATTERN=HZ, got '{value}'")
+
+
+def dir_size(path):
+    '''bytes of the files below path'''
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                # compressed and removed meanwhile
+                pass
+    return total
+
+
+class TopicFilter:
+    '''which topics to record, and the shortest time between kept messages'''
+
+    def __init__(self, include=None, exclude=None, rates=None):
+        self.include = include or ['*']
+        self.exclude = exclude or []
+        # [(pattern, hz)], the first match applies
+        self.rates = rates or []
+
+    def accepts(self, topic):
+        return (any(fnmatch.fnmatchcase(topic, p) for p in self.include) and
+                not any(fnmatch.fnmatchcase(topic, p) for p in self.exclude))
+
+    def min_interval_ns(self, topic):
+        for pattern, hz in self.rates:
+            if fnmatch.fnmatchcase(topic, pattern):
+                return int(1e9 / hz)
+        return 0
+
+
+class RingBuffer:
+    '''the last seconds of serialized messages, at most max_bytes'''
+
+    def __init__(self, seconds, max_bytes):
+        self.max_age_ns = int(seconds * 1e9)
+        self.max_bytes = max_bytes
+        # (timestamp ns, topic, data)
+        self.messages = collections.deque()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def append(self, timestamp, topic, data):
+        with self.lock:
+            self.messages.append((timestamp, topic, data))
+            self.nbytes += len(data)
+            while self.messages and (self.messages[0][0] < timestamp - self.max_age_ns or self.nbytes > self.max_bytes):
+                self.nbytes -= len(self.messages.popleft()[2])
+
+    def copy(self):
+        with self.lock:
+            return list(self.messages)
+
+    def seconds(self):
+        with self.lock:
+            return (self.messages[-1][0] - self.messages[0][0]) / 1e9 if self.messages else 0.0
+
+
+def qos_from_override(override):
+    '''QoSProfile from an entry of a ros2 bag QoS overrides file'''
+    from rclpy.qos import QoSDurabilityPolicy, QoSHistoryPolicy, QoSProfile, QoSReliabilityPolicy
+    qos = QoSProfile(depth=int(override.get("depth", 10)))
+    if "history" in override:
+        qos.history = QoSHistoryPolicy.get_from_short_key(override["history"])
+    if "reliability" in override:
+        qos.reliability = QoSReliabilityPolicy.get_from_short_key(override["reliability"])
+    if "durability" in override:
+        qos.durability = QoSDurabilityPolicy.get_from_short_key(override["durability"])
+    return qos
+
+
+def load_qos_overrides(path):
+    '''topic -> override entry, from a ros2 bag QoS overrides file'''
+    if not path:
+        return {}
+    import yaml
+    with open(path) as fh:
+        return yaml.safe_load(fh) or {}
+
+
+def subscription_qos(node, topic, overrides=None):
+    '''QoSProfile to subscribe to topic with, from overrides or matching its publishers'''
+    from rclpy.qos import QoSDurabilityPolicy, QoSProfile, QoSReliabilityPolicy
+    if overrides and topic in overrides:
+        return qos_from_override(overrides[topic])
+    # Like ros2 bag: best effort if any publisher is, transient local if all are
+    publishers = node.get_publishers_info_by_topic(topic)
+    qos = QoSProfile(depth=100)
+    if any(p.qos_profile.reliability == QoSReliabilityPolicy.BEST_EFFORT for p in publishers):
+        qos.reliability = QoSReliabilityPolicy.BEST_EFFORT
+    if publishers and all(p.qos_profile.durability == QoSDurabilityPolicy.TRANSIENT_LOCAL for p in publishers):
+        qos.durability = QoSDurabilityPolicy.TRANSIENT_LOCAL
+    return qos
+
+
+def open_writer(uri, args):
+    '''rosbag2_py writer for a new bag at uri, compressed if rosbag2 supports it'''
+    import rosbag2_py
+    storage = rosbag2_py.StorageOptions(uri=uri, storage_id='sqlite3', max_bagfile_size=args.max_bag_size)
+    converter = rosbag2_py.ConverterOptions(input_serialization_format='cdr', output_serialization_format='cdr')
+    if args.compression != "none" and hasattr(rosbag2_py, "SequentialCompressionWriter"):
+        mode = rosbag2_py.CompressionMode.MESSAGE if args.compression_mode == "message" else rosbag2_py.CompressionMode.FILE
+        writer = rosbag2_py.SequentialCompressionWriter(rosbag2_py.CompressionOptions(
+            compression_format=args.compression, compression_mode=mode,
+            compression_queue_size=1, compression_threads=1))
+    else:
+        if args.compression != "none":
+            print("WARNING: this rosbag2_py has no compression, writing uncompressed")
+        writer = rosbag2_py.SequentialWriter()
+    writer.open(storage, converter)
+    return writer
+
+
+def close_writer(writer):
+    # Older rosbag2_py has no close(), the bag is finished when the writer is destroyed
+    close = getattr(writer, "close", None)
+    if close is not None:
+        close()
+
+
+class BagRecorder:
+
+    def __init__(self, args, topic_filter):
+        import rclpy
+        self.args = args
+        self.filter = topic_filter
+        self.node = rclpy.create_node('fog_record_bag')
+        self.qos_overrides = load_qos_overrides(args.qos_overrides)
+        self.output = time.strftime(args.output)
+        self.ring = RingBuffer(args.ring * 60, args.ring_memory) if args.ring else None
+        self.writer = None
+        if self.ring is None:
+            self.writer = open_writer(self.output, args)
+        else:
+            os.makedirs(self.output, exist_ok=True)
+        # topic -> (type, subscription)
+        self.topics = {}
+        self.skipped = set()
+        # topic -> timestamp of the last kept message
+        self.last_kept = {}
+        self.received = 0
+        self.written = 0
+        self.decimated = 0
+        self.stopped = None
+        self.snapshot_requested = threading.Event()
+        self.snapshot_thread = None
+        self.start = time.monotonic()
+        # (time, cpu time, bag bytes, messages) at the last status line
+        self.mark = (self.start, time.process_time(), 0, 0)
+        self.discover()
+        self.node.create_timer(args.discovery_interval, self.discover)
+        self.node.create_timer(1.0, self.check_limits)
+        self.node.create_timer(args.interval, self.print_status)
+        if self.ring is not None:
+            try:
+                from std_srvs.srv import Trigger
+                self.node.create_service(Trigger, '~/snapshot', self.snapshot_service)
+            except ImportError:
+                print("WARNING: std_srvs not found, snapshots on SIGUSR1 only")
+
+    def discover(self):
+        import rosbag2_py
+        from rosidl_runtime_py.utilities import get_message
+        for topic, types in self.node.get_topic_names_and_types():
+            if topic in self.topics or topic in self.skipped or not self.filter.accepts(topic):
+                continue
+            try:
+                msg_class = get_message(types[0])
+            except (AttributeError, ModuleNotFoundError, ValueError) as e:
+                print(f"WARNING: not recording {topic}, type {types[0]} not available ({e})")
+                self.skipped.add(topic)
+                continue
+            metadata = rosbag2_py.TopicMetadata(name=topic, type=types[0], serialization_format='cdr')
+            if self.writer is not None:
+                self.writer.create_topic(metadata)
+            subscription = self.node.create_subscription(msg_class, topic, lambda data, topic=topic: self.receive(topic, data),
+                                                         subscription_qos(self.node, topic, self.qos_overrides), raw=True)
+            self.topics[topic] = (metadata, subscription)
+            print(f"Recording {topic} [{types[0]}]")
+
+    def receive(self, topic, data):
+        if self.stopped:
+            return
+        self.received += 1
+        timestamp = time.time_ns()
+        min_interval = self.filter.min_interval_ns(topic)
+        if min_interval:
+            if timestamp - self.last_kept.get(topic, 0) < min_interval:
+                self.decimated += 1
+                return
+            self.last_kept[topic] = timestamp
+        if self.ring is not None:
+            self.ring.append(timestamp, topic, data)
+        else:
+            self.writer.write(topic, data, timestamp)
+        self.written += 1
+
+    def check_limits(self):
+        if self.writer is None or self.stopped:
+            return
+        reason = self.limit_reached()
+        if reason:
+            self.stop(reason)
+
+    def limit_reached(self, size=0):
+        '''why writing size more bytes is not allowed, None if it is'''
+        if self.args.max_total and dir_size(self.output) + size >= self.args.max_total:
+            return f"output reached --max-total {self.args.max_total} bytes"
+        if shutil.disk_usage(self.output).free - size < self.args.min_free:
+            return f"less than --min-free {self.args.min_free} bytes left on disk"
+        return None
+
+    def stop(self, reason):
+        print(f"Recording stopped: {reason}")
+        self.stopped = reason
+        close_writer(self.writer)
+        self.writer = None
+
+    def snapshot_service(self, request, response):
+        self.snapshot_requested.set()
+        response.success = True
+        response.message = "snapshot of the last %.0f s requested" % self.ring.seconds()
+        return response
+
+    def write_snapshot(self):
+        '''write the ring buffer into a new bag, in a thread'''
+        if self.snapshot_thread is not None and self.snapshot_thread.is_alive():
+            print("Snapshot still being written, request ignored")
+            return
+        messages = self.ring.copy()
+        # Uncompressed size, the most the snapshot can take
+        reason = self.limit_reached(sum(len(data) for _, _, data in messages))
+        if reason:
+            print(f"Snapshot refused: {reason}")
+            return
+        uri = os.path.join(self.output, time.strftime("snapshot_%Y%m%d_%H%M%S"))
+        topics = [metadata for metadata, _ in self.topics.values()]
+
+        def write():
+            start = time.monotonic()
+            writer = open_writer(uri, self.args)
+            for metadata in topics:
+                writer.create_topic(metadata)
+            for timestamp, topic, data in messages:
+                writer.write(topic, data, timestamp)
+            close_writer(writer)
+            del writer
+            print("Snapshot %s: %u messages, %.1f s of data, %.1f MB in %.1f s" % (
+                uri, len(messages), (messages[-1][0] - messages[0][0]) / 1e9 if messages else 0.0,
+                dir_size(uri) / 1e6, time.monotonic() - start))
+
+        self.snapshot_thread = threading.Thread(target=write)
+        self.snapshot_thread.start()
+
+    def print_status(self):
+        now = time.monotonic()
+        cpu = time.process_time()
+        last_time, last_cpu, last_bytes, last_written = self.mark
+        interval = now - last_time
+        size = dir_size(self.output)
+        self.mark = (now, cpu, size, self.written)
+        line = "%7.0f s %6.0f msg/s" % (now - self.start, (self.written - last_written) / interval)
+        if self.ring is None:
+            line += "  disk %6.2f MB/s  bag %8.1f MB" % ((size - last_bytes) / interval / 1e6, size / 1e6)
+        else:
+            line += "  ring %6.1f s %8.1f MB" % (self.ring.seconds(), self.ring.nbytes / 1e6)
+        line += "  CPU %3.0f%%  %u topics" % ((cpu - last_cpu) / interval * 100, len(self.topics))
+        if self.decimated:
+            line += ", %u decimated" % self.decimated
+        print(line)
+        sys.stdout.flush()
+
+    def spin(self):
+        import rclpy
+        while not self.stopped:
+            rclpy.spin_once(self.node, timeout_sec=0.2)
+            if self.snapshot_requested.is_set():
+                self.snapshot_requested.clear()
+                self.write_snapshot()
+
+    def close(self):
+        if self.writer is not None:
+            close_writer(self.writer)
+            self.writer = None
+        if self.snapshot_thread is not None:
+            self.snapshot_thread.join()
+        self.node.destroy_node()
+        print("Recorded %u of %u messages (%u decimated) in %.0f s into %s (%.1f MB)" % (
+            self.written, self.received, self.decimated, time.monotonic() - self.start, self.output,
+            dir_size(self.output) / 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('-o', '--output', action="store", help=f'Bag directory, strftime format (default {DEFAULT_OUTPUT.replace("%", "%%")}); with --ring the directory for the snapshots', default=DEFAULT_OUTPUT)
+    parser.add_argument('-i', '--include', action="append", metavar='PATTERN', help='Record topics matching PATTERN (glob, repeatable, default all)')
+    parser.add_argument('-x', '--exclude', action="append", metavar='PATTERN', help='Skip topics matching PATTERN (glob, repeatable)')
+    parser.add_argument('--rate', action="append", type=parse_rate, metavar='PATTERN=HZ', help='Keep at most HZ messages per second of the topics matching PATTERN (repeatable, the first match applies)')
+    parser.add_argument('--max-bag-size', action="store", type=parse_size, metavar='SIZE', help='Split the bag into files of SIZE, suffixes k, M, G (default 256M)', default='256M')
+    parser.add_argument('--compression', action="store", choices=("zstd", "none"), help='Compression of the bag files (default zstd)', default="zstd")
+    parser.add_argument('--compression-mode', action="store", choices=("file", "message"), help='Compress every split file or every message (default file)', default="file")
+    parser.add_argument('--max-total', action="store", type=parse_size, metavar='SIZE', help='Stop recording when the bag reaches SIZE (default no limit)', default='0')
+    parser.add_argument('--min-free', action="store", type=parse_size, metavar='SIZE', help='Stop recording when less than SIZE is left on the disk (default 1G)', default='1G')
+    parser.add_argument('--ring', action="store", type=float, metavar='MINUTES', help='Keep the last MINUTES in memory and write them only on a snapshot request')
+    parser.add_argument('--ring-memory', action="store", type=parse_size, metavar='SIZE', help='Memory limit of --ring (default 512M)', default='512M')
+    parser.add_argument('--qos-overrides', action="store", metavar='FILE', help='QoS profile overrides per topic, in the format of ros2 bag record')
+    parser.add_argument('--interval', action="store", type=float, metavar='SECONDS', help='Seconds between status lines (default 5)', default=5.0)
+    parser.add_argument('--discovery-interval', action="store", type=float, metavar='SECONDS', help='Seconds between looking for new topics (default 2)', default=2.0)
+    args = parser.parse_args()
+
+    try:
+        import rclpy
+        import rosbag2_py  # noqa: F401
+    except ImportError as e:
+        print("Failed to import the ROS 2 python modules: " + str(e))
+        print("")
+        print("Source the ROS environment first:")
+        print("    source /etc/profile.d/ros/setup.bash")
+        sys.exit(1)
+
+    rclpy.init()
+    recorder = BagRecorder(args, TopicFilter(args.include, args.exclude, args.rate))
+
+    def stop(signum, frame):
+        recorder.stopped = recorder.stopped or signal.Signals(signum).name
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    if recorder.ring is not None:
+        signal.signal(signal.SIGUSR1, lambda signum, frame: recorder.snapshot_requested.set())
+    try:
+        recorder.spin()
+    finally:
+        recorder.close()
+        rclpy.shutdown()
+
+
+if __name__ == "__main__":
+    main()
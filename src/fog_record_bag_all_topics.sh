@@ -2,7 +2,7 @@
 
 source /etc/profile.d/ros/setup.bash
 
-ros2 bag record -a --qos-profile-overrides-path /opt/ros/galactic/share/mission-data-recorder/fog_qos_overrides.yaml &
+"$(dirname "$0")"/fog_record_bag.py --qos-overrides /opt/ros/galactic/share/mission-data-recorder/fog_qos_overrides.yaml "$@" &
 ROS_BAG_PID=$!
 
 echo "Press any key to stop recording."
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+"""
+ROS 2 topic rate and bandwidth profiler
+=======================================
+Subscribes to every topic at once and measures them for --duration seconds,
+instead of running 'ros2 topic hz' and 'ros2 topic bw' one topic at a time.
+Prints per topic the messages/s, bytes/s and the bag size per minute,
+most expensive first, to choose what fog_record_bag.py should record.
+
+The same --include, --exclude and --rate options as fog_record_bag.py can
+be given, the "rec MB/min" column and the totals then show what the
+recording would take. Sizes are serialized message sizes, before
+compression.
+
+Example:
+    fog_topic_profile.py --duration 30 --exclude '/camera/*' --rate '/fmu/out/sensor_combined=10'
+"""
+
+import argparse
+import json
+import sys
+import time
+
+from fog_record_bag import TopicFilter, load_qos_overrides, parse_rate, subscription_qos
+
+
+class TopicStats:
+
+    def __init__(self, msg_type, start, min_interval_ns, recorded):
+        self.type = msg_type
+        self.start = start
+        self.min_interval_ns = min_interval_ns
+        # False when the recording filters exclude the topic
+        self.recorded = recorded
+        self.count = 0
+        self.bytes = 0
+        self.kept_count = 0
+        self.kept_bytes = 0
+        self.last_kept = 0
+
+    def receive(self, data):
+        timestamp = time.monotonic_ns()
+        self.count += 1
+        self.bytes += len(data)
+        if self.recorded and timestamp - self.last_kept >= self.min_interval_ns:
+            self.last_kept = timestamp
+            self.kept_count += 1
+            self.kept_bytes += len(data)
+
+    def report(self, end):
+        # Topics found late were measured for a shorter time
+        duration = end - self.start
+        return {
+            "type": self.type,
+            "seconds": round(duration, 3),
+            "messages": self.count,
+            "rate_hz": round(self.count / duration, 2),
+            "bytes_per_s": round(self.bytes / duration, 1),
+            "avg_bytes": round(self.bytes / self.count) if self.count else 0,
+            "mb_per_min": round(self.bytes / duration * 60 / 1e6, 3),
+            "recorded": self.recorded,
+            "recorded_mb_per_min": round(self.kept_bytes / duration * 60 / 1e6, 3),
+        }
+
+
+class TopicProfiler:
+
+    def __init__(self, node, topic_filter, qos_overrides=None):
+        self.node = node
+        self.filter = topic_filter
+        self.qos_overrides = qos_overrides
+        # topic -> TopicStats
+        self.topics = {}
+        self.skipped = set()
+        self.subscriptions = []
+
+    def discover(self):
+        from rosidl_runtime_py.utilities import get_message
+        for topic, types in self.node.get_topic_names_and_types():
+            if topic in self.topics or topic in self.skipped:
+                continue
+            try:
+                msg_class = get_message(types[0])
+            except (AttributeError, ModuleNotFoundError, ValueError) as e:
+                print(f"WARNING: not profiling {topic}, type {types[0]} not available ({e})", file=sys.stderr)
+                self.skipped.add(topic)
+                continue
+            stats = TopicStats(types[0], time.monotonic(), self.filter.min_interval_ns(topic), self.filter.accepts(topic))
+            self.topics[topic] = stats
+            self.subscriptions.append(self.node.create_subscription(
+                msg_class, topic, lambda data, stats=stats: stats.receive(data),
+                subscription_qos(self.node, topic, self.qos_overrides), raw=True))
+
+    def run(self, duration, discovery_interval=2.0):
+        import rclpy
+        end = time.monotonic() + duration
+        next_discovery = time.monotonic()
+        try:
+            while time.monotonic() < end:
+                if time.monotonic() >= next_discovery:
+                    self.discover()
+                    next_discovery += discovery_interval
+                rclpy.spin_once(self.node, timeout_sec=max(0, min(next_discovery, end) - time.monotonic()))
+        except KeyboardInterrupt:
+            pass
+        return self.report(time.monotonic())
+
+    def report(self, end):
+        topics = {topic: stats.report(end) for topic, stats in self.topics.items() if end > stats.start}
+        topics = dict(sorted(topics.items(), key=lambda t: -t[1]["bytes_per_s"]))
+        return {
+            "topics": topics,
+            "total_bytes_per_s": round(sum(t["bytes_per_s"] for t in topics.values()), 1),
+            "total_mb_per_min": round(sum(t["mb_per_min"] for t in topics.values()), 3),
+            "recorded_mb_per_min": round(sum(t["recorded_mb_per_min"] for t in topics.values()), 3),
+        }
+
+
+def print_report(report):
+    total = report["total_bytes_per_s"]
+    print("topic".ljust(48) + "msg/s".rjust(9) + "avg B".rjust(9) + "kB/s".rjust(10) +
+          "MB/min".rjust(9) + "rec MB/min".rjust(12) + "share".rjust(7))
+    for topic, stats in report["topics"].items():
+        print(topic.ljust(48) + f"{stats['rate_hz']:9.1f}" + str(stats["avg_bytes"]).rjust(9) +
+              f"{stats['bytes_per_s'] / 1000:10.1f}" + f"{stats['mb_per_min']:9.2f}" +
+              (f"{stats['recorded_mb_per_min']:12.2f}" if stats["recorded"] else "excluded".rjust(12)) +
+              f"{stats['bytes_per_s'] / total * 100 if total else 0.0:6.1f}%")
+    print("")
+    print("%u topics, %.1f kB/s: %.1f MB per minute, %.1f MB per hour" % (
+        len(report["topics"]), total / 1000, report["total_mb_per_min"], report["total_mb_per_min"] * 60))
+    if report["recorded_mb_per_min"] != report["total_mb_per_min"]:
+        print("With the recording filters: %.1f MB per minute, %.1f MB per hour" % (
+            report["recorded_mb_per_min"], report["recorded_mb_per_min"] * 60))
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('-d', '--duration', action="store", type=float, metavar='SECONDS', help='Seconds to measure (default 10)', default=10.0)
+    parser.add_argument('-i', '--include', action="append", metavar='PATTERN', help='Topics fog_record_bag.py would record (glob, repeatable, default all)')
+    parser.add_argument('-x', '--exclude', action="append", metavar='PATTERN', help='Topics fog_record_bag.py would skip (glob, repeatable)')
+    parser.add_argument('--rate', action="append", type=parse_rate, metavar='PATTERN=HZ', help='Decimation fog_record_bag.py would do (repeatable)')
+    parser.add_argument('--qos-overrides', action="store", metavar='FILE', help='QoS profile overrides per topic, in the format of ros2 bag record')
+    parser.add_argument('--discovery-interval', action="store", type=float, metavar='SECONDS', help='Seconds between looking for new topics (default 2)', default=2.0)
+    parser.add_argument('--json', action="store", metavar='FILE', help='Write the report as JSON into FILE (- for stdout)')
+    args = parser.parse_args()
+
+    try:
+        import rclpy
+    except ImportError as e:
+        print("Failed to import the ROS 2 python modules: " + str(e))
+        print("")
+        print("Source the ROS environment first:")
+        print("    source /etc/profile.d/ros/setup.bash")
+        sys.exit(1)
+
+    rclpy.init()
+    node = rclpy.create_node('fog_topic_profile')
+    profiler = TopicProfiler(node, TopicFilter(args.include, args.exclude, args.rate), load_qos_overrides(args.qos_overrides))
+    print("Profiling topics for %.0f s..." % args.duration, file=sys.stderr)
+    report = profiler.run(args.duration, args.discovery_interval)
+    node.destroy_node()
+    rclpy.shutdown()
+
+    if args.json != '-':
+        print_report(report)
+    if args.json == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    elif args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(report, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
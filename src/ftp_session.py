@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+"""
+Cached MAVLink FTP session shared by the mavsdk based tools.
+
+FtpSession wraps an FTP plugin (mavsdk System.ftp, InstrumentedFtp or the
+broker's stand-in) and keeps directory listings for a short time, so
+existence checks and repeated listings of the same directory cost one
+round trip. Existence checks look at the listing of the parent directory
+only, instead of every component from '/'. Concurrent requests for the same
+listing share one reply, and writes drop the listings they affect.
+"""
+
+import asyncio
+import os
+import time
+
+NOT_FOUND_RESULTS = ("FILE_DOES_NOT_EXIST",)
+
+
+def is_not_found(error):
+    # mavsdk FtpError keeps the result code in _result, BrokerError in result
+    result = getattr(error, 'result', None)
+    if result is None:
+        result = getattr(getattr(getattr(error, '_result', None), 'result', None), 'name', None)
+    return result in NOT_FOUND_RESULTS
+
+
+def normalize(path):
+    path = os.path.normpath('/' + path.strip('/'))
+    # normpath keeps a leading '//'
+    return '/' + path.lstrip('/')
+
+
+class FtpSession:
+
+    def __init__(self, ftp, ttl=5.0, metrics=None):
+        self.ftp = ftp
+        self.ttl = ttl
+        self.metrics = metrics
+        # path -> (expires, entries or the not found error)
+        self.listings = {}
+        # path -> future of the listing request in flight
+        self.inflight = {}
+        # Bumped by every invalidation, replies to older requests are not cached
+        self.generation = 0
+
+    def __getattr__(self, name):
+        # download, are_files_identical, ... pass through unchanged
+        return getattr(self.ftp, name)
+
+    async def _fetch(self, path):
+        try:
+            return await self.ftp.list_directory(path)
+        except Exception as e:
+            if is_not_found(e):
+                return e
+            raise
+
+    async def listing(self, path):
+        '''entries of path, or the not found error if it doesn't exist'''
+        path = normalize(path)
+        cached = self.listings.get(path)
+        if cached is not None and cached[0] > time.monotonic():
+            if self.metrics is not None:
+                self.metrics.record("ftp_cache.hit", 0.0, target=path)
+            return cached[1]
+        future = self.inflight.get(path)
+        if future is None:
+            generation = self.generation
+            future = asyncio.ensure_future(self._fetch(path))
+            self.inflight[path] = future
+
+            def done(future, path=path, generation=generation):
+                self.inflight.pop(path, None)
+                if not future.cancelled() and future.exception() is None and generation == self.generation:
+                    self.listings[path] = (time.monotonic() + self.ttl, future.result())
+            future.add_done_callback(done)
+        elif self.metrics is not None:
+            self.metrics.record("ftp_cache.shared", 0.0, target=path)
+        # A cancelled caller must not cancel the request other callers wait for
+        return await asyncio.shield(future)
+
+    async def list_directory(self, path):
+        entries = await self.listing(path)
+        if isinstance(entries, Exception):
+            raise entries
+        return entries
+
+    async def dir_exists(self, path):
+        # From the parent listing rather than by listing path: mavsdk starts
+        # every listing at sequence number 0, so after a NAK PX4 takes the next
+        # listing for a retransmission and replays the NAK.
+        path = normalize(path)
+        if path == '/':
+            return True
+        entries = await self.listing(os.path.dirname(path))
+        if isinstance(entries, Exception):
+            return False
+        return ('D' + os.path.basename(path)) in entries
+
+    async def file_size(self, path):
+        '''size of a file from the listing of its directory, None if missing'''
+        entries = await self.listing(os.path.dirname(normalize(path)))
+        if isinstance(entries, Exception):
+            return None
+        name = os.path.basename(path)
+        for entry in entries:
+            fields = entry[1:].split('\t')
+            if entry.startswith('F') and fields[0] == name:
+                return int(fields[1]) if len(fields) > 1 else 0
+        return None
+
+    async def file_exists(self, path):
+        return await self.file_size(path) is not None
+
+    def invalidate(self, *paths):
+        '''drop the listings of paths and their parent directories'''
+        self.generation += 1
+        for path in paths:
+            path = normalize(path)
+            self.listings.pop(path, None)
+            self.listings.pop(os.path.dirname(path), None)
+
+    def invalidate_all(self):
+        '''drop every listing, e.g. after a reboot'''
+        self.generation += 1
+        self.listings.clear()
+
+    async def create_directory(self, path):
+        try:
+            return await self.ftp.create_directory(path)
+        finally:
+            self.invalidate(path)
+
+    async def remove_directory(self, path):
+        try:
+            return await self.ftp.remove_directory(path)
+        finally:
+            self.invalidate(path)
+
+    async def remove_file(self, path):
+        try:
+            return await self.ftp.remove_file(path)
+        finally:
+            self.invalidate(path)
+
+    async def rename(self, from_path, to_path):
+        try:
+            return await self.ftp.rename(from_path, to_path)
+        finally:
+            self.invalidate(from_path, to_path)
+
+    async def upload(self, local_path, remote_dir):
+        try:
+            async for progress in self.ftp.upload(local_path, remote_dir):
+                yield progress
+        finally:
+            self.invalidate(os.path.join(remote_dir, os.path.basename(local_path)))
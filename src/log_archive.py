@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+"""
+Local PX4 Log Archive
+=====================
+Compressed, content addressed store for downloaded ulog files with a
+SQLite index of which logs have been fetched from which vehicle.
+
+Layout of the archive directory:
+ - index.sqlite                  : vehicle, date, time, name, size and hash of every log
+ - objects/<hh>/<sha256>.gz      : gzip compressed file contents, stored once per hash
+
+Command description:
+ - list      : List archived logs
+ - stats     : Show archive size and compression ratio
+ - extract   : Decompress an archived log
+"""
+
+import argparse
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+CHUNK_SIZE = 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    hash TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    stored_size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS logs (
+    vehicle TEXT NOT NULL,
+    date TEXT NOT NULL,
+    time TEXT NOT NULL,
+    name TEXT NOT NULL,
+    hash TEXT NOT NULL REFERENCES objects(hash),
+    added TEXT NOT NULL,
+    PRIMARY KEY (vehicle, date, time, name)
+);
+CREATE INDEX IF NOT EXISTS logs_date ON logs(date, time);
+"""
+
+
+class LogArchive:
+
+    def __init__(self, root):
+        self.root = os.path.realpath(root)
+        self.objects_dir = os.path.join(self.root, "objects")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(self.root, "index.sqlite"), check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest + ".gz")
+
+    def has_log(self, vehicle, date, time, name):
+        row = self.db.execute("SELECT 1 FROM logs WHERE vehicle=? AND date=? AND time=? AND name=?",
+                              (vehicle, date, time, name)).fetchone()
+        return row is not None
+
+    def add_file(self, path, vehicle, date, time, name=None):
+        '''compress path into the archive and index it, returns (hash, stored_size, new_object)'''
+        if name is None:
+            name = os.path.basename(path)
+        # Compress into a temporary object while hashing the plain content,
+        # the hash is only known once the whole file has been read.
+        hasher = hashlib.sha256()
+        size = 0
+        with tempfile.NamedTemporaryFile(dir=self.objects_dir, prefix=".part_", delete=False) as tmp:
+            try:
+                with open(path, 'rb') as src, gzip.GzipFile(fileobj=tmp, mode='wb', compresslevel=6, mtime=0) as gz:
+                    while True:
+                        chunk = src.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        hasher.update(chunk)
+                        gz.write(chunk)
+                        size += len(chunk)
+            except BaseException:
+                os.remove(tmp.name)
+                raise
+        digest = hasher.hexdigest()
+        stored_size = os.path.getsize(tmp.name)
+
+        target = self.object_path(digest)
+        new_object = not os.path.exists(target)
+        if new_object:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(tmp.name, target)
+        else:
+            os.remove(tmp.name)
+            stored_size = os.path.getsize(target)
+
+        with self.db:
+            self.db.execute("INSERT OR IGNORE INTO objects (hash, size, stored_size) VALUES (?, ?, ?)",
+                            (digest, size, stored_size))
+            self.db.execute("INSERT OR REPLACE INTO logs (vehicle, date, time, name, hash, added) VALUES (?, ?, ?, ?, ?, ?)",
+                            (vehicle, date, time, name, digest,
+                             datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')))
+        return digest, stored_size, new_object
+
+    def query(self, vehicle=None, since=None, until=None):
+        sql = "SELECT logs.vehicle, logs.date, logs.time, logs.name, logs.hash, objects.size, objects.stored_size " \
+              "FROM logs JOIN objects ON logs.hash = objects.hash WHERE 1=1"
+        params = []
+        if vehicle is not None:
+            sql += " AND logs.vehicle = ?"
+            params.append(vehicle)
+        if since is not None:
+            sql += " AND logs.date >= ?"
+            params.append(since)
+        if until is not None:
+            sql += " AND logs.date <= ?"
+            params.append(until)
+        sql += " ORDER BY logs.date, logs.time, logs.name"
+        keys = ("vehicle", "date", "time", "name", "hash", "size", "stored_size")
+        return [dict(zip(keys, row)) for row in self.db.execute(sql, params)]
+
+    def stats(self):
+        logs = self.db.execute("SELECT COUNT(*) FROM logs").fetchone()[0]
+        vehicles = self.db.execute("SELECT COUNT(DISTINCT vehicle) FROM logs").fetchone()[0]
+        objects, size, stored_size = self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(stored_size), 0) FROM objects").fetchone()
+        return {"logs": logs, "vehicles": vehicles, "objects": objects, "size": size, "stored_size": stored_size}
+
+    def extract(self, digest, out):
+        matches = [row[0] for row in self.db.execute("SELECT hash FROM objects WHERE hash LIKE ?", (digest + "%",))]
+        if len(matches) != 1:
+            raise KeyError(f"{len(matches)} objects match '{digest}'")
+        with gzip.open(self.object_path(matches[0]), 'rb') as src, open(out, 'wb') as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('ARCHIVE', help='Archive directory')
+    parser.add_argument('COMMAND', choices=['list', 'stats', 'extract'], help='Command to execute')
+    parser.add_argument('HASH', nargs='?', help='Object hash (or unique prefix) for extract')
+    parser.add_argument('-v', '--vehicle', action="store", help='Only logs from this vehicle')
+    parser.add_argument('--since', action="store", metavar='YYYY-MM-DD', help='Only logs from this date on')
+    parser.add_argument('--until', action="store", metavar='YYYY-MM-DD', help='Only logs up to this date')
+    parser.add_argument('-o', '--output', action="store", help='Output file for extract (default: hash prefix + .ulg)')
+    parser.add_argument('--json', action="store_true", help='Machine readable output')
+    args = parser.parse_args()
+
+    archive = LogArchive(args.ARCHIVE)
+    if args.COMMAND == "list":
+        rows = archive.query(vehicle=args.vehicle, since=args.since, until=args.until)
+        if args.json:
+            json.dump(rows, sys.stdout, indent=2)
+            print()
+        else:
+            for row in rows:
+                print(f"{row['vehicle']:<24} {row['date']}/{row['time']:<10} {row['name']:<14} "
+                      f"{row['size']/1024/1024:8.2f} MB  {row['hash'][:12]}")
+    elif args.COMMAND == "stats":
+        stats = archive.stats()
+        if args.json:
+            json.dump(stats, sys.stdout, indent=2)
+            print()
+        else:
+            ratio = stats["size"] / stats["stored_size"] if stats["stored_size"] else 0.0
+            print(f"{stats['logs']} logs from {stats['vehicles']} vehicles in {stats['objects']} objects")
+            print(f"{stats['size']/1024/1024:.2f} MB stored as {stats['stored_size']/1024/1024:.2f} MB (ratio {ratio:.1f})")
+    elif args.COMMAND == "extract":
+        if args.HASH is None:
+            parser.error("extract needs a HASH")
+        out = args.output if args.output else args.HASH[:12] + ".ulg"
+        archive.extract(args.HASH, out)
+        print(f"file: {out}")
+    archive.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+
+"""
+MAVLink Connection Broker
+=========================
+Keeps one mavsdk connection to the vehicle open and shares it with the
+tools over a Unix socket, so back to back commands skip the mavsdk_server
+startup and the connection handshake:
+
+    mav_broker.py -a udp://:14540 &
+    flight_env_config.py check --broker
+    flight_env_config.py upload -f indoor.txt --broker
+
+Protocol, one JSON object per line:
+ request : {"id": 1, "plugin": "ftp", "method": "list_directory", "args": ["/fs/microsd"]}
+ reply   : {"id": 1, "result": ...}
+ stream  : {"id": 1, "item": ...} per value, then {"id": 1, "end": true}
+ error   : {"id": 1, "error": "...", "type": "FtpError", "result": "FILE_DOES_NOT_EXIST"}
+ cancel  : {"id": 1, "cancel": true}
+Requests without "plugin" are handled by the broker itself ("describe", "status").
+"""
+
+import argparse
+import asyncio
+import collections.abc
+import enum
+import inspect
+import itertools
+import json
+import os
+import signal
+import socket
+import tempfile
+import time
+import types
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), "fog-mav-broker.sock")
+# mavsdk plugins the clients may use
+PLUGINS = ("action", "core", "ftp", "info", "param", "telemetry")
+# Arguments of FTP calls that are local paths, resolved by the client since
+# the broker has another working directory
+FTP_LOCAL_ARGS = {"download": 1, "upload": 0, "are_files_identical": 0}
+
+
+def to_json(value):
+    '''mavsdk result objects as JSON types'''
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, enum.Enum):
+        return value.name
+    if isinstance(value, collections.abc.Sequence):
+        # also protobuf repeated fields, e.g. list_directory()
+        return [to_json(v) for v in value]
+    if hasattr(value, '__dict__'):
+        return {k: to_json(v) for k, v in vars(value).items() if not k.startswith('_')}
+    return str(value)
+
+
+def from_json(value):
+    # Objects come back as namespaces, so attribute access works as with mavsdk
+    if isinstance(value, dict):
+        return types.SimpleNamespace(**{k: from_json(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return [from_json(v) for v in value]
+    return value
+
+
+class BrokerError(Exception):
+
+    def __init__(self, message, type=None, result=None):
+        super().__init__(message)
+        # Exception class and mavsdk result code on the broker side
+        self.type = type
+        self.result = result
+
+
+class MavBroker:
+
+    mav = None
+    # gRPC port of the mavsdk_server spawned by the broker, apart from the
+    # 50051 the tools use when they connect directly
+    mavsdk_server_port = 50050
+
+    def __init__(self, args):
+        self.args = args
+        self.connected = asyncio.Event()
+        self.started = time.monotonic()
+        self.requests = 0
+        self.watch_task = None
+
+    async def initialize(self):
+        from mavsdk_bootstrap import require_mavsdk
+        require_mavsdk()
+        from mavsdk import System
+        self.mav = System(port=self.mavsdk_server_port)
+        print("Connecting to px4...")
+        await self.mav.connect(system_address=self.args.address)
+        self.watch_task = asyncio.ensure_future(self.watch_connection())
+        await self.connected.wait()
+
+    async def watch_connection(self):
+        # Requests wait while the vehicle is away, e.g. rebooting
+        async for state in self.mav.core.connection_state():
+            if state.is_connected and not self.connected.is_set():
+                print(".. Connected to px4!")
+                self.connected.set()
+            elif not state.is_connected and self.connected.is_set():
+                print("Connection to px4 lost")
+                self.connected.clear()
+
+    def describe(self):
+        # plugin -> method -> "call" | "stream"
+        methods = {}
+        for plugin in PLUGINS:
+            methods[plugin] = {name: "stream" if inspect.isasyncgenfunction(func) else "call"
+                               for name, func in inspect.getmembers(getattr(self.mav, plugin), inspect.ismethod)
+                               if not name.startswith('_')}
+        return methods
+
+    async def status(self):
+        try:
+            await asyncio.wait_for(self.connected.wait(), self.args.connect_timeout)
+        except asyncio.TimeoutError:
+            pass
+        return {"address": self.args.address, "connected": self.connected.is_set(),
+                "uptime": time.monotonic() - self.started, "requests": self.requests}
+
+    async def serve(self, request, send):
+        id = request["id"]
+        plugin = request.get("plugin")
+        method = request.get("method", "")
+        args = request.get("args", [])
+        start = time.perf_counter()
+        try:
+            if plugin is None:
+                if method == "describe":
+                    result = self.describe()
+                elif method == "status":
+                    result = await self.status()
+                else:
+                    raise BrokerError(f"unknown broker request '{method}'")
+                await send({"id": id, "result": result})
+                return
+            if plugin not in PLUGINS or method.startswith('_'):
+                raise BrokerError(f"{plugin}.{method} is not available")
+            self.requests += 1
+            await asyncio.wait_for(self.connected.wait(), self.args.connect_timeout)
+            func = getattr(getattr(self.mav, plugin), method)
+            if inspect.isasyncgenfunction(func):
+                async for item in func(*args):
+                    await send({"id": id, "item": to_json(item)})
+                await send({"id": id, "end": True})
+            else:
+                await send({"id": id, "result": to_json(await func(*args))})
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            result = getattr(getattr(e, '_result', None), 'result', None)
+            await send({"id": id, "error": str(e) or type(e).__name__, "type": type(e).__name__,
+                        "result": to_json(result)})
+        finally:
+            if self.args.verbose and plugin is not None:
+                print(f"{plugin}.{method} {args} {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    async def handle_client(self, reader, writer):
+        tasks = {}
+
+        async def send(message):
+            writer.write((json.dumps(message) + "\n").encode())
+            await writer.drain()
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = json.loads(line)
+                if request.get("cancel"):
+                    task = tasks.get(request["id"])
+                    if task is not None:
+                        task.cancel()
+                    continue
+                task = asyncio.ensure_future(self.serve(request, send))
+                tasks[request["id"]] = task
+                task.add_done_callback(lambda t, id=request["id"]: tasks.pop(id, None))
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            # Client gone, stop its streams and pending requests
+            for task in list(tasks.values()):
+                task.cancel()
+            writer.close()
+
+    async def run(self):
+        if os.path.exists(self.args.socket):
+            probe = socket.socket(socket.AF_UNIX)
+            try:
+                probe.connect(self.args.socket)
+                print(f"ERROR: a broker is already serving {self.args.socket}")
+                return
+            except OSError:
+                # Left over from a broker that was killed
+                os.remove(self.args.socket)
+            finally:
+                probe.close()
+
+        await self.initialize()
+        # Clients can reboot the vehicle and write its files, only our user may connect
+        umask = os.umask(0o077)
+        try:
+            server = await asyncio.start_unix_server(self.handle_client, path=self.args.socket)
+        finally:
+            os.umask(umask)
+        print(f"Serving {self.args.address} on {self.args.socket}")
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+        try:
+            await stop.wait()
+        finally:
+            server.close()
+            os.remove(self.args.socket)
+            self.watch_task.cancel()
+            # mavsdk (2.1.0) stops its server only when System is garbage collected,
+            # its output thread would keep the process alive until then.
+            # _stop_mavsdk_server is private, newer versions may not have it
+            if hasattr(self.mav, "_stop_mavsdk_server"):
+                self.mav._stop_mavsdk_server()
+            print(f"Served {self.requests} requests")
+
+
+class BrokerPlugin:
+    '''mavsdk plugin stand-in, methods are generated from the broker's description'''
+
+    def __init__(self, system, plugin, methods):
+        for method, kind in methods.items():
+            setattr(self, method, self._stream(system, plugin, method) if kind == "stream"
+                    else self._call(system, plugin, method))
+
+    @staticmethod
+    def _args(plugin, method, args):
+        args = list(args)
+        index = FTP_LOCAL_ARGS.get(method) if plugin == "ftp" else None
+        if index is not None and index < len(args):
+            args[index] = os.path.realpath(args[index])
+        return args
+
+    def _call(self, system, plugin, method):
+        async def call(*args):
+            return await system.call(plugin, method, self._args(plugin, method, args))
+        return call
+
+    def _stream(self, system, plugin, method):
+        async def stream(*args):
+            async for item in system.stream(plugin, method, self._args(plugin, method, args)):
+                yield item
+        return stream
+
+
+class BrokerProtocol(asyncio.Protocol):
+    '''client end of the broker socket, routes replies to the waiting requests'''
+
+    def __init__(self):
+        self.transport = None
+        self.buffer = b""
+        # request id -> queue of replies
+        self.pending = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        *lines, self.buffer = (self.buffer + data).split(b"\n")
+        for line in lines:
+            reply = json.loads(line)
+            queue = self.pending.get(reply["id"])
+            if queue is not None:
+                queue.put_nowait(reply)
+
+    def connection_lost(self, exc):
+        for queue in self.pending.values():
+            queue.put_nowait({"error": "broker closed the connection", "type": "BrokerError"})
+
+    def send(self, message):
+        self.transport.write((json.dumps(message) + "\n").encode())
+
+
+class BrokerSystem:
+    '''
+    stands in for mavsdk.System in the tools: plugin calls are forwarded to a
+    running mav_broker.py
+    '''
+
+    def __init__(self, socket_path=DEFAULT_SOCKET):
+        self.socket_path = socket_path
+        self.ids = itertools.count(1)
+        self.protocol = None
+
+    async def connect(self, system_address=None):
+        '''attach to the broker, raises BrokerError if the broker has no vehicle'''
+        try:
+            _, self.protocol = await asyncio.get_running_loop().create_unix_connection(BrokerProtocol, self.socket_path)
+        except OSError as e:
+            raise BrokerError(f"no broker on {self.socket_path} ({e.strerror}), start mav_broker.py first")
+        for plugin, methods in vars(await self.call(None, "describe")).items():
+            setattr(self, plugin, BrokerPlugin(self, plugin, vars(methods)))
+        status = await self.call(None, "status")
+        if not status.connected:
+            raise BrokerError(f"broker on {self.socket_path} is not connected to {status.address}")
+        return status
+
+    def close(self):
+        if self.protocol is not None:
+            self.protocol.transport.close()
+
+    def _request(self, plugin, method, args):
+        id = next(self.ids)
+        queue = self.protocol.pending[id] = asyncio.Queue()
+        self.protocol.send({"id": id, "plugin": plugin, "method": method, "args": args})
+        return id, queue
+
+    @staticmethod
+    def _error(reply):
+        return BrokerError(reply["error"], reply.get("type"), reply.get("result"))
+
+    async def call(self, plugin, method, args=()):
+        id, queue = self._request(plugin, method, list(args))
+        try:
+            reply = await queue.get()
+        finally:
+            self.protocol.pending.pop(id, None)
+        if "error" in reply:
+            raise self._error(reply)
+        return from_json(reply["result"])
+
+    async def stream(self, plugin, method, args=()):
+        id, queue = self._request(plugin, method, list(args))
+        done = False
+        try:
+            while True:
+                reply = await queue.get()
+                if "item" in reply:
+                    yield from_json(reply["item"])
+                    continue
+                done = True
+                if "error" in reply:
+                    raise self._error(reply)
+                return
+        finally:
+            self.protocol.pending.pop(id, None)
+            if not done and not self.protocol.transport.is_closing():
+                # Consumer stopped early (e.g. break out of connection_state)
+                self.protocol.send({"id": id, "cancel": True})
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('-a', '--address', action="store", help='Address to connect. (e.g serial:///dev/ttyACM0, udp://:14540, tcp://:5760)', default='udp://:14540')
+    parser.add_argument('-s', '--socket', action="store", help=f'Unix socket to serve on (default {DEFAULT_SOCKET})', default=DEFAULT_SOCKET)
+    parser.add_argument('--connect-timeout', action="store", type=float, metavar='SECONDS', help='How long requests wait for the vehicle to (re)connect (default 30)', default=30)
+    parser.add_argument('-v', '--verbose', action="store_true", help='Print every request with its duration')
+    args = parser.parse_args()
+
+    broker = MavBroker(args)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(broker.run())
+
+
+if __name__ == "__main__":
+    main()
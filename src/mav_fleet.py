@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+"""
+Fleet helpers shared by the tools that work on many vehicles at once
+(download_px4_logfile.py --fleet, mavlink_shell.py --fleet).
+"""
+
+import contextvars
+import re
+
+
+current_vehicle = contextvars.ContextVar("current_vehicle", default=None)
+
+
+class VehicleOutput:
+    '''
+    stdout replacement for fleet mode: lines printed by a vehicle task are
+    prefixed with the vehicle name so concurrent output stays readable
+    '''
+
+    def __init__(self, out):
+        self.out = out
+        self.pending = {}
+
+    def write(self, text):
+        name = current_vehicle.get()
+        if name is None:
+            return self.out.write(text)
+        *lines, rest = (self.pending.pop(name, "") + text).split("\n")
+        for line in lines:
+            self.out.write(f"[{name}] {line}\n")
+        if rest:
+            self.pending[name] = rest
+        return len(text)
+
+    def flush(self):
+        self.out.flush()
+
+
+def parse_fleet_file(path):
+    # One vehicle per line: ADDRESS [NAME], '#' starts a comment
+    vehicles = []
+    with open(path) as fh:
+        for line in fh:
+            fields = line.split('#')[0].split()
+            if fields:
+                vehicles.append((fields[0], fields[1] if len(fields) > 1 else None))
+    return vehicles
+
+
+def vehicle_dir_name(address):
+    # "udp://:14541" -> "udp_14541"
+    return re.sub(r'[^A-Za-z0-9.-]+', '_', address).strip('_')
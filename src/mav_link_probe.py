@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+
+"""
+MAVLink link quality probe
+==========================
+Connects to a vehicle the same way as mavlink_shell.py and measures the
+link instead of guessing from how sluggish the shell feels:
+ - packet loss, from gaps in the MAVLink sequence numbers of every sender
+ - round trip time of TIMESYNC and PING requests
+ - rate and bandwidth of every message type
+
+A line of live stats is printed every --interval seconds and a summary at
+the end, --json FILE writes the final report. --max-loss and --max-rtt-ms
+make the exit status 1 when the link is worse, e.g. before a log download:
+
+    mav_link_probe.py udp:0.0.0.0:14550 --duration 20 --max-loss 1 --max-rtt-ms 300 && download_px4_logfile.py --latest
+"""
+
+import argparse
+import json
+import select
+import sys
+import time
+
+from mavlink_shell import connect, mavutil
+from mav_metrics import percentile
+
+# Sequence numbers this far behind the last one are duplicates or reordered
+REORDER_WINDOW = 8
+
+
+class RttProbe:
+    '''requests of one kind on the way and the round trips of the answered ones'''
+
+    def __init__(self):
+        # request id -> send time
+        self.pending = {}
+        self.sent = 0
+        self.lost = 0
+        self.samples = []
+
+    def answered(self, id, now):
+        sent = self.pending.pop(id, None)
+        if sent is not None:
+            self.samples.append(now - sent)
+
+    def expire(self, now, timeout):
+        for id in [id for id, sent in self.pending.items() if now - sent > timeout]:
+            del self.pending[id]
+            self.lost += 1
+
+    def report(self):
+        report = {"sent": self.sent, "received": len(self.samples), "lost": self.lost}
+        if self.samples:
+            for p in (50, 90, 99):
+                report[f"p{p}_ms"] = round(percentile(self.samples, p) * 1000, 3)
+            report["max_ms"] = round(max(self.samples) * 1000, 3)
+        return report
+
+
+class LinkProbe:
+
+    def __init__(self, mav, probe_rate=2.0, probe_timeout=2.0):
+        self.mav = mav
+        # TIMESYNC and PING requests per second, each
+        self.probe_rate = probe_rate
+        # A request without answer after this many seconds is lost
+        self.probe_timeout = probe_timeout
+        # (system, component) -> {"last_seq", "received", "lost"}
+        self.sources = {}
+        # message type -> [count, bytes]
+        self.types = {}
+        self.rtt = {"timesync": RttProbe(), "ping": RttProbe()}
+        self.ping_seq = 0
+        self.received_bytes = 0
+        self.sent_bytes = 0
+        self.bad_data = 0
+        self.start = None
+        self.end = None
+        # totals at the last live line
+        self.mark = (0, 0, 0, {name: 0 for name in self.rtt})
+
+    def send(self, msg):
+        self.mav.mav.send(msg)
+        self.sent_bytes += len(msg.get_msgbuf())
+
+    def send_probes(self, now):
+        ts1 = time.perf_counter_ns()
+        self.rtt["timesync"].pending[ts1] = now
+        self.rtt["timesync"].sent += 1
+        self.send(self.mav.mav.timesync_encode(0, ts1))
+        self.ping_seq = (self.ping_seq + 1) & 0xffffffff
+        self.rtt["ping"].pending[self.ping_seq] = now
+        self.rtt["ping"].sent += 1
+        self.send(self.mav.mav.ping_encode(int(time.time() * 1e6), self.ping_seq, 0, 0))
+        for probe in self.rtt.values():
+            probe.expire(now, self.probe_timeout)
+
+    def handle(self, m, now):
+        msg_type = m.get_type()
+        if msg_type == 'BAD_DATA':
+            self.bad_data += 1
+            return
+        key = (m.get_srcSystem(), m.get_srcComponent())
+        seq = m.get_seq()
+        source = self.sources.get(key)
+        if source is None:
+            source = self.sources[key] = {"last_seq": seq, "received": 0, "lost": 0}
+        elif (source["last_seq"] - seq) & 0xff < REORDER_WINDOW:
+            # A small step back is a duplicate or reordered message
+            pass
+        else:
+            # Anything else is a step forward, also after an outage of 128+ messages
+            source["lost"] += (seq - source["last_seq"] - 1) & 0xff
+            source["last_seq"] = seq
+        source["received"] += 1
+        size = len(m.get_msgbuf())
+        self.received_bytes += size
+        stats = self.types.setdefault(msg_type, [0, 0])
+        stats[0] += 1
+        stats[1] += size
+        # Requests have tc1 0 (PX4 asks us too), answers our ts1
+        if msg_type == 'TIMESYNC' and m.tc1 != 0:
+            self.rtt["timesync"].answered(m.ts1, now)
+        elif msg_type == 'PING' and m.target_system == self.mav.source_system:
+            self.rtt["ping"].answered(m.seq, now)
+
+    def totals(self):
+        received = sum(s["received"] for s in self.sources.values())
+        lost = sum(s["lost"] for s in self.sources.values())
+        return received, lost, self.received_bytes, {name: len(probe.samples) for name, probe in self.rtt.items()}
+
+    def live_line(self, now):
+        '''stats since the previous line'''
+        received, lost, nbytes, samples = self.totals()
+        last_received, last_lost, last_bytes, last_samples = self.mark
+        interval = now - self.mark_time
+        self.mark = (received, lost, nbytes, samples)
+        self.mark_time = now
+        messages = received - last_received
+        dropped = lost - last_lost
+        line = "%7.1f s %6.0f msg/s %8.1f kB/s  loss %5.2f%% (%u)" % (
+            now - self.start, messages / interval, (nbytes - last_bytes) / interval / 1000,
+            dropped / (messages + dropped) * 100 if messages + dropped else 0.0, dropped)
+        for name, probe in self.rtt.items():
+            recent = probe.samples[last_samples[name]:]
+            line += "  %s %s" % (name, "%.1f ms" % (percentile(recent, 50) * 1000) if recent else "-")
+        return line
+
+    def run(self, duration=None, interval=1.0, live=True):
+        self.start = self.mark_time = time.perf_counter()
+        end = self.start + duration if duration else None
+        next_probe = self.start
+        next_heartbeat = self.start
+        next_line = self.start + interval
+        try:
+            while end is None or time.perf_counter() < end:
+                now = time.perf_counter()
+                if now >= next_heartbeat:
+                    self.send(self.mav.mav.heartbeat_encode(mavutil.mavlink.MAV_TYPE_GCS,
+                                                            mavutil.mavlink.MAV_AUTOPILOT_INVALID, 0, 0, 0))
+                    next_heartbeat = now + 1
+                if self.probe_rate > 0 and now >= next_probe:
+                    self.send_probes(now)
+                    next_probe = max(next_probe + 1 / self.probe_rate, now)
+                if now >= next_line:
+                    if live:
+                        print(self.live_line(now))
+                        sys.stdout.flush()
+                    next_line += interval
+                wake = min(next_heartbeat, next_line, next_probe if self.probe_rate > 0 else next_line)
+                if end is not None:
+                    wake = min(wake, end)
+                select.select([self.mav.fd], [], [], max(0, wake - time.perf_counter()))
+                while True:
+                    m = self.mav.recv_match(blocking=False)
+                    if m is None:
+                        break
+                    self.handle(m, time.perf_counter())
+        except KeyboardInterrupt:
+            pass
+        self.end = time.perf_counter()
+        return self.report()
+
+    def report(self):
+        duration = self.end - self.start
+        received, lost, nbytes, _ = self.totals()
+        return {
+            "duration_s": round(duration, 3),
+            "messages": received,
+            "bytes": nbytes,
+            "bytes_per_s": round(nbytes / duration, 1) if duration > 0 else 0.0,
+            "sent_bytes": self.sent_bytes,
+            "bad_data": self.bad_data,
+            "loss": {"received": received, "lost": lost,
+                     "percent": round(lost / (received + lost) * 100, 3) if received + lost else 0.0},
+            "sources": {f"{system}:{component}": {
+                "received": s["received"], "lost": s["lost"],
+                "percent": round(s["lost"] / (s["received"] + s["lost"]) * 100, 3)}
+                for (system, component), s in sorted(self.sources.items())},
+            "rtt": {name: probe.report() for name, probe in self.rtt.items()},
+            "types": {msg_type: {"count": count, "rate_hz": round(count / duration, 2),
+                                 "bytes": size, "bytes_per_s": round(size / duration, 1)}
+                      for msg_type, (count, size) in sorted(self.types.items(), key=lambda t: -t[1][1])},
+        }
+
+
+def print_report(report):
+    print("")
+    print("message".ljust(28) + "count".rjust(8) + "rate Hz".rjust(10) + "bytes/s".rjust(10))
+    for msg_type, stats in report["types"].items():
+        print(msg_type.ljust(28) + str(stats["count"]).rjust(8) + f"{stats['rate_hz']:10.1f}" + f"{stats['bytes_per_s']:10.0f}")
+    print("")
+    loss = report["loss"]
+    print("Received %u messages, %u bytes (%.0f bytes/s) in %.1f s" % (
+        report["messages"], report["bytes"], report["bytes_per_s"], report["duration_s"]))
+    print("Lost %u messages (%.2f%%)%s" % (loss["lost"], loss["percent"],
+                                           ", %u bytes of bad data" % report["bad_data"] if report["bad_data"] else ""))
+    for name, rtt in report["rtt"].items():
+        if "p50_ms" in rtt:
+            print("Round trip %-8s p50 %.1f ms, p90 %.1f ms, p99 %.1f ms, max %.1f ms (%u of %u answered)" % (
+                name, rtt["p50_ms"], rtt["p90_ms"], rtt["p99_ms"], rtt["max_ms"], rtt["received"], rtt["sent"]))
+        else:
+            print("Round trip %-8s no answers to %u requests" % (name, rtt["sent"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('port', metavar='PORT', nargs='?', default=':15761',
+                        help='Mavlink port name: serial: DEVICE[,BAUD], udp: IP:PORT, tcp: tcp:IP:PORT (default :15761)')
+    parser.add_argument('-b', '--baudrate', action="store", type=int, help='Mavlink port baud rate (default 57600)', default=57600)
+    parser.add_argument('-d', '--duration', action="store", type=float, metavar='SECONDS', help='Seconds to measure, 0 = until Ctrl-C (default 10)', default=10.0)
+    parser.add_argument('-i', '--interval', action="store", type=float, metavar='SECONDS', help='Seconds between live stats lines (default 1)', default=1.0)
+    parser.add_argument('--probe-rate', action="store", type=float, metavar='HZ', help='TIMESYNC and PING requests per second, 0 = none (default 2)', default=2.0)
+    parser.add_argument('--probe-timeout', action="store", type=float, metavar='SECONDS', help='A request not answered within this is lost (default 2)', default=2.0)
+    parser.add_argument('--connect-timeout', action="store", type=float, metavar='SECONDS', help='How long to wait for a heartbeat (default 10)', default=10.0)
+    parser.add_argument('--json', action="store", metavar='FILE', help='Write the final report as JSON into FILE (- for stdout)')
+    parser.add_argument('--max-loss', action="store", type=float, metavar='PERCENT', help='Exit with an error if more messages are lost')
+    parser.add_argument('--max-rtt-ms', action="store", type=float, help='Exit with an error if the p90 round trip is longer')
+    args = parser.parse_args()
+    # JSON on stdout, keep it parseable
+    live = args.json != '-'
+    out = sys.stdout if live else sys.stderr
+
+    print("Connecting to %s..." % args.port, file=out)
+    try:
+        mav = connect(args.port, args.baudrate, args.connect_timeout)
+    except TimeoutError as e:
+        print("Error: %s" % e, file=sys.stderr)
+        sys.exit(1)
+    probe = LinkProbe(mav, args.probe_rate, args.probe_timeout)
+    report = probe.run(args.duration or None, args.interval, live)
+    mav.close()
+    report["address"] = args.port
+
+    if live:
+        print_report(report)
+    if args.json == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    elif args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(report, fh, indent=2)
+
+    failures = []
+    if args.max_loss is not None and report["loss"]["percent"] > args.max_loss:
+        failures.append("loss %.2f%% > %.2f%%" % (report["loss"]["percent"], args.max_loss))
+    if args.max_rtt_ms is not None:
+        p90 = [rtt["p90_ms"] for rtt in report["rtt"].values() if "p90_ms" in rtt]
+        if not p90:
+            failures.append("no round trip measured")
+        elif max(p90) > args.max_rtt_ms:
+            failures.append("round trip p90 %.1f ms > %.1f ms" % (max(p90), args.max_rtt_ms))
+    for failure in failures:
+        print("FAIL: " + failure, file=sys.stderr)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
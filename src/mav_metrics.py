@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+"""
+Timing instrumentation shared by the MAVLink tools.
+
+Metrics collects one event per operation (FTP request, connection
+handshake, transfer, ...). It can print a breakdown table (--profile) and
+append every event as a line of JSON to a file (--metrics-file).
+"""
+
+import asyncio
+import contextlib
+import json
+import sys
+import time
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[k]
+
+
+class Metrics:
+
+    def __init__(self, tool, metrics_file=None):
+        self.tool = tool
+        # op -> [(duration, bytes, ok)]
+        self.samples = {}
+        self._fh = open(metrics_file, 'a') if metrics_file else None
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def record(self, op, duration, nbytes=0, target=None, ok=True, error=None):
+        self.samples.setdefault(op, []).append((duration, nbytes, ok))
+        if self._fh is not None:
+            event = {"ts": round(time.time(), 6), "tool": self.tool, "op": op, "duration": round(duration, 6)}
+            if target is not None:
+                event["target"] = target
+            if nbytes:
+                event["bytes"] = nbytes
+                event["bytes_per_s"] = round(nbytes / duration, 1) if duration > 0 else None
+            event["ok"] = ok
+            if error is not None:
+                event["error"] = error
+            self._fh.write(json.dumps(event) + "\n")
+            self._fh.flush()
+
+    @contextlib.contextmanager
+    def timed(self, op, target=None):
+        '''time the body of a with statement (also around awaits)'''
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            self.record(op, time.perf_counter() - start, target=target, ok=False, error=repr(e))
+            raise
+        self.record(op, time.perf_counter() - start, target=target)
+
+    def summary(self):
+        rows = []
+        for op, samples in self.samples.items():
+            durations = [d for d, _, _ in samples]
+            total = sum(durations)
+            nbytes = sum(b for _, b, _ in samples)
+            rows.append({
+                "op": op,
+                "count": len(samples),
+                "errors": sum(1 for _, _, ok in samples if not ok),
+                "total_s": total,
+                "ops_per_s": len(samples) / total if total > 0 else 0.0,
+                "bytes": nbytes,
+                "mb_per_s": nbytes / 1024 / 1024 / total if total > 0 and nbytes else 0.0,
+                "p50_ms": percentile(durations, 50) * 1000,
+                "p99_ms": percentile(durations, 99) * 1000,
+            })
+        return rows
+
+    def print_profile(self, file=None):
+        file = sys.stdout if file is None else file
+        print("", file=file)
+        print("operation".ljust(32) + "count".rjust(7) + "errors".rjust(7) + "total s".rjust(9) +
+              "p50 ms".rjust(9) + "p99 ms".rjust(9) + "MB/s".rjust(8), file=file)
+        for row in self.summary():
+            print(row["op"].ljust(32) + str(row["count"]).rjust(7) + str(row["errors"]).rjust(7) +
+                  f"{row['total_s']:9.2f}" + f"{row['p50_ms']:9.1f}" + f"{row['p99_ms']:9.1f}" +
+                  (f"{row['mb_per_s']:8.2f}" if row["bytes"] else "".rjust(8)), file=file)
+
+
+class InstrumentedFtp:
+    '''
+    wraps an FTP plugin (mavsdk System.ftp or a MavlinkFtpClient) and records
+    every request in Metrics as "<prefix>.<method>"
+    '''
+
+    def __init__(self, ftp, metrics, prefix="ftp"):
+        self._ftp = ftp
+        self._metrics = metrics
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        attr = getattr(self._ftp, name)
+        if name.startswith('_') or name == 'close' or not callable(attr):
+            return attr
+        op = f"{self._prefix}.{name}"
+        if name in ('download', 'upload'):
+            return self._wrap_transfer(op, attr)
+        if asyncio.iscoroutinefunction(attr):
+            return self._wrap_coroutine(op, attr)
+        return self._wrap_call(op, attr)
+
+    def _wrap_coroutine(self, op, func):
+        async def timed(*args, **kwargs):
+            with self._metrics.timed(op, target=args[0] if args else None):
+                return await func(*args, **kwargs)
+        return timed
+
+    def _wrap_call(self, op, func):
+        def timed(*args, **kwargs):
+            with self._metrics.timed(op, target=args[0] if args and isinstance(args[0], str) else None):
+                return func(*args, **kwargs)
+        return timed
+
+    def _wrap_transfer(self, op, func):
+        # mavsdk download/upload are async generators of progress updates
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            total = 0
+            try:
+                async for progress in func(*args, **kwargs):
+                    total = progress.total_bytes
+                    yield progress
+            except BaseException as e:
+                self._metrics.record(op, time.perf_counter() - start, total, target=args[0] if args else None,
+                                     ok=False, error=repr(e))
+                raise
+            self._metrics.record(op, time.perf_counter() - start, total, target=args[0] if args else None)
+        return timed
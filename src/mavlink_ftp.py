@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+
+"""
+Minimal MAVLink FTP client on top of pymavlink.
+
+Used where the mavsdk ftp plugin is not enough: reading a file from an
+offset (resuming partial downloads) and asking PX4 for the CRC32 of a file.
+"""
+
+import struct
+import sys
+import zlib
+from timeit import default_timer as timer
+
+try:
+    from pymavlink import mavutil
+except ImportError as e:
+    print("Failed to import pymavlink: " + str(e))
+    print("")
+    print("You may need to install it with:")
+    print("    pip3 install --user pymavlink")
+    print("")
+    sys.exit(1)
+
+
+# Opcodes
+OP_NONE = 0
+OP_TERMINATE_SESSION = 1
+OP_RESET_SESSIONS = 2
+OP_LIST_DIRECTORY = 3
+OP_OPEN_FILE_RO = 4
+OP_READ_FILE = 5
+OP_CREATE_FILE = 6
+OP_WRITE_FILE = 7
+OP_REMOVE_FILE = 8
+OP_CREATE_DIRECTORY = 9
+OP_REMOVE_DIRECTORY = 10
+OP_OPEN_FILE_WO = 11
+OP_TRUNCATE_FILE = 12
+OP_RENAME = 13
+OP_CALC_FILE_CRC32 = 14
+OP_BURST_READ_FILE = 15
+OP_ACK = 128
+OP_NAK = 129
+
+# NAK error codes
+ERR_NONE = 0
+ERR_FAIL = 1
+ERR_FAIL_ERRNO = 2
+ERR_INVALID_DATA_SIZE = 3
+ERR_INVALID_SESSION = 4
+ERR_NO_SESSIONS_AVAILABLE = 5
+ERR_EOF = 6
+ERR_UNKNOWN_COMMAND = 7
+ERR_FILE_EXISTS = 8
+ERR_FILE_PROTECTED = 9
+ERR_FILE_NOT_FOUND = 10
+
+PAYLOAD_LEN = 251
+HEADER_LEN = 12
+MAX_DATA_LEN = PAYLOAD_LEN - HEADER_LEN
+
+_header = struct.Struct('<HBBBBBBI')
+
+
+class FtpError(Exception):
+
+    def __init__(self, message, error=None):
+        super().__init__(message)
+        self.error = error
+
+
+class FtpPacket:
+    __slots__ = ('seq', 'session', 'opcode', 'size', 'req_opcode', 'burst_complete', 'offset', 'data')
+
+    def __init__(self, seq=0, session=0, opcode=OP_NONE, size=0, req_opcode=OP_NONE, burst_complete=0, offset=0, data=b''):
+        self.seq = seq
+        self.session = session
+        self.opcode = opcode
+        self.size = size
+        self.req_opcode = req_opcode
+        self.burst_complete = burst_complete
+        self.offset = offset
+        self.data = data
+
+    def pack(self):
+        '''payload of a FILE_TRANSFER_PROTOCOL message'''
+        payload = _header.pack(self.seq, self.session, self.opcode, self.size, self.req_opcode,
+                               self.burst_complete, 0, self.offset) + self.data
+        return list(payload.ljust(PAYLOAD_LEN, b'\0'))
+
+    @classmethod
+    def unpack(cls, payload):
+        payload = bytes(payload)
+        seq, session, opcode, size, req_opcode, burst_complete, _, offset = _header.unpack_from(payload)
+        data = payload[HEADER_LEN:HEADER_LEN + size]
+        return cls(seq, session, opcode, size, req_opcode, burst_complete, offset, data)
+
+    def error(self):
+        '''NAK error code'''
+        if self.opcode == OP_NAK and self.size > 0:
+            return self.data[0]
+        return ERR_NONE
+
+
+def px4_crc32(data, crc=0):
+    '''CRC32 as calculated by PX4 (crc32part(): reflected, no pre/post inversion)'''
+    return zlib.crc32(data, crc ^ 0xffffffff) ^ 0xffffffff
+
+
+def file_crc32(path, length=None, chunk_size=1024 * 1024):
+    '''PX4 CRC32 of a local file (or of its first length bytes)'''
+    crc = 0
+    remaining = length
+    with open(path, 'rb') as fh:
+        while remaining is None or remaining > 0:
+            n = chunk_size if remaining is None else min(chunk_size, remaining)
+            chunk = fh.read(n)
+            if not chunk:
+                break
+            crc = px4_crc32(chunk, crc)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return crc
+
+
+def mavutil_address(address):
+    '''Convert a mavsdk connection url into a (device, baudrate) pair for mavutil'''
+    baud = 57600
+    if address.startswith('serial://'):
+        device = address[len('serial://'):]
+        if device.count(':') == 1:
+            device, baud = device.split(':')
+            baud = int(baud)
+        return device, baud
+    if address.startswith('udp://'):
+        host, port = address[len('udp://'):].rsplit(':', 1)
+        return f"udpin:{host or '0.0.0.0'}:{port}", baud
+    if address.startswith('tcp://'):
+        host, port = address[len('tcp://'):].rsplit(':', 1)
+        return f"tcp:{host or '127.0.0.1'}:{port}", baud
+    # Already in mavutil format
+    return address, baud
+
+
+def probe_heartbeat(address, timeout):
+    '''True if an autopilot heartbeat arrives on a mavsdk style address within timeout seconds'''
+    device, baud = mavutil_address(address)
+    mav = mavutil.mavlink_connection(device, baud=baud)
+    try:
+        mav.mav.heartbeat_send(mavutil.mavlink.MAV_TYPE_GENERIC, mavutil.mavlink.MAV_AUTOPILOT_INVALID, 0, 0, 0)
+        return mav.wait_heartbeat(timeout=timeout) is not None
+    finally:
+        mav.close()
+
+
+def parse_list_entries(data):
+    '''Entries of a ListDirectory reply in mavsdk list_directory() format ("D<name>", "F<name>\\t<size>")'''
+    entries = []
+    for entry in data.split(b'\0'):
+        if len(entry) == 0:
+            continue
+        entries.append(entry.decode('utf-8', 'replace'))
+    return entries
+
+
+class MavlinkFtpClient():
+    '''MAVLink FTP requests over a mavutil connection, one request in flight at a time'''
+
+    def __init__(self, mav, target_system=1, target_component=1, timeout=0.5, retries=8, debug=0):
+        self.mav = mav
+        self.target_system = target_system
+        self.target_component = target_component
+        self.timeout = timeout
+        self.retries = retries
+        self._debug = debug
+        self.seq = 0
+
+    @classmethod
+    def connect(cls, address, **kwargs):
+        '''open a mavutil connection for a mavsdk style address and wait for the autopilot'''
+        device, baud = mavutil_address(address)
+        mav = mavutil.mavlink_connection(device, autoreconnect=True, baud=baud)
+        mav.mav.heartbeat_send(mavutil.mavlink.MAV_TYPE_GENERIC, mavutil.mavlink.MAV_AUTOPILOT_INVALID, 0, 0, 0)
+        mav.wait_heartbeat()
+        return cls(mav, target_system=mav.target_system, **kwargs)
+
+    def debug(self, s, level=1):
+        '''write some debug text'''
+        if self._debug >= level:
+            print(s)
+
+    def close(self):
+        self.mav.close()
+
+    def _send(self, packet):
+        self.mav.mav.file_transfer_protocol_send(0, self.target_system, self.target_component, packet.pack())
+
+    def _recv(self, timeout):
+        m = self.mav.recv_match(type='FILE_TRANSFER_PROTOCOL', blocking=True, timeout=timeout)
+        if m is None:
+            return None
+        if m.get_srcSystem() != self.target_system or m.get_srcComponent() != self.target_component:
+            return None
+        return FtpPacket.unpack(m.payload)
+
+    def request(self, opcode, session=0, offset=0, data=b'', size=None):
+        '''send a request and return the matching ACK/NAK packet, retrying on timeouts'''
+        if size is None:
+            size = len(data)
+        self.seq = (self.seq + 1) & 0xffff
+        packet = FtpPacket(seq=self.seq, session=session, opcode=opcode, size=size, offset=offset, data=data)
+        for attempt in range(self.retries):
+            self._send(packet)
+            deadline = timer() + self.timeout
+            while True:
+                remaining = deadline - timer()
+                if remaining <= 0:
+                    break
+                reply = self._recv(remaining)
+                if reply is None:
+                    continue
+                if reply.req_opcode != opcode or reply.seq != ((self.seq + 1) & 0xffff):
+                    self.debug(f"ignoring stale reply seq {reply.seq} op {reply.req_opcode}", 2)
+                    continue
+                self.seq = reply.seq
+                return reply
+            self.debug(f"timeout for opcode {opcode}, attempt {attempt + 1}", 1)
+        raise FtpError(f"No reply for opcode {opcode} after {self.retries} attempts")
+
+    def _check(self, reply, what):
+        if reply.opcode == OP_NAK:
+            raise FtpError(f"{what} failed (error {reply.error()})", reply.error())
+        return reply
+
+    def list_directory(self, path):
+        '''directory entries in mavsdk list_directory() format'''
+        entries = []
+        while True:
+            reply = self.request(OP_LIST_DIRECTORY, offset=len(entries), data=path.encode())
+            if reply.opcode == OP_NAK:
+                if reply.error() == ERR_EOF:
+                    break
+                raise FtpError(f"list_directory({path}) failed (error {reply.error()})", reply.error())
+            new_entries = parse_list_entries(reply.data)
+            if len(new_entries) == 0:
+                break
+            entries.extend(new_entries)
+        # PX4 reports skipped entries as "S", they still take up an offset
+        return [e for e in entries if e != 'S']
+
+    def calc_crc32(self, path):
+        '''CRC32 of a remote file, calculated by PX4'''
+        reply = self._check(self.request(OP_CALC_FILE_CRC32, data=path.encode()), f"crc32({path})")
+        return struct.unpack_from('<I', reply.data)[0]
+
+    def open_ro(self, path):
+        '''open a remote file for reading, returns (session, file size)'''
+        reply = self._check(self.request(OP_OPEN_FILE_RO, data=path.encode()), f"open({path})")
+        size = struct.unpack_from('<I', reply.data)[0] if reply.size >= 4 else None
+        return reply.session, size
+
+    def terminate(self, session):
+        try:
+            self.request(OP_TERMINATE_SESSION, session=session)
+        except FtpError:
+            pass
+
+    def reset_sessions(self):
+        self.request(OP_RESET_SESSIONS)
+
+    def read_file(self, path, fh, offset=0, progress=None, burst=True):
+        '''copy a remote file into fh (opened 'r+b' or 'wb') starting from offset, returns the file size'''
+        session, size = self.open_ro(path)
+        try:
+            if burst:
+                self._burst_read(session, fh, offset, size, progress)
+            else:
+                self._read(session, fh, offset, offset, size, progress)
+        finally:
+            self.terminate(session)
+        return size
+
+    def _read(self, session, fh, offset, end, size, progress):
+        # Plain reads from offset up to end (or EOF when end is None)
+        while end is None or offset < end:
+            reply = self.request(OP_READ_FILE, session=session, offset=offset, size=MAX_DATA_LEN)
+            if reply.opcode == OP_NAK:
+                if reply.error() == ERR_EOF:
+                    return offset
+                raise FtpError(f"read at {offset} failed (error {reply.error()})", reply.error())
+            if len(reply.data) == 0:
+                return offset
+            data = reply.data if end is None else reply.data[:end - offset]
+            fh.seek(offset)
+            fh.write(data)
+            offset += len(data)
+            if progress is not None:
+                progress(offset, size)
+            if end is None and size is not None and offset >= size:
+                return offset
+        return offset
+
+    def _burst_read(self, session, fh, offset, size, progress):
+        # PX4 streams ACKs until burst_complete is set. Lost packets are
+        # recorded as gaps and fetched with plain reads afterwards. If the
+        # transfer fails, the file is cut at the first gap so that its length
+        # always is a valid resume offset.
+        gaps = []
+        next_offset = offset
+        retries = 0
+        try:
+            self._send_burst(session, next_offset)
+            while size is None or next_offset < size:
+                reply = self._recv(self.timeout)
+                if reply is None:
+                    retries += 1
+                    if retries >= self.retries:
+                        raise FtpError(f"burst read stalled at offset {next_offset}")
+                    self._send_burst(session, next_offset)
+                    continue
+                if reply.session != session or reply.req_opcode != OP_BURST_READ_FILE:
+                    continue
+                if reply.opcode == OP_NAK:
+                    if reply.error() == ERR_EOF:
+                        break
+                    raise FtpError(f"burst read at {next_offset} failed (error {reply.error()})", reply.error())
+                retries = 0
+                self.seq = reply.seq
+                if reply.offset < next_offset:
+                    # late duplicate of something already requested again
+                    continue
+                if reply.offset > next_offset:
+                    self.debug(f"gap {next_offset}-{reply.offset}", 2)
+                    gaps.append((next_offset, reply.offset))
+                if len(reply.data) == 0:
+                    break
+                fh.seek(reply.offset)
+                fh.write(reply.data)
+                next_offset = reply.offset + len(reply.data)
+                if progress is not None:
+                    progress(next_offset, size)
+                if reply.burst_complete and (size is None or next_offset < size):
+                    self._send_burst(session, next_offset)
+            gaps = self._fill_gaps(session, fh, gaps)
+        except BaseException:
+            fh.truncate(gaps[0][0] if len(gaps) > 0 else next_offset)
+            raise
+
+    def _fill_gaps(self, session, fh, gaps, window=8):
+        # Read requests for the missing pieces, up to window in flight. Replies
+        # are matched by offset. Returns the gaps that are still missing,
+        # i.e. an empty list.
+        pieces = []
+        for start, end in gaps:
+            for offset in range(start, end, MAX_DATA_LEN):
+                pieces.append((offset, min(end, offset + MAX_DATA_LEN)))
+        missing = set(pieces)
+        # offset -> (piece, send time, attempts)
+        pending = {}
+        queue = list(pieces)
+        while missing:
+            now = timer()
+            for offset, (piece, sent, attempts) in list(pending.items()):
+                if now - sent > self.timeout:
+                    if attempts >= self.retries:
+                        raise FtpError(f"could not fill gap at {offset}")
+                    self._send_read(session, piece)
+                    pending[offset] = (piece, now, attempts + 1)
+            while queue and len(pending) < window:
+                piece = queue.pop(0)
+                self._send_read(session, piece)
+                pending[piece[0]] = (piece, now, 1)
+            reply = self._recv(min(self.timeout, 0.05))
+            if reply is None or reply.session != session or reply.req_opcode != OP_READ_FILE:
+                continue
+            entry = pending.pop(reply.offset, None)
+            if entry is None:
+                continue
+            piece = entry[0]
+            if reply.opcode == OP_NAK:
+                raise FtpError(f"read at {reply.offset} failed (error {reply.error()})", reply.error())
+            fh.seek(piece[0])
+            fh.write(reply.data[:piece[1] - piece[0]])
+            missing.discard(piece)
+        return []
+
+    def _send_read(self, session, piece):
+        self.seq = (self.seq + 1) & 0xffff
+        self._send(FtpPacket(seq=self.seq, session=session, opcode=OP_READ_FILE,
+                             size=piece[1] - piece[0], offset=piece[0]))
+
+    def _send_burst(self, session, offset):
+        self.seq = (self.seq + 1) & 0xffff
+        self._send(FtpPacket(seq=self.seq, session=session, opcode=OP_BURST_READ_FILE,
+                             size=MAX_DATA_LEN, offset=offset))
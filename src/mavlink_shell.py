@@ -13,10 +13,17 @@ Open a shell over MAVLink.
 from __future__ import print_function
 import sys, select
 import termios
+import json
+import collections
+import concurrent.futures
+import contextlib
 from timeit import default_timer as timer
 from argparse import ArgumentParser
 import os
 
+from mav_metrics import Metrics
+from mav_fleet import current_vehicle, VehicleOutput, parse_fleet_file, vehicle_dir_name
+
 try:
     from pymavlink import mavutil
 except ImportError as e:
@@ -38,18 +45,26 @@ except ImportError as e:
     sys.exit(1)
 
 
+def connect(portname, baudrate, timeout=None):
+    '''mavutil connection to portname, once the vehicle has sent a heartbeat'''
+    mav = mavutil.mavlink_connection(portname, autoreconnect=True, baud=baudrate)
+    mav.mav.heartbeat_send(mavutil.mavlink.MAV_TYPE_GENERIC, mavutil.mavlink.MAV_AUTOPILOT_INVALID, 0, 0, 0)
+    if mav.wait_heartbeat(timeout=timeout) is None:
+        mav.close()
+        raise TimeoutError("no heartbeat from %s within %.0f s" % (portname, timeout))
+    return mav
+
+
 class MavlinkSerialPort():
     '''an object that looks like a serial port, but
     transmits using mavlink SERIAL_CONTROL packets'''
-    def __init__(self, portname, baudrate, devnum=0, debug=0):
+    def __init__(self, portname, baudrate, devnum=0, debug=0, timeout=None):
         self.baudrate = 0
         self._debug = debug
-        self.buf = ''
+        self.buf = bytearray()
         self.port = devnum
         self.debug("Connecting with MAVLink to %s ..." % portname)
-        self.mav = mavutil.mavlink_connection(portname, autoreconnect=True, baud=baudrate)
-        self.mav.mav.heartbeat_send(mavutil.mavlink.MAV_TYPE_GENERIC, mavutil.mavlink.MAV_AUTOPILOT_INVALID, 0, 0, 0)
-        self.mav.wait_heartbeat()
+        self.mav = connect(portname, baudrate, timeout)
         self.debug("HEARTBEAT OK\n")
         self.debug("Locked serial device\n")
 
@@ -59,51 +74,297 @@ class MavlinkSerialPort():
             print(s)
 
     def write(self, b):
-        '''write some bytes'''
-        self.debug("sending '%s' (0x%02x) of len %u\n" % (b, ord(b[0]), len(b)), 2)
-        while len(b) > 0:
-            n = len(b)
-            if n > 70:
-                n = 70
-            buf = [ord(x) for x in b[:n]]
-            buf.extend([0]*(70-len(buf)))
+        '''write some bytes (or a str), in SERIAL_CONTROL frames of 70 bytes'''
+        if isinstance(b, str):
+            b = b.encode('utf8')
+        self.debug("sending %r of len %u\n" % (b[:20], len(b)), 2)
+        for offset in range(0, len(b), 70):
+            chunk = b[offset:offset + 70]
             self.mav.mav.serial_control_send(self.port,
                                              mavutil.mavlink.SERIAL_CONTROL_FLAG_EXCLUSIVE |
                                              mavutil.mavlink.SERIAL_CONTROL_FLAG_RESPOND,
                                              0,
                                              0,
-                                             n,
-                                             buf)
-            b = b[n:]
+                                             len(chunk),
+                                             chunk.ljust(70, b'\0'))
 
     def close(self):
         self.mav.mav.serial_control_send(self.port, 0, 0, 0, 0, [0]*70)
 
+    def fileno(self):
+        '''file descriptor of the MAVLink connection, readable when data arrives'''
+        return self.mav.fd
+
     def _recv(self):
-        '''read some bytes into self.buf'''
-        m = self.mav.recv_match(condition='SERIAL_CONTROL.count!=0',
-                                type='SERIAL_CONTROL', blocking=True,
-                                timeout=0.03)
-        if m is not None:
+        '''move all pending SERIAL_CONTROL data into self.buf, without blocking'''
+        # Drained until recv_match returns None, which also empties the
+        # parser buffer, so select() on fileno() is reliable afterwards
+        while True:
+            m = self.mav.recv_match(condition='SERIAL_CONTROL.count!=0',
+                                    type='SERIAL_CONTROL', blocking=False)
+            if m is None:
+                break
             if self._debug > 2:
                 print(m)
-            data = m.data[:m.count]
-            self.buf += ''.join(str(chr(x)) for x in data)
+            self.buf.extend(m.data[:m.count])
 
     def read(self, n):
-        '''read some bytes'''
+        '''read up to n bytes, b'' if nothing has arrived'''
         if len(self.buf) == 0:
             self._recv()
-        if len(self.buf) > 0:
-            if n > len(self.buf):
-                n = len(self.buf)
-            ret = self.buf[:n]
-            self.buf = self.buf[n:]
-            if self._debug >= 2:
-                for b in ret:
-                    self.debug("read 0x%x" % ord(b), 2)
-            return ret
-        return ''
+        ret = bytes(self.buf[:n])
+        del self.buf[:n]
+        if self._debug >= 2:
+            for b in ret:
+                self.debug("read 0x%x" % b, 2)
+        return ret
+
+    def read_all(self):
+        '''read everything that has arrived'''
+        self._recv()
+        return self.read(len(self.buf))
+
+
+class ResponseTimer():
+    '''times the reply to each command line: the delay until its echo
+    arrives and the output throughput until the shell goes quiet'''
+    idle = 0.5
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.sent_time = None
+        self.first_time = None
+        self.last_time = None
+        self.nbytes = 0
+
+    def pending(self):
+        return self.sent_time is not None
+
+    def sent(self, now):
+        self.finish()
+        self.sent_time = now
+
+    def received(self, nbytes, now):
+        if self.sent_time is None:
+            return
+        if self.first_time is None:
+            self.first_time = now
+            self.metrics.record("shell.echo", now - self.sent_time)
+        self.last_time = now
+        self.nbytes += nbytes
+
+    def poll(self, now):
+        if self.last_time is not None and now - self.last_time > self.idle:
+            self.finish()
+
+    def finish(self):
+        if self.nbytes:
+            self.metrics.record("shell.output", self.last_time - self.sent_time, self.nbytes)
+        self.sent_time = None
+        self.first_time = None
+        self.last_time = None
+        self.nbytes = 0
+
+
+PROMPT = b'nsh> '
+
+
+def command_output(command, data):
+    '''output of a command without its echo and the final prompt'''
+    text = data.decode('utf8', 'replace').replace('\r\n', '\n')
+    if text.endswith(PROMPT.decode()):
+        text = text[:-len(PROMPT)]
+    first, sep, rest = text.partition('\n')
+    if first.strip() == command.strip():
+        text = rest
+    return text
+
+
+class BatchShell():
+    '''runs commands one after the other without a terminal: a command has
+    finished when nsh prints its prompt, the next one is sent right away'''
+
+    def __init__(self, port, metrics, timeout=10):
+        self.port = port
+        self.metrics = metrics
+        self.timeout = timeout
+        self.next_heartbeat_time = timer()
+
+    def heartbeat(self):
+        now = timer()
+        if now >= self.next_heartbeat_time:
+            self.port.mav.mav.heartbeat_send(mavutil.mavlink.MAV_TYPE_GENERIC, mavutil.mavlink.MAV_AUTOPILOT_INVALID, 0, 0, 0)
+            self.next_heartbeat_time = now + 1
+
+    def read_until_prompt(self):
+        '''(received bytes, True if they end with the prompt)'''
+        data = bytearray()
+        deadline = timer() + self.timeout
+        while True:
+            data += self.port.read_all()
+            # nsh prints the prompt when it waits for the next command
+            if data.endswith(PROMPT):
+                return bytes(data), True
+            if timer() >= deadline:
+                return bytes(data), False
+            self.heartbeat()
+            select.select([self.port], [], [], max(0, min(deadline, self.next_heartbeat_time) - timer()))
+
+    def send_file(self, path, window=512):
+        '''paste the bytes of a file into the shell, then wait for the prompt
+        after the last line. PX4 does not acknowledge shell input, but nsh
+        echoes what it reads: at most window bytes are sent ahead of the echo,
+        so the input pipe of the shell never overflows.'''
+        with open(path, 'rb') as fh:
+            data = fh.read()
+        start = timer()
+        sent = 0
+        # sent, not yet echoed
+        unechoed = collections.deque()
+        output = bytearray()
+        deadline = start + self.timeout
+        while sent < len(data) or unechoed:
+            if sent < len(data) and len(unechoed) < window:
+                chunk = data[sent:sent + window - len(unechoed)]
+                self.port.write(chunk)
+                unechoed.extend(chunk)
+                sent += len(chunk)
+            received = self.port.read_all()
+            output += received
+            for b in received:
+                # Control characters other than newline may not be echoed
+                while unechoed and unechoed[0] != b and (unechoed[0] < 0x20 and unechoed[0] != 0x0a):
+                    unechoed.popleft()
+                if unechoed and unechoed[0] == b:
+                    unechoed.popleft()
+                    # Waiting is fine as long as nsh keeps reading
+                    deadline = timer() + self.timeout
+            if timer() >= deadline:
+                break
+            self.heartbeat()
+            if not received and (sent == len(data) or len(unechoed) >= window):
+                select.select([self.port], [], [], max(0, min(deadline, self.next_heartbeat_time) - timer()))
+        duration = timer() - start
+        nbytes = sent - len(unechoed)
+        self.metrics.record("shell.send", duration, nbytes, target=path, ok=not unechoed)
+        print("Sent %u bytes in %.2f s (%.0f bytes/s)" % (nbytes, duration, nbytes / duration if duration > 0 else 0),
+              file=sys.stderr)
+        if unechoed:
+            print("Error: nsh stopped reading after %u of %u bytes" % (nbytes, len(data)), file=sys.stderr)
+            ok = False
+        elif output.endswith(PROMPT):
+            ok = True
+        else:
+            rest, ok = self.read_until_prompt()
+            output += rest
+        return {"command": "--send-file " + path, "output": command_output("", bytes(output)),
+                "seconds": round(timer() - start, 4), "timed_out": not ok,
+                "bytes": nbytes, "bytes_per_s": round(nbytes / duration, 1) if duration > 0 else None}
+
+    def run(self, commands, send_file=None, window=512):
+        '''list of results, one per command run'''
+        # An empty line gets a fresh prompt, anything printed before is dropped
+        self.port.write('\n')
+        _, ok = self.read_until_prompt()
+        if not ok:
+            print("Error: no nsh prompt within %.1f s" % self.timeout, file=sys.stderr)
+            return None
+        results = []
+        for command in commands:
+            start = timer()
+            self.port.write(command + '\n')
+            data, ok = self.read_until_prompt()
+            duration = timer() - start
+            self.metrics.record("shell.command", duration, len(data), target=command, ok=ok)
+            results.append({"command": command, "output": command_output(command, data),
+                            "seconds": round(duration, 4), "timed_out": not ok})
+            if not ok:
+                # The shell is still busy, later commands would get mixed in
+                print("Error: '%s' did not finish within %.1f s" % (command, self.timeout), file=sys.stderr)
+                return results
+        if send_file is not None:
+            results.append(self.send_file(send_file, window))
+        return results
+
+
+def read_script(path):
+    '''commands of a script file (- for stdin), blank and # lines skipped'''
+    fh = sys.stdin if path == '-' else open(path, 'r')
+    try:
+        lines = [line.strip() for line in fh]
+    finally:
+        if fh is not sys.stdin:
+            fh.close()
+    return [line for line in lines if line and not line.startswith('#')]
+
+
+def shell_vehicle(address, name, commands, args, metrics):
+    '''run the batch on one vehicle of the fleet, in a thread of its own'''
+    current_vehicle.set(name)
+    start = timer()
+    results = None
+    try:
+        port = MavlinkSerialPort(address, args.baudrate, devnum=10, timeout=args.connect_timeout)
+        try:
+            results = BatchShell(port, metrics, args.timeout).run(commands, args.send_file, args.window)
+        finally:
+            port.close()
+            port.mav.close()
+        if results is None:
+            status = "no nsh prompt"
+        elif any(r["timed_out"] for r in results):
+            status = "timed out"
+        else:
+            status = "ok"
+    except TimeoutError as e:
+        status = "not connected: %s" % e
+    except Exception as e:
+        status = "ERROR: %s" % e
+    if results is not None and not args.json:
+        # One write per vehicle keeps its output together
+        sys.stdout.write(''.join(PROMPT.decode() + r["command"] + '\n' + r["output"] +
+                                 ('\n' if r["output"] and not r["output"].endswith('\n') else '') for r in results))
+    return {"name": name, "address": address, "status": status,
+            "seconds": round(timer() - start, 4), "results": results or []}
+
+
+def run_fleet(args, commands, metrics):
+    '''run the same commands on every vehicle at once, True if all succeeded'''
+    vehicles = [(address, None) for address in args.fleet or []]
+    if args.fleet_file:
+        try:
+            vehicles += parse_fleet_file(args.fleet_file)
+        except OSError as e:
+            print("Error: %s" % e, file=sys.stderr)
+            return False
+    if not vehicles:
+        print("Error: no vehicles in the fleet", file=sys.stderr)
+        return False
+    vehicles = [(address, name if name else vehicle_dir_name(address)) for address, name in vehicles]
+    print("Running %u commands on %u vehicles" % (len(commands) + (args.send_file is not None), len(vehicles)),
+          file=sys.stderr)
+    start = timer()
+    # pymavlink blocks, so every vehicle gets a thread; each BatchShell
+    # keeps the heartbeat of its link going while it waits
+    with contextlib.redirect_stdout(VehicleOutput(sys.stdout)), \
+            contextlib.redirect_stderr(VehicleOutput(sys.stderr)), \
+            concurrent.futures.ThreadPoolExecutor(len(vehicles)) as pool:
+        futures = [pool.submit(shell_vehicle, address, name, commands, args, metrics) for address, name in vehicles]
+        vehicle_results = [future.result() for future in futures]
+    elapsed = timer() - start
+
+    if args.json:
+        json.dump(vehicle_results, sys.stdout, indent=2)
+        print()
+    out = sys.stderr if args.json else sys.stdout
+    print("", file=out)
+    print("vehicle".ljust(24) + "commands".rjust(9) + "time s".rjust(9) + "  status", file=out)
+    for result in vehicle_results:
+        print(result["name"].ljust(24) + str(len(result["results"])).rjust(9) + ("%9.2f" % result["seconds"]) +
+              "  " + result["status"], file=out)
+    print("Fleet done in %.2f s (vehicles took %.2f s in total)" %
+          (elapsed, sum(r["seconds"] for r in vehicle_results)), file=out)
+    return all(r["status"] == "ok" for r in vehicle_results)
 
 
 def main():
@@ -113,7 +374,31 @@ def main():
 /dev/ttyUSB0 or 0.0.0.0:14550. Auto-detect serial if not given.')
     parser.add_argument("--baudrate", "-b", dest="baudrate", type=int,
                       help="Mavlink port baud rate (default=57600)", default=57600)
+    parser.add_argument('--cmd', '-c', dest="commands", action="append", metavar='COMMAND',
+                      help='Run COMMAND and exit instead of opening an interactive shell, can be repeated')
+    parser.add_argument('--script', '-s', action="store", metavar='FILE',
+                      help='Run the commands in FILE (one per line, - for stdin) and exit')
+    parser.add_argument('--send-file', action="store", metavar='FILE',
+                      help='Paste the contents of FILE into the shell (after --cmd/--script) and exit')
+    parser.add_argument('--window', action="store", type=int, metavar='BYTES',
+                      help='Bytes of --send-file sent ahead of the echo of nsh (default 512)', default=512)
+    parser.add_argument('--fleet', action="store", nargs='+', metavar='ADDRESS',
+                      help='Run --cmd/--script/--send-file on all these vehicles at once')
+    parser.add_argument('--fleet-file', action="store", metavar='FILE',
+                      help='Fleet vehicles from FILE, one "ADDRESS [NAME]" per line')
+    parser.add_argument('--connect-timeout', action="store", type=float, metavar='SECONDS',
+                      help='How long a fleet vehicle may take to send a heartbeat (default 10)', default=10)
+    parser.add_argument('--timeout', action="store", type=float, metavar='SECONDS',
+                      help='How long a command may take, or --send-file may wait for the echo (default 10)', default=10)
+    parser.add_argument('--json', action="store_true",
+                      help='Print the results of --cmd/--script as JSON, with timings')
+    parser.add_argument('--profile', action="store_true",
+                      help='Print the echo latency and output throughput of the commands at exit')
+    parser.add_argument('--metrics-file', action="store", metavar='FILE',
+                      help='Append a JSON line per command response to FILE')
     args = parser.parse_args()
+    metrics = Metrics("mavlink_shell", args.metrics_file)
+    response_timer = ResponseTimer(metrics)
 
 
     if args.port == None:
@@ -135,9 +420,39 @@ def main():
             args.port = serial_list[0].device
 
 
-    print("Connecting to MAVLINK...")
+    commands = list(args.commands or [])
+    if args.script:
+        commands += read_script(args.script)
+    batch = args.commands is not None or args.script is not None or args.send_file is not None
+    if args.fleet or args.fleet_file:
+        if not batch:
+            parser.error("--fleet needs --cmd, --script or --send-file")
+        ok = run_fleet(args, commands, metrics)
+        if args.profile:
+            metrics.print_profile(file=sys.stderr)
+        metrics.close()
+        sys.exit(0 if ok else 1)
+
+    print("Connecting to MAVLINK...", file=sys.stderr if batch else sys.stdout)
     mav_serialport = MavlinkSerialPort(args.port, args.baudrate, devnum=10)
 
+    if batch:
+        results = BatchShell(mav_serialport, metrics, args.timeout).run(commands, args.send_file, args.window)
+        mav_serialport.close()
+        if results is not None:
+            if args.json:
+                json.dump(results, sys.stdout, indent=2)
+                print()
+            else:
+                for result in results:
+                    sys.stdout.write(PROMPT.decode() + result["command"] + '\n' + result["output"])
+        if args.profile:
+            metrics.print_profile(file=sys.stderr)
+        metrics.close()
+        if results is None or any(r["timed_out"] for r in results):
+            sys.exit(1)
+        return
+
     mav_serialport.write('\n') # make sure the shell is started
 
     # disable echo & avoid buffering on stdin
@@ -167,8 +482,17 @@ def main():
         next_heartbeat_time = timer()
 
         quit_time = None
+        # One wait for keystrokes and MAVLink data, no polling
+        inputs = [ubuf_stdin, mav_serialport]
         while quit_time is None or quit_time > timer():
-            while True:
+            timeout = next_heartbeat_time - timer()
+            if quit_time is not None:
+                timeout = min(timeout, quit_time - timer())
+            if response_timer.pending():
+                timeout = min(timeout, response_timer.idle)
+            ready, _, _ = select.select(inputs, [], [], max(0, timeout))
+
+            while ubuf_stdin in ready:
                 i, o, e = select.select([ubuf_stdin], [], [], 0)
                 if not i: break
                 ch = ubuf_stdin.read(1).decode('utf8')
@@ -178,6 +502,8 @@ def main():
                         # run a bit longer to read the response (we could also
                         # read until we get a prompt)
                         quit_time = timer() + 1
+                    # stdin stays readable at EOF
+                    inputs.remove(ubuf_stdin)
                     break
 
                 # provide a simple shell with command history
@@ -193,6 +519,7 @@ def main():
                                 del command_history[0]
                         cur_history_index = len(command_history)
                     mav_serialport.write(cur_line+'\n')
+                    response_timer.sent(timer())
                     cur_line = ''
                 elif ord(ch) == 127: # backslash
                     if len(cur_line) > 0:
@@ -222,10 +549,12 @@ def main():
                     sys.stdout.write(ch)
                 sys.stdout.flush()
 
-            data = mav_serialport.read(4096)
-            if data and len(data) > 0:
-                sys.stdout.write(data)
-                sys.stdout.flush()
+            data = mav_serialport.read_all()
+            if data:
+                response_timer.received(len(data), timer())
+                sys.stdout.buffer.write(data)
+                sys.stdout.buffer.flush()
+            response_timer.poll(timer())
 
             # handle heartbeat sending
             heartbeat_time = timer()
@@ -242,6 +571,10 @@ def main():
     finally:
         if old_attr:
             termios.tcsetattr(fd_in, termios.TCSADRAIN, old_attr)
+        response_timer.finish()
+        if args.profile:
+            metrics.print_profile()
+        metrics.close()
 
 
 if __name__ == '__main__':
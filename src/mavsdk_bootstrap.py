@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+"""
+Offline mavsdk bootstrap for the fog-tools container.
+
+The arm64 image is built under qemu where installing mavsdk is slow, so the
+image only carries the wheels (FOG_TOOLS_WHEELHOUSE, see Dockerfile).
+require_mavsdk() installs them on first use, without network access. The
+attempt is made once per container: a marker file serializes concurrent
+tools and remembers a failed install so later runs fail fast.
+"""
+
+import fcntl
+import importlib
+import importlib.util
+import os
+import site
+import subprocess
+import sys
+import tempfile
+
+MAVSDK_REQUIREMENT = "mavsdk==2.1.0"
+DEFAULT_WHEELHOUSE = "/opt/fog-tools/wheels"
+MARKER_FILE = os.path.join(tempfile.gettempdir(), "fog-tools-mavsdk-bootstrap")
+
+
+def mavsdk_available():
+    return importlib.util.find_spec('mavsdk') is not None
+
+
+def install_from_wheelhouse(wheelhouse):
+    cmd = [sys.executable, '-m', 'pip', 'install', '--no-index', '--find-links', wheelhouse, MAVSDK_REQUIREMENT]
+    print(f"Installing {MAVSDK_REQUIREMENT} from {wheelhouse} (once per container)...", file=sys.stderr)
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        return result.stderr.decode('utf-8', 'replace').strip().splitlines()[-1:]
+    # The package may have gone into a site directory that did not exist at
+    # interpreter startup
+    user_site = site.getusersitepackages()
+    if os.path.isdir(user_site) and user_site not in sys.path:
+        site.addsitedir(user_site)
+    importlib.invalidate_caches()
+    return None
+
+
+def require_mavsdk():
+    '''make mavsdk importable or exit with instructions'''
+    if mavsdk_available():
+        return
+    wheelhouse = os.environ.get("FOG_TOOLS_WHEELHOUSE", DEFAULT_WHEELHOUSE)
+    with open(MARKER_FILE, 'a+') as marker:
+        # Another tool may be installing right now, wait for it
+        fcntl.flock(marker, fcntl.LOCK_EX)
+        importlib.invalidate_caches()
+        if mavsdk_available():
+            return
+        marker.seek(0)
+        previous = marker.read().strip()
+        if previous:
+            error = [previous]
+        elif not os.path.isdir(wheelhouse):
+            error = [f"wheelhouse {wheelhouse} not found"]
+        else:
+            error = install_from_wheelhouse(wheelhouse)
+            if error is not None:
+                marker.write("\n".join(error) or "pip install failed")
+                marker.flush()
+    if error is not None:
+        print(f"Failed to install {MAVSDK_REQUIREMENT}: {' '.join(error)}")
+        print("You may need to install it with:")
+        print(f"    pip3 install --user {MAVSDK_REQUIREMENT}")
+        if previous:
+            print(f"(remove {MARKER_FILE} to retry the offline install)")
+        print("")
+        sys.exit(1)
@@ -0,0 +1,841 @@
+#!/usr/bin/env python3
+
+"""
+Simulated PX4 MAVLink endpoint
+==============================
+Serves a fake /fs/microsd tree over MAVLink FTP on UDP so that the tools in
+this repo can be exercised and benchmarked without a drone. The endpoint
+sends heartbeats as a PX4 autopilot (system 1, component 1) to the given
+UDP address, the same way PX4 does to a ground station.
+
+It also runs a stand-in for nsh on SERIAL_CONTROL device 10
+(mavlink_shell.py): input is echoed, `output SIZE` prints SIZE bytes and
+`sleep SECONDS` holds the prompt, besides ver, ls, cat, param show, ...
+
+Link behaviour can be shaped with --latency, --loss and --bandwidth.
+
+Example:
+    px4_sim.py --port 15761 --days 3 --logs-per-day 4 --log-size 2M &
+    download_px4_logfile.py --latest
+"""
+
+import argparse
+import heapq
+import math
+import os
+import random
+import select
+import shutil
+import struct
+import sys
+import tempfile
+from timeit import default_timer as timer
+
+# PX4 talks MAVLink 2, mavutil picks the protocol version at import
+os.environ.setdefault('MAVLINK20', '1')
+
+try:
+    from pymavlink import mavutil
+except ImportError as e:
+    print("Failed to import pymavlink: " + str(e))
+    print("")
+    print("You may need to install it with:")
+    print("    pip3 install --user pymavlink")
+    print("")
+    sys.exit(1)
+
+from fog_args import parse_size
+from mavlink_ftp import (FtpPacket, MAX_DATA_LEN, px4_crc32,
+                         OP_TERMINATE_SESSION, OP_RESET_SESSIONS, OP_LIST_DIRECTORY, OP_OPEN_FILE_RO,
+                         OP_READ_FILE, OP_CREATE_FILE, OP_WRITE_FILE, OP_REMOVE_FILE, OP_CREATE_DIRECTORY,
+                         OP_REMOVE_DIRECTORY, OP_OPEN_FILE_WO, OP_TRUNCATE_FILE, OP_RENAME,
+                         OP_CALC_FILE_CRC32, OP_BURST_READ_FILE, OP_ACK, OP_NAK,
+                         ERR_FAIL, ERR_INVALID_SESSION, ERR_NO_SESSIONS_AVAILABLE, ERR_EOF,
+                         ERR_UNKNOWN_COMMAND, ERR_FILE_EXISTS, ERR_FILE_NOT_FOUND)
+
+MAX_SESSIONS = 3
+
+DEFAULT_CONFIG = b"""# [ env: outdoor ]
+param set MPC_XY_VEL_MAX 5.0
+param set COM_RC_IN_MODE 1
+"""
+
+# Parameters of DEFAULT_CONFIG and the ones the tools touch, the rest of
+# the parameter set is generated (PX4 has about a thousand)
+DEFAULT_PARAMS = [
+    ("SYS_HITL", "int", 0),
+    ("COM_RC_IN_MODE", "int", 0),
+    ("MPC_XY_VEL_MAX", "float", 12.0),
+    ("MPC_Z_VEL_MAX_UP", "float", 3.0),
+    ("MIS_TAKEOFF_ALT", "float", 2.5),
+    ("EKF2_HGT_REF", "int", 1),
+]
+
+
+def create_params(count):
+    '''[name, "int" | "float", value] of count parameters'''
+    params = [list(p) for p in DEFAULT_PARAMS[:count]]
+    for n in range(count - len(params)):
+        params.append([f"SIM_P{n:04d}", "int", n] if n % 2 else [f"SIM_P{n:04d}", "float", n / 10.0])
+    return params
+
+
+def create_fake_sdcard(root, days=3, logs_per_day=3, log_size=1024 * 1024, encrypted=False, seed=0):
+    '''populate root with fs/microsd/{log/<date>/<time>.ulg,etc/config.txt}'''
+    rnd = random.Random(seed)
+    log_dir = os.path.join(root, "fs", "microsd", "log")
+    os.makedirs(log_dir, exist_ok=True)
+    os.makedirs(os.path.join(root, "fs", "microsd", "etc"), exist_ok=True)
+    with open(os.path.join(root, "fs", "microsd", "etc", "config.txt"), 'wb') as fh:
+        fh.write(DEFAULT_CONFIG)
+    # Compressible content (repeating records with a counter) like real logs
+    record = bytes(rnd.getrandbits(8) for _ in range(56))
+    for day in range(days):
+        date = f"2024-05-{day + 1:02d}"
+        os.makedirs(os.path.join(log_dir, date), exist_ok=True)
+        for n in range(logs_per_day):
+            name = f"{10 + n:02d}_{rnd.randrange(60):02d}_{rnd.randrange(60):02d}"
+            ext = "ulgc" if encrypted else "ulg"
+            with open(os.path.join(log_dir, date, name + "." + ext), 'wb') as fh:
+                written = 0
+                counter = 0
+                while written < log_size:
+                    chunk = (struct.pack('<Q', counter) + record) * 1024
+                    chunk = chunk[:log_size - written]
+                    fh.write(chunk)
+                    written += len(chunk)
+                    counter += 1
+            if encrypted:
+                with open(os.path.join(log_dir, date, name + ".ulgk"), 'wb') as fh:
+                    fh.write(bytes(rnd.getrandbits(8) for _ in range(272)))
+
+
+class SimFtpSession:
+    '''an open file of the FTP server'''
+    __slots__ = ('fh', 'path', 'writable', 'stream_offset', 'streaming', 'stream_seq')
+
+    def __init__(self, fh, path, writable):
+        self.fh = fh
+        self.path = path
+        self.writable = writable
+        self.stream_offset = 0
+        self.streaming = False
+        self.stream_seq = 0
+
+
+class NshShell:
+    '''nsh behind SERIAL_CONTROL device 10: echoes what it reads from its
+    input pipe, runs a few commands and prints the prompt'''
+    # Input pipe of the PX4 MAVLink shell, what doesn't fit is dropped
+    pipe_size = 1024
+    prompt = b'nsh> '
+
+    def __init__(self, sim, read_rate=0, delay=0.0):
+        self.sim = sim
+        # bytes/s nsh reads from the pipe, 0 = as fast as it arrives
+        self.read_rate = read_rate
+        # Seconds every command takes before its output appears
+        self.delay = delay
+        self.pipe = bytearray()
+        self.line = bytearray()
+        self.output = bytearray()
+        self.read_credit = 0.0
+        self.last_read = timer()
+        # (finish time, output) of the command running, nsh reads no input meanwhile
+        self.running = None
+        self.busy = 0.0
+        self.commands = {
+            'cat': self.cat,
+            'echo': self.echo,
+            'free': self.free,
+            'help': self.help,
+            'ls': self.ls,
+            'output': self.bulk_output,
+            'param': self.param,
+            'sleep': self.sleep,
+            'ver': self.ver,
+        }
+
+    def input(self, data):
+        room = self.pipe_size - len(self.pipe)
+        self.pipe += data[:room]
+        self.sim.stats["shell_in"] += len(data)
+        self.sim.stats["shell_dropped"] += max(0, len(data) - room)
+
+    def wake_time(self):
+        '''when step() has something to do, None if idle'''
+        if self.running is not None:
+            return self.running[0]
+        if self.pipe:
+            return self.last_read + (1 / self.read_rate if self.read_rate > 0 else 0)
+        return None
+
+    def step(self, now):
+        if self.running is not None:
+            if now < self.running[0]:
+                return
+            self.output += self.running[1] + self.prompt
+            self.running = None
+        count = len(self.pipe)
+        if self.read_rate > 0:
+            self.read_credit = min(self.read_credit + (now - self.last_read) * self.read_rate, self.pipe_size)
+            count = min(count, int(self.read_credit))
+        self.last_read = now
+        n = 0
+        while n < count and self.running is None:
+            c = self.pipe[n]
+            n += 1
+            if c == 0x0a:
+                self.output += b'\n'
+                self.run(self.line.decode('utf-8', 'replace'), now)
+                self.line = bytearray()
+            elif c in (0x08, 0x7f):
+                if self.line:
+                    self.line.pop()
+                    self.output += b'\b \b'
+            elif c >= 0x20:
+                self.line.append(c)
+                self.output.append(c)
+        del self.pipe[:n]
+        if self.read_rate > 0:
+            self.read_credit -= n
+
+    def run(self, line, now):
+        args = line.split()
+        self.busy = 0.0
+        if not args:
+            output = b''
+        elif args[0] in self.commands:
+            output = self.commands[args[0]](args[1:])
+        else:
+            output = f"nsh: {args[0]}: command not found\n".encode()
+        self.sim.debug(f"nsh: {line}")
+        self.running = (now + self.delay + self.busy, output)
+
+    # --- commands ---------------------------------------------------------
+
+    def help(self, args):
+        return ("Builtin Apps:\n" + "".join(f"  {name}\n" for name in sorted(self.commands))).encode()
+
+    def echo(self, args):
+        return (" ".join(args) + "\n").encode()
+
+    def ver(self, args):
+        return (f"HW arch: PX4_SIM\nHW UID: {self.sim.uid:024X}\nFW git tag: v1.14.0\n"
+                "OS: NuttX\nOS version: Release 11.0.0\n").encode()
+
+    def free(self, args):
+        return (b"                   total       used       free    largest\n"
+                b"Umem:             376832     180736     196096     183904\n")
+
+    def ls(self, args):
+        path = args[0] if args else '/'
+        local = self.sim.local_path(path)
+        if local is None or not os.path.exists(local):
+            return f"nsh: ls: stat failed: {path}\n".encode()
+        if not os.path.isdir(local):
+            return f" {path}\n".encode()
+        entries = [name + '/' if os.path.isdir(os.path.join(local, name)) else name for name in sorted(os.listdir(local))]
+        return (f"{path}:\n" + "".join(f" {name}\n" for name in entries)).encode()
+
+    def cat(self, args):
+        if not args:
+            return b"nsh: cat: missing required argument(s)\n"
+        local = self.sim.local_path(args[0])
+        if local is None or not os.path.isfile(local):
+            return f"nsh: cat: open failed: {args[0]}\n".encode()
+        with open(local, 'rb') as fh:
+            return fh.read()
+
+    def param(self, args):
+        if not args or args[0] != "show":
+            return b"usage: param show [NAME*]\n"
+        pattern = args[1] if len(args) > 1 else '*'
+        lines = ["Symbols: x = used, + = saved, * = unsaved\n"]
+        for index, (name, kind, value) in enumerate(self.sim.params):
+            if name == pattern or (pattern.endswith('*') and name.startswith(pattern[:-1])):
+                lines.append(f"x   {name} [{index},{index}] : {value if kind == 'int' else f'{value:.4f}'}\n")
+        lines.append(f"\n {len(self.sim.params)}/{len(self.sim.params)} parameters used.\n")
+        return "".join(lines).encode()
+
+    def bulk_output(self, args):
+        # Not in PX4: SIZE bytes of text, to measure the shell throughput
+        try:
+            size = parse_size(args[0])
+        except (IndexError, ValueError):
+            return b"usage: output SIZE\n"
+        text = bytearray()
+        row = 0
+        while len(text) < size:
+            text += f"{row:08d} 0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRS\n".encode()
+            row += 1
+        return bytes(text[:size])
+
+    def sleep(self, args):
+        try:
+            self.busy = float(args[0])
+        except (IndexError, ValueError):
+            return b"usage: sleep SECONDS\n"
+        return b''
+
+
+class SimulatedPx4:
+
+    def __init__(self, root, address, latency=0.0, loss=0.0, bandwidth=0, debug=0, uid=1, reboot_time=5.0,
+                 param_count=len(DEFAULT_PARAMS), shell_read_rate=0, shell_delay=0.0, telemetry_rate=0.0):
+        self.root = os.path.realpath(root)
+        # Silence after a reboot command, longer than the heartbeat timeout
+        # of the ground station so that it sees the link go down
+        self.reboot_time = reboot_time
+        self.rebooting_until = 0.0
+        # Hardware UID reported in AUTOPILOT_VERSION
+        self.uid = uid
+        self.latency = latency
+        self.loss = loss
+        # bytes/s, 0 = unlimited
+        self.bandwidth = bandwidth
+        self._debug = debug
+        self.mav = mavutil.mavlink_connection(address, source_system=1, source_component=1)
+        self.sessions = {}
+        self.last_request = None
+        self.last_reply = None
+        # (send time, order, packed message)
+        self.outgoing = []
+        self.order = 0
+        self.link_free_time = 0.0
+        self.handlers = {
+            'FILE_TRANSFER_PROTOCOL': self.handle_ftp,
+            'COMMAND_LONG': self.handle_command,
+            'PARAM_REQUEST_LIST': self.handle_param_list,
+            'PARAM_REQUEST_READ': self.handle_param_read,
+            'PARAM_SET': self.handle_param_set,
+            'SERIAL_CONTROL': self.handle_serial_control,
+            'TIMESYNC': self.handle_timesync,
+            'PING': self.handle_ping,
+        }
+        self.params = create_params(param_count)
+        self.param_index = {p[0]: i for i, p in enumerate(self.params)}
+        self.message_senders = {
+            mavutil.mavlink.MAVLINK_MSG_ID_AUTOPILOT_VERSION: self.send_autopilot_version,
+            mavutil.mavlink.MAVLINK_MSG_ID_FLIGHT_INFORMATION: self.send_flight_information,
+        }
+        # Hz of the ATTITUDE stream, 0 = heartbeats only
+        self.telemetry_rate = telemetry_rate
+        self.shell_read_rate = shell_read_rate
+        self.shell_delay = shell_delay
+        self.shell = NshShell(self, shell_read_rate, shell_delay)
+        self.start_time = timer()
+        self.stats = {"requests": 0, "replies": 0, "dropped_in": 0, "dropped_out": 0,
+                      "shell_in": 0, "shell_dropped": 0, "shell_out": 0}
+
+    def debug(self, s, level=1):
+        '''write some debug text'''
+        if self._debug >= level:
+            print(s)
+
+    # --- link model -------------------------------------------------------
+
+    def send(self, msg):
+        '''queue a message, it leaves after latency and serialization delay'''
+        # Numbered first, so a lost message leaves a gap in the sequence
+        # numbers (MAVLink.send() counts, pack() doesn't)
+        buf = msg.pack(self.mav.mav)
+        self.mav.mav.seq = (self.mav.mav.seq + 1) % 256
+        if self.loss > 0 and random.random() < self.loss:
+            self.stats["dropped_out"] += 1
+            return
+        now = timer()
+        send_time = max(now, self.link_free_time)
+        if self.bandwidth > 0:
+            send_time += len(buf) / self.bandwidth
+        self.link_free_time = send_time
+        heapq.heappush(self.outgoing, (send_time + self.latency, self.order, buf))
+        self.order += 1
+
+    def flush(self):
+        now = timer()
+        while self.outgoing and self.outgoing[0][0] <= now:
+            _, _, buf = heapq.heappop(self.outgoing)
+            self.mav.write(buf)
+
+    def send_heartbeat(self):
+        self.send(self.mav.mav.heartbeat_encode(mavutil.mavlink.MAV_TYPE_QUADROTOR,
+                                                mavutil.mavlink.MAV_AUTOPILOT_PX4,
+                                                mavutil.mavlink.MAV_MODE_FLAG_CUSTOM_MODE_ENABLED, 0,
+                                                mavutil.mavlink.MAV_STATE_STANDBY))
+
+    def send_attitude(self):
+        t = timer() - self.start_time
+        self.send(self.mav.mav.attitude_encode(int(t * 1000), 0.01 * math.sin(t), 0.01 * math.cos(t), t % 6.28,
+                                               0.0, 0.0, 0.0))
+
+    def send_sys_status(self):
+        self.send(self.mav.mav.sys_status_encode(0, 0, 0, 250, 16000, 1200, 80, 0, 0, 0, 0, 0, 0))
+
+    def run(self, duration=None):
+        end_time = timer() + duration if duration else None
+        next_heartbeat = timer()
+        next_telemetry = timer()
+        while end_time is None or timer() < end_time:
+            now = timer()
+            if self.rebooting_until:
+                if now < self.rebooting_until:
+                    # Replies already on the link still arrive
+                    self.flush()
+                    select.select([self.mav.fd], [], [], min(0.1, self.rebooting_until - now))
+                    # Nobody listening while booting
+                    while self.mav.recv_match(blocking=False) is not None:
+                        pass
+                    continue
+                self.boot()
+                next_heartbeat = now
+            if now >= next_heartbeat:
+                self.send_heartbeat()
+                if self.telemetry_rate > 0:
+                    self.send_sys_status()
+                next_heartbeat = now + 1
+            if self.telemetry_rate > 0 and now >= next_telemetry:
+                self.send_attitude()
+                next_telemetry = max(next_telemetry + 1 / self.telemetry_rate, now)
+            self.stream_bursts()
+            self.shell.step(now)
+            self.send_shell_output()
+            self.flush()
+
+            timeout = next_heartbeat - timer()
+            if self.telemetry_rate > 0:
+                timeout = min(timeout, next_telemetry - timer())
+            if self.outgoing:
+                timeout = min(timeout, self.outgoing[0][0] - timer())
+            shell_wake = self.shell.wake_time()
+            if shell_wake is not None:
+                timeout = min(timeout, shell_wake - timer())
+            if (self.streaming() or self.shell.output) and self.link_free_time - timer() < 0.005:
+                timeout = 0
+            select.select([self.mav.fd], [], [], max(0.0, timeout))
+            while True:
+                m = self.mav.recv_match(blocking=False)
+                if m is None:
+                    break
+                if self.loss > 0 and random.random() < self.loss:
+                    self.stats["dropped_in"] += 1
+                    continue
+                handler = self.handlers.get(m.get_type())
+                if handler is not None:
+                    handler(m)
+
+    # --- commands ---------------------------------------------------------
+
+    def for_us(self, m):
+        return m.target_system in (0, 1) and m.target_component in (0, 1)
+
+    def handle_command(self, m):
+        if not self.for_us(m):
+            return
+        if m.command == mavutil.mavlink.MAV_CMD_PREFLIGHT_REBOOT_SHUTDOWN and int(m.param1) == 1:
+            self.send(self.mav.mav.command_ack_encode(m.command, mavutil.mavlink.MAV_RESULT_ACCEPTED, 0, 0,
+                                                      m.get_srcSystem(), m.get_srcComponent()))
+            self.debug("reboot")
+            self.rebooting_until = timer() + self.reboot_time
+            return
+        # Messages mavsdk requests on connection. Its info plugin keeps
+        # retrying a request answered with UNSUPPORTED until mavsdk_server
+        # crashes, so these have to be served as PX4 does.
+        requested = {
+            mavutil.mavlink.MAV_CMD_REQUEST_AUTOPILOT_CAPABILITIES: mavutil.mavlink.MAVLINK_MSG_ID_AUTOPILOT_VERSION,
+            mavutil.mavlink.MAV_CMD_REQUEST_FLIGHT_INFORMATION: mavutil.mavlink.MAVLINK_MSG_ID_FLIGHT_INFORMATION,
+        }.get(m.command)
+        if m.command == mavutil.mavlink.MAV_CMD_REQUEST_MESSAGE:
+            requested = int(m.param1)
+        send = self.message_senders.get(requested)
+        result = mavutil.mavlink.MAV_RESULT_ACCEPTED if send is not None else mavutil.mavlink.MAV_RESULT_UNSUPPORTED
+        self.send(self.mav.mav.command_ack_encode(m.command, result, 0, 0, m.get_srcSystem(), m.get_srcComponent()))
+        if send is not None:
+            send()
+
+    def handle_timesync(self, m):
+        # A request has tc1 0, PX4 answers with its own time and the ts1 of the request
+        if m.tc1 == 0:
+            self.send(self.mav.mav.timesync_encode(int((timer() - self.start_time) * 1e9), m.ts1))
+
+    def handle_ping(self, m):
+        if m.target_system == 0 and m.target_component == 0:
+            self.send(self.mav.mav.ping_encode(m.time_usec, m.seq, m.get_srcSystem(), m.get_srcComponent()))
+
+    def boot(self):
+        self.debug("booted")
+        self.rebooting_until = 0.0
+        for session in list(self.sessions):
+            self.close_session(session)
+        self.last_request = None
+        self.last_reply = None
+        self.shell = NshShell(self, self.shell_read_rate, self.shell_delay)
+        self.start_time = timer()
+
+    def send_autopilot_version(self):
+        capabilities = (mavutil.mavlink.MAV_PROTOCOL_CAPABILITY_FTP |
+                        mavutil.mavlink.MAV_PROTOCOL_CAPABILITY_MAVLINK2 |
+                        mavutil.mavlink.MAV_PROTOCOL_CAPABILITY_PARAM_ENCODE_BYTEWISE)
+        self.send(self.mav.mav.autopilot_version_encode(capabilities, 0, 0, 0, 0, [0] * 8, [0] * 8, [0] * 8,
+                                                        0, 0, self.uid, list(struct.pack('<Q', self.uid)) + [0] * 10))
+
+    def send_flight_information(self):
+        self.send(self.mav.mav.flight_information_encode(int((timer() - self.start_time) * 1000), 0, 0, self.uid))
+
+    # --- parameters -------------------------------------------------------
+
+    def send_param(self, index):
+        name, kind, value = self.params[index]
+        if kind == "int":
+            # PX4 puts int32 values bytewise into the float field
+            value = struct.unpack('<f', struct.pack('<i', value))[0]
+            param_type = mavutil.mavlink.MAV_PARAM_TYPE_INT32
+        else:
+            param_type = mavutil.mavlink.MAV_PARAM_TYPE_REAL32
+        self.send(self.mav.mav.param_value_encode(name.encode(), value, param_type, len(self.params), index))
+
+    def handle_param_list(self, m):
+        if self.for_us(m):
+            for index in range(len(self.params)):
+                self.send_param(index)
+
+    def handle_param_read(self, m):
+        if not self.for_us(m):
+            return
+        index = m.param_index if m.param_index >= 0 else self.param_index.get(m.param_id)
+        if index is not None and index < len(self.params):
+            self.send_param(index)
+
+    def handle_param_set(self, m):
+        if not self.for_us(m):
+            return
+        index = self.param_index.get(m.param_id)
+        if index is None:
+            # PX4 does not answer for unknown parameters
+            return
+        param = self.params[index]
+        if param[1] == "int":
+            param[2] = struct.unpack('<i', struct.pack('<f', m.param_value))[0]
+        else:
+            param[2] = m.param_value
+        self.debug(f"param set {param[0]} {param[2]}")
+        self.send_param(index)
+
+    # --- shell ------------------------------------------------------------
+
+    def handle_serial_control(self, m):
+        if m.device == mavutil.mavlink.SERIAL_CONTROL_DEV_SHELL and m.count:
+            self.shell.input(bytes(m.data[:m.count]))
+
+    def send_shell_output(self):
+        # Paced by the link like burst reads, PX4 sends shell output as fast
+        # as its MAVLink buffer allows
+        while self.shell.output and self.link_free_time - timer() < 0.005:
+            chunk = bytes(self.shell.output[:70])
+            del self.shell.output[:70]
+            self.stats["shell_out"] += len(chunk)
+            self.send(self.mav.mav.serial_control_encode(mavutil.mavlink.SERIAL_CONTROL_DEV_SHELL,
+                                                         mavutil.mavlink.SERIAL_CONTROL_FLAG_REPLY, 0, 0,
+                                                         len(chunk), list(chunk.ljust(70, b'\0'))))
+            if self.bandwidth <= 0:
+                break
+
+    # --- ftp --------------------------------------------------------------
+
+    def local_path(self, remote):
+        remote = remote.split('\0')[0]
+        path = os.path.normpath(os.path.join(self.root, remote.lstrip('/')))
+        if path != self.root and not path.startswith(self.root + os.sep):
+            return None
+        return path
+
+    def send_ftp(self, m, packet):
+        self.stats["replies"] += 1
+        self.send(self.mav.mav.file_transfer_protocol_encode(0, m.get_srcSystem(), m.get_srcComponent(), packet.pack()))
+
+    def reply(self, req, opcode, data=b'', offset=None, session=None):
+        return FtpPacket(seq=(req.seq + 1) & 0xffff, session=req.session if session is None else session,
+                         opcode=opcode, size=len(data), req_opcode=req.opcode,
+                         offset=req.offset if offset is None else offset, data=data)
+
+    def nak(self, req, error):
+        return self.reply(req, OP_NAK, bytes([error]))
+
+    def handle_ftp(self, m):
+        if not self.for_us(m):
+            return
+        req = FtpPacket.unpack(m.payload)
+        self.stats["requests"] += 1
+        self.debug(f"ftp op {req.opcode} seq {req.seq} session {req.session} offset {req.offset}", 2)
+        if req.opcode == OP_BURST_READ_FILE:
+            reply = self.ftp_burst(req, m)
+            if reply is not None:
+                self.send_ftp(m, reply)
+            return
+        # Repeated request: the reply got lost, send it again without redoing the operation
+        if self.last_request is not None and req.seq == self.last_request[0] and req.opcode == self.last_request[1]:
+            self.send_ftp(m, self.last_reply)
+            return
+        handler = self.ftp_handlers().get(req.opcode)
+        try:
+            reply = handler(req) if handler is not None else self.nak(req, ERR_UNKNOWN_COMMAND)
+        except OSError:
+            reply = self.nak(req, ERR_FAIL)
+        self.last_request = (req.seq, req.opcode)
+        self.last_reply = reply
+        self.send_ftp(m, reply)
+
+    def ftp_handlers(self):
+        return {
+            OP_TERMINATE_SESSION: self.ftp_terminate,
+            OP_RESET_SESSIONS: self.ftp_reset,
+            OP_LIST_DIRECTORY: self.ftp_list,
+            OP_OPEN_FILE_RO: self.ftp_open_ro,
+            OP_READ_FILE: self.ftp_read,
+            OP_CREATE_FILE: self.ftp_create,
+            OP_OPEN_FILE_WO: self.ftp_open_wo,
+            OP_WRITE_FILE: self.ftp_write,
+            OP_REMOVE_FILE: self.ftp_remove_file,
+            OP_CREATE_DIRECTORY: self.ftp_mkdir,
+            OP_REMOVE_DIRECTORY: self.ftp_rmdir,
+            OP_TRUNCATE_FILE: self.ftp_truncate,
+            OP_RENAME: self.ftp_rename,
+            OP_CALC_FILE_CRC32: self.ftp_crc32,
+        }
+
+    def new_session(self, req, fh, path, writable):
+        for session in range(MAX_SESSIONS):
+            if session not in self.sessions:
+                self.sessions[session] = SimFtpSession(fh, path, writable)
+                return session
+        fh.close()
+        return None
+
+    def close_session(self, session):
+        s = self.sessions.pop(session, None)
+        if s is not None:
+            s.fh.close()
+
+    def ftp_terminate(self, req):
+        if req.session not in self.sessions:
+            return self.nak(req, ERR_INVALID_SESSION)
+        self.close_session(req.session)
+        return self.reply(req, OP_ACK)
+
+    def ftp_reset(self, req):
+        for session in list(self.sessions):
+            self.close_session(session)
+        return self.reply(req, OP_ACK)
+
+    def ftp_list(self, req):
+        path = self.local_path(req.data.decode('utf-8', 'replace'))
+        if path is None or not os.path.isdir(path):
+            return self.nak(req, ERR_FILE_NOT_FOUND)
+        entries = []
+        for name in sorted(os.listdir(path)):
+            full = os.path.join(path, name)
+            if os.path.isdir(full):
+                entries.append(b"D" + name.encode())
+            else:
+                entries.append(b"F" + name.encode() + b"\t" + str(os.path.getsize(full)).encode())
+        if req.offset >= len(entries):
+            return self.nak(req, ERR_EOF)
+        data = b''
+        for entry in entries[req.offset:]:
+            if len(data) + len(entry) + 1 > MAX_DATA_LEN:
+                break
+            data += entry + b'\0'
+        return self.reply(req, OP_ACK, data)
+
+    def ftp_open_ro(self, req):
+        path = self.local_path(req.data.decode('utf-8', 'replace'))
+        if path is None or not os.path.isfile(path):
+            return self.nak(req, ERR_FILE_NOT_FOUND)
+        session = self.new_session(req, open(path, 'rb'), path, False)
+        if session is None:
+            return self.nak(req, ERR_NO_SESSIONS_AVAILABLE)
+        return self.reply(req, OP_ACK, struct.pack('<I', os.path.getsize(path)), session=session)
+
+    def ftp_read(self, req):
+        s = self.sessions.get(req.session)
+        if s is None:
+            return self.nak(req, ERR_INVALID_SESSION)
+        s.fh.seek(req.offset)
+        data = s.fh.read(MAX_DATA_LEN)
+        if len(data) == 0:
+            return self.nak(req, ERR_EOF)
+        return self.reply(req, OP_ACK, data)
+
+    def ftp_burst(self, req, m):
+        s = self.sessions.get(req.session)
+        if s is None:
+            return self.nak(req, ERR_INVALID_SESSION)
+        # Data is streamed from stream_bursts() as link capacity allows
+        s.stream_offset = req.offset
+        s.stream_seq = req.seq
+        s.streaming = (m.get_srcSystem(), m.get_srcComponent())
+        return None
+
+    def streaming(self):
+        return any(s.streaming for s in self.sessions.values())
+
+    def stream_bursts(self):
+        # Keep at most a few packets queued ahead so that a new burst request
+        # (after a lost packet) takes effect quickly.
+        for session, s in self.sessions.items():
+            while s.streaming and self.link_free_time - timer() < 0.005:
+                s.fh.seek(s.stream_offset)
+                data = s.fh.read(MAX_DATA_LEN)
+                s.stream_seq = (s.stream_seq + 1) & 0xffff
+                target_system, target_component = s.streaming
+                if len(data) == 0:
+                    packet = FtpPacket(seq=s.stream_seq, session=session, opcode=OP_NAK, size=1,
+                                       req_opcode=OP_BURST_READ_FILE, offset=s.stream_offset, data=bytes([ERR_EOF]))
+                    s.streaming = False
+                else:
+                    at_end = s.stream_offset + len(data) >= os.fstat(s.fh.fileno()).st_size
+                    packet = FtpPacket(seq=s.stream_seq, session=session, opcode=OP_ACK, size=len(data),
+                                       req_opcode=OP_BURST_READ_FILE, burst_complete=1 if at_end else 0,
+                                       offset=s.stream_offset, data=data)
+                    s.stream_offset += len(data)
+                    if at_end:
+                        s.streaming = False
+                self.stats["replies"] += 1
+                self.send(self.mav.mav.file_transfer_protocol_encode(0, target_system, target_component, packet.pack()))
+                if self.bandwidth <= 0:
+                    # no link model, don't starve the receive side
+                    break
+
+    def ftp_create(self, req):
+        path = self.local_path(req.data.decode('utf-8', 'replace'))
+        if path is None or not os.path.isdir(os.path.dirname(path)):
+            return self.nak(req, ERR_FILE_NOT_FOUND)
+        session = self.new_session(req, open(path, 'wb'), path, True)
+        if session is None:
+            return self.nak(req, ERR_NO_SESSIONS_AVAILABLE)
+        return self.reply(req, OP_ACK, session=session)
+
+    def ftp_open_wo(self, req):
+        path = self.local_path(req.data.decode('utf-8', 'replace'))
+        if path is None or not os.path.isfile(path):
+            return self.nak(req, ERR_FILE_NOT_FOUND)
+        session = self.new_session(req, open(path, 'r+b'), path, True)
+        if session is None:
+            return self.nak(req, ERR_NO_SESSIONS_AVAILABLE)
+        return self.reply(req, OP_ACK, struct.pack('<I', os.path.getsize(path)), session=session)
+
+    def ftp_write(self, req):
+        s = self.sessions.get(req.session)
+        if s is None or not s.writable:
+            return self.nak(req, ERR_INVALID_SESSION)
+        s.fh.seek(req.offset)
+        s.fh.write(req.data)
+        return self.reply(req, OP_ACK)
+
+    def ftp_remove_file(self, req):
+        path = self.local_path(req.data.decode('utf-8', 'replace'))
+        if path is None or not os.path.isfile(path):
+            return self.nak(req, ERR_FILE_NOT_FOUND)
+        os.remove(path)
+        return self.reply(req, OP_ACK)
+
+    def ftp_mkdir(self, req):
+        path = self.local_path(req.data.decode('utf-8', 'replace'))
+        if path is None:
+            return self.nak(req, ERR_FAIL)
+        if os.path.exists(path):
+            return self.nak(req, ERR_FILE_EXISTS)
+        os.mkdir(path)
+        return self.reply(req, OP_ACK)
+
+    def ftp_rmdir(self, req):
+        path = self.local_path(req.data.decode('utf-8', 'replace'))
+        if path is None or not os.path.isdir(path):
+            return self.nak(req, ERR_FILE_NOT_FOUND)
+        os.rmdir(path)
+        return self.reply(req, OP_ACK)
+
+    def ftp_truncate(self, req):
+        path = self.local_path(req.data.decode('utf-8', 'replace'))
+        if path is None or not os.path.isfile(path):
+            return self.nak(req, ERR_FILE_NOT_FOUND)
+        os.truncate(path, req.offset)
+        return self.reply(req, OP_ACK)
+
+    def ftp_rename(self, req):
+        names = req.data.split(b'\0')
+        if len(names) < 2:
+            return self.nak(req, ERR_FAIL)
+        src = self.local_path(names[0].decode('utf-8', 'replace'))
+        dst = self.local_path(names[1].decode('utf-8', 'replace'))
+        if src is None or dst is None or not os.path.exists(src):
+            return self.nak(req, ERR_FILE_NOT_FOUND)
+        os.rename(src, dst)
+        return self.reply(req, OP_ACK)
+
+    def ftp_crc32(self, req):
+        path = self.local_path(req.data.decode('utf-8', 'replace'))
+        if path is None or not os.path.isfile(path):
+            return self.nak(req, ERR_FILE_NOT_FOUND)
+        crc = 0
+        with open(path, 'rb') as fh:
+            while True:
+                chunk = fh.read(1024 * 1024)
+                if not chunk:
+                    break
+                crc = px4_crc32(chunk, crc)
+        return self.reply(req, OP_ACK, struct.pack('<I', crc))
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('--host', action="store", help='Address of the ground station (default 127.0.0.1)', default='127.0.0.1')
+    parser.add_argument('-p', '--port', action="store", type=int, help='UDP port of the ground station (default 15761)', default=15761)
+    parser.add_argument('--root', action="store", help='Serve this directory as / instead of a generated fake SD card')
+    parser.add_argument('--days', action="store", type=int, help='Number of log date directories (default 3)', default=3)
+    parser.add_argument('--logs-per-day', action="store", type=int, help='Number of logs per date directory (default 3)', default=3)
+    parser.add_argument('--log-size', action="store", type=parse_size, help='Size of each log, suffixes k, M (default 1M)', default='1M')
+    parser.add_argument('--encrypted', action="store_true", help='Generate encrypted logs (.ulgc + .ulgk)')
+    parser.add_argument('--latency', action="store", type=float, help='One way latency in seconds (default 0)', default=0.0)
+    parser.add_argument('--loss', action="store", type=float, help='Packet loss probability in each direction (default 0)', default=0.0)
+    parser.add_argument('--bandwidth', action="store", type=parse_size, help='Link bandwidth in bytes/s, 0 = unlimited (default 2M)', default='2M')
+    parser.add_argument('--uid', action="store", type=int, help='Hardware UID reported to the ground station (default the port)')
+    parser.add_argument('--reboot-time', action="store", type=float, help='Seconds without heartbeats after a reboot command (default 5)', default=5.0)
+    parser.add_argument('--params', action="store", type=int, help='Number of parameters (default 1000)', default=1000)
+    parser.add_argument('--shell-read-rate', action="store", type=parse_size, help='Bytes/s nsh reads from its 1k input pipe, 0 = unlimited (default 0)', default='0')
+    parser.add_argument('--shell-delay', action="store", type=float, help='Seconds every shell command takes (default 0)', default=0.0)
+    parser.add_argument('--telemetry', action="store", type=float, metavar='HZ', help='Stream ATTITUDE at HZ and SYS_STATUS at 1 Hz (default 0, off)', default=0.0)
+    parser.add_argument('--duration', action="store", type=float, help='Exit after this many seconds')
+    parser.add_argument('--debug', action="store", type=int, help='Debug level', default=0)
+    args = parser.parse_args()
+
+    tmpdir = None
+    root = args.root
+    if root is None:
+        tmpdir = tempfile.mkdtemp(prefix="px4_sim_")
+        create_fake_sdcard(tmpdir, args.days, args.logs_per_day, args.log_size, args.encrypted)
+        root = tmpdir
+    print(f"Serving {root} to udp {args.host}:{args.port}")
+    sys.stdout.flush()
+
+    sim = SimulatedPx4(root, f"udpout:{args.host}:{args.port}", latency=args.latency, loss=args.loss,
+                       bandwidth=args.bandwidth, debug=args.debug,
+                       uid=args.uid if args.uid is not None else args.port, reboot_time=args.reboot_time,
+                       param_count=args.params, shell_read_rate=args.shell_read_rate, shell_delay=args.shell_delay,
+                       telemetry_rate=args.telemetry)
+    try:
+        sim.run(args.duration)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+        print(f"requests: {sim.stats['requests']}, replies: {sim.stats['replies']}, "
+              f"dropped: {sim.stats['dropped_in']} in / {sim.stats['dropped_out']} out")
+        if sim.stats["shell_in"]:
+            print(f"shell: {sim.stats['shell_in']} bytes in ({sim.stats['shell_dropped']} dropped), "
+                  f"{sim.stats['shell_out']} bytes out")
+
+
+if __name__ == '__main__':
+    main()
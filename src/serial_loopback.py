@@ -4,25 +4,67 @@
 Performs a loopback test over serial. Helps identify serial communications
 issues.
 
+Without --soak one message is sent and checked. With --soak numbered frames
+with a CRC32 are streamed for --duration seconds (or --bytes), written and
+read by two threads at the same time, and the throughput, lost and corrupted
+frames and the round trip latency are reported.
+
+With --sweep a soak runs for every combination of --bauds, --flow-control
+and --frame-sizes on all given devices in parallel, and the highest setting
+without errors is reported per device.
+
+Examples:
+    serial_loopback.py /dev/px4serial --soak --duration 60
+    serial_loopback.py loop:// --soak --bytes 1000000
+    serial_loopback.py /dev/pts/3 --rx /dev/pts/4 --soak
+    serial_loopback.py /dev/ttyUSB0 /dev/ttyUSB1 --sweep --bauds 115200,460800,921600
+
 @author: Humaid AlQassimi (humaid.alqassimi@tii.ae)
 """
 
+import argparse
+import concurrent.futures
+import itertools
+import json
+import struct
+import sys
+import threading
 import time
+import zlib
 import serial
 from threading import Thread
 
+from mav_metrics import percentile
+
 # This is the message propagated through serial. I kept this slightly long to
 # make sure we catch issue where sometimes random characters are dropped (which
 # we do have!).
 serialmessage = b'lorem ipsum dolor serial amet! Aperiam ducimus qui animi non deserunt ullam optio. Illo enim est sed est quae ab voluptatem\n'
 serialDev = '/dev/px4serial'
 ser = None
+# Port the message comes back on, ser unless --rx is given
+serRx = None
+
+# Soak frame: sync, sequence number, payload, CRC32 of sequence number and payload
+FRAME_SYNC = b'\xa5\x5a'
+FRAME_HEADER = struct.Struct('<2sI')
+FRAME_CRC = struct.Struct('<I')
+MIN_FRAME_SIZE = FRAME_HEADER.size + FRAME_CRC.size + 1
+# Corrupted frames listed in the report
+MAX_REPORTED = 20
+# --flow-control choices, as serial_for_url arguments
+FLOW_CONTROL = {
+    "none": {},
+    "rtscts": {"rtscts": True},
+    "dsrdtr": {"dsrdtr": True},
+}
+
 
 def serialWrite():
     ser.write(serialmessage)
 
 def serialRead():
-    line = ser.readline()
+    line = serRx.readline()
     if line == serialmessage:
         print("Successful!")
     else:
@@ -34,19 +76,367 @@ def serialRead():
             print("Sent: " + repr(serialmessage.decode('ascii')))
             print("Got: " + repr(line.decode('ascii')))
 
+
+def make_frame(seq, size):
+    # The payload is text (from serialmessage), so the sync bytes only
+    # show up at frame starts
+    payload_size = size - FRAME_HEADER.size - FRAME_CRC.size
+    offset = seq % len(serialmessage)
+    payload = (serialmessage[offset:] + serialmessage * (payload_size // len(serialmessage) + 1))[:payload_size]
+    body = struct.pack('<I', seq) + payload
+    return FRAME_SYNC + body + FRAME_CRC.pack(zlib.crc32(body))
+
+
+class SoakTest:
+    '''streams frames through tx and checks what comes back on rx'''
+
+    def __init__(self, tx, rx, frame_size=129, window=16, timeout=2.0):
+        self.tx = tx
+        self.rx = rx
+        self.frame_size = frame_size
+        # Frames sent ahead of the reader, keeps the latency to the link's
+        # and not the OS buffers'
+        self.window = window
+        # A frame not back after this many seconds is lost
+        self.timeout = timeout
+        self.lock = threading.Condition()
+        # seq -> (send time, frame) of the frames on the way
+        self.inflight = {}
+        self.stop = threading.Event()
+        self.writer_done = threading.Event()
+        self.sent_frames = 0
+        self.sent_bytes = 0
+        self.received_frames = 0
+        self.received_bytes = 0
+        self.lost = 0
+        self.duplicates = 0
+        # (seq, offsets of the differing bytes, bytes missing)
+        self.corrupted = []
+        self.corrupted_count = 0
+        self.latencies = []
+        self.start = None
+        self.end = None
+        self.last_received = None
+        self.write_error = None
+
+    def expire(self, now):
+        '''count the frames older than the timeout as lost, lock held'''
+        for seq in [seq for seq, (sent, _) in self.inflight.items() if now - sent > self.timeout]:
+            del self.inflight[seq]
+            self.lost += 1
+        self.lock.notify_all()
+
+    def write_frames(self, duration, nbytes):
+        seq = 0
+        end = self.start + duration if duration else None
+        try:
+            while not self.stop.is_set():
+                if (end is not None and time.monotonic() >= end) or (nbytes and self.sent_bytes >= nbytes):
+                    break
+                with self.lock:
+                    while len(self.inflight) >= self.window:
+                        if not self.lock.wait(self.timeout):
+                            self.expire(time.monotonic())
+                    frame = make_frame(seq, self.frame_size)
+                    self.inflight[seq] = (time.monotonic(), frame)
+                try:
+                    self.tx.write(frame)
+                except serial.SerialTimeoutException:
+                    # Flow control never let the frame out
+                    self.write_error = "write timed out"
+                    with self.lock:
+                        self.inflight.pop(seq, None)
+                    break
+                self.sent_frames += 1
+                self.sent_bytes += len(frame)
+                seq = (seq + 1) & 0xffffffff
+        finally:
+            self.writer_done.set()
+
+    def intact(self, data):
+        return (len(data) == self.frame_size and
+                FRAME_CRC.unpack_from(data, len(data) - FRAME_CRC.size)[0] == zlib.crc32(data[2:-FRAME_CRC.size]))
+
+    def check(self, data):
+        '''one frame's worth of bytes starting with the sync, possibly damaged'''
+        now = time.monotonic()
+        seq = FRAME_HEADER.unpack_from(data)[1] if len(data) >= FRAME_HEADER.size else None
+        with self.lock:
+            if self.intact(data):
+                sent = self.inflight.pop(seq, None)
+                if sent is None:
+                    # Already counted as lost, or sent twice by the link
+                    self.duplicates += 1
+                else:
+                    self.received_frames += 1
+                    self.last_received = now
+                    self.latencies.append(now - sent[0])
+            else:
+                if seq not in self.inflight:
+                    # Sequence number damaged too, assume the oldest frame on the way
+                    seq = min(self.inflight) if self.inflight else None
+                sent = self.inflight.pop(seq, None)
+                self.corrupted_count += 1
+                if sent is not None and len(self.corrupted) < MAX_REPORTED:
+                    frame = sent[1]
+                    offsets = [i for i in range(min(len(frame), len(data))) if frame[i] != data[i]]
+                    self.corrupted.append((seq, offsets, len(frame) - len(data)))
+            self.lock.notify_all()
+
+    def read_frames(self):
+        buf = bytearray()
+        while True:
+            data = self.rx.read(max(1, self.rx.in_waiting))
+            if data:
+                self.received_bytes += len(data)
+                buf += data
+            start = buf.find(FRAME_SYNC)
+            while start >= 0 and len(buf) - start >= self.frame_size:
+                end = start + self.frame_size
+                if not self.intact(bytes(buf[start:end])):
+                    # A sync inside the frame (or right after its first
+                    # frame_size - 1 bytes) means bytes got dropped
+                    if len(buf) - start < self.frame_size + 1:
+                        break
+                    sync = buf.find(FRAME_SYNC, start + len(FRAME_SYNC), start + self.frame_size + 1)
+                    end = sync if sync >= 0 else end
+                self.check(bytes(buf[start:end]))
+                del buf[:end]
+                start = buf.find(FRAME_SYNC)
+            if start < 0 and len(buf) > 1:
+                # Garbage without a frame start
+                del buf[:-1]
+            with self.lock:
+                self.expire(time.monotonic())
+                if self.writer_done.is_set() and not self.inflight:
+                    return
+            if self.stop.is_set():
+                return
+
+    def run(self, duration=None, nbytes=None):
+        self.tx.reset_input_buffer()
+        self.rx.reset_input_buffer()
+        self.start = time.monotonic()
+        writer = Thread(target=self.write_frames, args=(duration, nbytes))
+        writer.start()
+        try:
+            self.read_frames()
+        except KeyboardInterrupt:
+            self.stop.set()
+            print("Interrupted")
+        finally:
+            self.stop.set()
+            writer.join()
+            self.end = time.monotonic()
+        return self.result()
+
+    def result(self):
+        elapsed = self.end - self.start
+        # Up to the last frame, not including the wait for lost ones
+        busy = (self.last_received or self.end) - self.start
+        return {
+            "frame_size": self.frame_size,
+            "seconds": elapsed,
+            "sent_frames": self.sent_frames,
+            "sent_bytes": self.sent_bytes,
+            "received_frames": self.received_frames,
+            "bytes_per_s": self.received_frames * self.frame_size / busy if busy > 0 else 0.0,
+            "lost_frames": self.lost,
+            "corrupted_frames": self.corrupted_count,
+            "error_rate": (self.lost + self.corrupted_count) / self.sent_frames if self.sent_frames else 0.0,
+            "duplicates": self.duplicates,
+            "write_error": self.write_error,
+            "corrupted": self.corrupted,
+            "latency_ms": {p: percentile(self.latencies, p) * 1000 for p in (50, 90, 99, 100)} if self.latencies else None,
+        }
+
+
+def print_soak(result):
+    print("Sent %u frames (%u bytes) in %.1f s, %u came back intact: %.0f bytes/s" % (
+        result["sent_frames"], result["sent_bytes"], result["seconds"], result["received_frames"], result["bytes_per_s"]))
+    print("Lost: %u, corrupted: %u, frame error rate %.4f%%" % (
+        result["lost_frames"], result["corrupted_frames"], result["error_rate"] * 100))
+    if result["write_error"]:
+        print("Stopped: %s" % result["write_error"])
+    if result["duplicates"]:
+        print("Frames received twice or after the timeout: %u" % result["duplicates"])
+    for seq, offsets, missing in result["corrupted"]:
+        if missing > 0:
+            # The bytes after a gap are all shifted, where it starts is what matters
+            details = "%u byte(s) missing from offset %u" % (missing, offsets[0] if offsets else result["frame_size"] - missing)
+        else:
+            details = "bytes differ at offsets " + ", ".join(str(o) for o in offsets[:16]) + (" ..." if len(offsets) > 16 else "")
+        print("  frame %u: %s" % (seq, details))
+    if result["corrupted_frames"] > len(result["corrupted"]):
+        print("  ...")
+    if result["latency_ms"]:
+        latency = result["latency_ms"]
+        print("Round trip: p50 %.2f ms, p90 %.2f ms, p99 %.2f ms, max %.2f ms" % (
+            latency[50], latency[90], latency[99], latency[100]))
+
+
+def is_clean(result):
+    return (not result.get("error") and not result["write_error"] and result["received_frames"] > 0 and
+            not result["lost_frames"] and not result["corrupted_frames"])
+
+
+def soak_timeout(args, frame_size, baudrate):
+    # Frames queued behind a full window take that long on a slow link
+    return args.timeout + args.window * frame_size * 10 / baudrate
+
+
+def open_port(device, args, baudrate=None, flow=None):
+    if flow is None:
+        flow = {"rtscts": args.rtscts, "dsrdtr": args.dsrdtr}
+    return serial.serial_for_url(device, timeout=args.read_timeout, write_timeout=args.timeout,
+                                 baudrate=baudrate or args.baudrate, **flow)
+
+
+def sweep_device(device, args):
+    '''soak results of device for every setting of the sweep'''
+    results = []
+    # JSON on stdout, keep it parseable
+    out = sys.stderr if args.json else sys.stdout
+    for baudrate, flow, frame_size in itertools.product(args.bauds, args.flow_control, args.frame_sizes):
+        setting = {"device": device, "baudrate": baudrate, "flow": flow, "frame_size": frame_size}
+        try:
+            port = open_port(device, args, baudrate, FLOW_CONTROL[flow])
+        except (serial.SerialException, ValueError) as e:
+            results.append(dict(setting, error=str(e)))
+            print("[%s] %u baud, flow %s, %u byte frames: %s" % (device, baudrate, flow, frame_size, e), file=out)
+            continue
+        try:
+            soak = SoakTest(port, port, frame_size, args.window, soak_timeout(args, frame_size, baudrate))
+            result = dict(soak.run(args.duration, args.bytes), **setting)
+        finally:
+            port.close()
+        results.append(result)
+        print("[%s] %u baud, flow %s, %u byte frames: %.0f bytes/s, frame error rate %.4f%%" % (
+            device, baudrate, flow, frame_size, result["bytes_per_s"], result["error_rate"] * 100), file=out)
+    return results
+
+
+def best_setting(results):
+    '''(baud rate, flow control) of the fastest setting that was clean
+    with all frame sizes, without flow control if possible; None if none'''
+    settings = {}
+    for result in results:
+        key = (result["baudrate"], result["flow"])
+        settings[key] = settings.get(key, True) and is_clean(result)
+    clean = [key for key, ok in settings.items() if ok]
+    if not clean:
+        return None
+    return max(clean, key=lambda key: (key[0], key[1] == "none"))
+
+
+def print_sweep(device, results):
+    print()
+    print(device)
+    print("  baud".ljust(10) + "flow".ljust(8) + "frame".rjust(6) + "bytes/s".rjust(10) + "line %".rjust(8) +
+          "errors %".rjust(10) + "p99 ms".rjust(9))
+    for r in results:
+        if r.get("error"):
+            print(f"  {r['baudrate']:<8}{r['flow']:<8}{r['frame_size']:6}  {r['error']}")
+            continue
+        # 10 bits per byte on the wire (start, 8 data, stop)
+        line = r["bytes_per_s"] * 10 / r["baudrate"] * 100
+        p99 = "%9.2f" % r["latency_ms"][99] if r["latency_ms"] else "-".rjust(9)
+        note = "  " + r["write_error"] if r["write_error"] else ""
+        print(f"  {r['baudrate']:<8}{r['flow']:<8}{r['frame_size']:6}{r['bytes_per_s']:10.0f}{line:8.1f}"
+              f"{r['error_rate'] * 100:10.4f}{p99}{note}")
+    best = best_setting(results)
+    if best is None:
+        print("  No clean setting")
+    else:
+        rate = max(r["bytes_per_s"] for r in results if (r["baudrate"], r["flow"]) == best)
+        print("  Highest clean setting: %u baud, %s (%.0f bytes/s)" % (
+            best[0], "no flow control" if best[1] == "none" else best[1] + " flow control", rate))
+
+
+def run_sweep(devices, args):
+    '''sweep all devices in parallel, True if every one has a clean setting'''
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(devices)) as executor:
+        sweeps = dict(zip(devices, executor.map(lambda device: sweep_device(device, args), devices)))
+    if args.json:
+        json.dump({device: [dict(r, corrupted=r.get("corrupted", [])[:MAX_REPORTED]) for r in results]
+                   for device, results in sweeps.items()}, sys.stdout, indent=2)
+        print()
+    else:
+        for device, results in sweeps.items():
+            print_sweep(device, results)
+    return all(best_setting(results) is not None for results in sweeps.values())
+
+
+def int_list(value):
+    # "115200,921600" -> [115200, 921600]
+    return [int(v) for v in value.split(',') if v]
+
+
+def flow_list(value):
+    flows = [v for v in value.split(',') if v]
+    for flow in flows:
+        if flow not in FLOW_CONTROL:
+            raise argparse.ArgumentTypeError(f"unknown flow control '{flow}', choose from {', '.join(FLOW_CONTROL)}")
+    return flows
+
+
 def main():
-    global ser
-    ser = serial.serial_for_url(serialDev, timeout=2, baudrate=115200, rtscts=False, dsrdtr=False)
-    threadWrite = Thread(target=serialWrite)
-    threadRead = Thread(target=serialRead)
-    threadRead.start()
-    threadWrite.start()
-
-    # Wait for the read to end
-    threadRead.join()
+    global ser, serRx
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('device', nargs='*', help=f'Serial device or pyserial URL, several with --sweep (default {serialDev})')
+    parser.add_argument('--rx', action="store", metavar='DEVICE', help='Read from DEVICE instead, e.g. the other end of a pty pair')
+    parser.add_argument('-b', '--baudrate', action="store", type=int, help='Baud rate (default 115200)', default=115200)
+    parser.add_argument('--rtscts', action="store_true", help='Use RTS/CTS flow control')
+    parser.add_argument('--dsrdtr', action="store_true", help='Use DSR/DTR flow control')
+    parser.add_argument('--soak', action="store_true", help='Stream frames instead of sending one message')
+    parser.add_argument('--sweep', action="store_true", help='Soak every combination of --bauds, --flow-control and --frame-sizes')
+    parser.add_argument('--bauds', action="store", type=int_list, metavar='LIST', help='Sweep baud rates (default 115200,230400,460800,921600)', default='115200,230400,460800,921600')
+    parser.add_argument('--flow-control', action="store", type=flow_list, metavar='LIST', help=f'Sweep flow control, from {",".join(FLOW_CONTROL)} (default none,rtscts)', default='none,rtscts')
+    parser.add_argument('--frame-sizes', action="store", type=int_list, metavar='LIST', help=f'Sweep frame sizes (default 64,{len(serialmessage)},512)', default=f'64,{len(serialmessage)},512')
+    parser.add_argument('--duration', action="store", type=float, metavar='SECONDS', help='Soak duration (default 10, 2 per setting with --sweep, unless --bytes is given)')
+    parser.add_argument('--bytes', action="store", type=int, help='Stop the soak after sending this many bytes')
+    parser.add_argument('--frame-size', action="store", type=int, help=f'Bytes per frame (default {len(serialmessage)})', default=len(serialmessage))
+    parser.add_argument('--window', action="store", type=int, help='Frames in flight (default 16)', default=16)
+    parser.add_argument('--timeout', action="store", type=float, metavar='SECONDS', help='A frame not back within this is lost (default 2)', default=2.0)
+    parser.add_argument('--json', action="store_true", help='Print the soak or sweep results as JSON')
+    args = parser.parse_args()
+    args.read_timeout = 0.1 if args.soak or args.sweep else 2
+    devices = list(dict.fromkeys(args.device)) or [serialDev]
+    if min([args.frame_size] + (args.frame_sizes if args.sweep else [])) < MIN_FRAME_SIZE:
+        parser.error(f"frames must be at least {MIN_FRAME_SIZE} bytes")
+    if args.duration is None and not args.bytes:
+        args.duration = 2.0 if args.sweep else 10.0
+
+    if args.sweep:
+        if args.rx:
+            parser.error("--sweep needs loopback devices, --rx is not supported")
+        sys.exit(0 if run_sweep(devices, args) else 1)
+    if len(devices) > 1:
+        parser.error("several devices need --sweep")
+
+    ser = open_port(devices[0], args)
+    serRx = open_port(args.rx, args) if args.rx else ser
+    if not args.soak:
+        threadWrite = Thread(target=serialWrite)
+        threadRead = Thread(target=serialRead)
+        threadRead.start()
+        threadWrite.start()
+
+        # Wait for the read to end
+        threadRead.join()
+    else:
+        soak = SoakTest(ser, serRx, args.frame_size, args.window, soak_timeout(args, args.frame_size, args.baudrate))
+        result = soak.run(args.duration, args.bytes)
+        if args.json:
+            json.dump(result, sys.stdout, indent=2)
+            print()
+        else:
+            print_soak(result)
     ser.close()
+    if serRx is not ser:
+        serRx.close()
+    if args.soak and not is_clean(result):
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
-
-
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+
+"""
+ULog Indexer
+============
+Memory-maps a PX4 ULog file, indexes its message definitions and data
+records without copying the file, and extracts topics into NumPy arrays.
+
+Without --topics a summary is printed: duration, dropouts and the rate of
+every logged topic.
+"""
+
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+try:
+    import numpy as np
+except ImportError as e:
+    print("Failed to import numpy: " + str(e))
+    print("")
+    print("You may need to install it with:")
+    print("    pip3 install --user numpy")
+    print("")
+    sys.exit(1)
+
+
+ULOG_MAGIC = b'ULog\x01\x12\x35'
+HEADER_LEN = 16
+MSG_HEADER_LEN = 3
+
+MSG_FLAG_BITS = ord('B')
+MSG_FORMAT = ord('F')
+MSG_INFO = ord('I')
+MSG_INFO_MULTIPLE = ord('M')
+MSG_PARAMETER = ord('P')
+MSG_PARAMETER_DEFAULT = ord('Q')
+MSG_ADD_LOGGED = ord('A')
+MSG_REMOVE_LOGGED = ord('R')
+MSG_DATA = ord('D')
+MSG_LOGGING = ord('L')
+MSG_LOGGING_TAGGED = ord('C')
+MSG_SYNC = ord('S')
+MSG_DROPOUT = ord('O')
+
+BASE_TYPES = {
+    'int8_t': 'i1', 'uint8_t': 'u1',
+    'int16_t': '<i2', 'uint16_t': '<u2',
+    'int32_t': '<i4', 'uint32_t': '<u4',
+    'int64_t': '<i8', 'uint64_t': '<u8',
+    'float': '<f4', 'double': '<f8',
+    'bool': '?', 'char': 'S1',
+}
+
+_msg_header = struct.Struct('<HB')
+
+
+class ULogError(Exception):
+    pass
+
+
+def parse_format(text):
+    '''"name:type field;type[n] field;..." -> (name, [(type, array length or None, field name)])'''
+    name, _, body = text.partition(':')
+    fields = []
+    for field in body.split(';'):
+        if not field:
+            continue
+        ftype, fname = field.rsplit(' ', 1)
+        length = None
+        if ftype.endswith(']'):
+            ftype, _, n = ftype[:-1].partition('[')
+            length = int(n)
+        fields.append((ftype, length, fname))
+    return name, fields
+
+
+class ULogIndex:
+    '''Offsets of all records of a memory-mapped ULog file'''
+
+    def __init__(self, path):
+        self.path = path
+        self._fh = open(path, 'rb')
+        self.file_size = os.fstat(self._fh.fileno()).st_size
+        if self.file_size < HEADER_LEN:
+            raise ULogError(f"{path}: too short for a ULog file")
+        self.mm = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(ULOG_MAGIC)] != ULOG_MAGIC:
+            raise ULogError(f"{path}: not a ULog file")
+        self.version = self.mm[7]
+        self.start_timestamp = struct.unpack_from('<Q', self.mm, 8)[0]
+
+        # format name -> fields, and file offsets of the 'F' records
+        self.formats = {}
+        self.format_offsets = {}
+        # msg_id -> (topic name, multi_id)
+        self.subscriptions = {}
+        self.info = {}
+        self.params = {}
+        self.dropouts = []
+        self.truncated = False
+        self._dtypes = {}
+        self._build()
+
+    def close(self):
+        try:
+            self.mm.close()
+        except BufferError:
+            # a NumPy view of the map is still alive, it is closed once that is gone
+            pass
+        self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _build(self):
+        # Only the message headers are walked in Python; data records are
+        # just remembered by offset and decoded later in bulk with NumPy.
+        mm = self.mm
+        end = self.file_size
+        pos = HEADER_LEN
+        offsets = array('Q')
+        unpack_header = _msg_header.unpack_from
+        append = offsets.append
+        while pos + MSG_HEADER_LEN <= end:
+            size, mtype = unpack_header(mm, pos)
+            payload = pos + MSG_HEADER_LEN
+            if payload + size > end:
+                self.truncated = True
+                break
+            if mtype == MSG_DATA:
+                append(pos)
+            elif mtype == MSG_FORMAT:
+                name, fields = parse_format(mm[payload:payload + size].decode('utf-8', 'replace'))
+                self.formats[name] = fields
+                self.format_offsets[name] = pos
+            elif mtype == MSG_ADD_LOGGED:
+                multi_id, msg_id = struct.unpack_from('<BH', mm, payload)
+                topic = mm[payload + 3:payload + size].decode('utf-8', 'replace')
+                self.subscriptions[msg_id] = (topic, multi_id)
+            elif mtype == MSG_DROPOUT:
+                self.dropouts.append((pos, struct.unpack_from('<H', mm, payload)[0]))
+            elif mtype in (MSG_INFO, MSG_PARAMETER):
+                self._read_key_value(mm[payload:payload + size], self.info if mtype == MSG_INFO else self.params)
+            pos = payload + size
+
+        self.data_offsets = np.frombuffer(offsets, dtype=np.uint64).astype(np.int64) if len(offsets) else np.zeros(0, np.int64)
+        buf = np.frombuffer(mm, dtype=np.uint8)
+        if len(self.data_offsets):
+            # msg_id and record size of every data record, gathered in one go
+            self.data_ids = self._gather(buf, self.data_offsets + MSG_HEADER_LEN, 2).view('<u2').ravel()
+            self.data_sizes = self._gather(buf, self.data_offsets, 2).view('<u2').ravel()
+        else:
+            self.data_ids = np.zeros(0, np.uint16)
+            self.data_sizes = np.zeros(0, np.uint16)
+
+    def _read_key_value(self, payload, target):
+        key_len = payload[0]
+        key = payload[1:1 + key_len].decode('utf-8', 'replace')
+        vtype, _, name = key.partition(' ')
+        value = payload[1 + key_len:]
+        base = vtype.split('[')[0]
+        try:
+            if vtype.startswith('char['):
+                target[name] = value.decode('utf-8', 'replace')
+            elif base in BASE_TYPES and '[' not in vtype:
+                target[name] = np.frombuffer(value, dtype=BASE_TYPES[base], count=1)[0].item()
+        except ValueError:
+            pass
+
+    @staticmethod
+    def _gather(buf, starts, length):
+        # rows of length bytes starting at each offset, shape (len(starts), length).
+        # Gathered column by column so the temporary index array stays at one
+        # int64 per record instead of one per byte.
+        rows = np.empty((len(starts), length), dtype=np.uint8)
+        for k in range(length):
+            rows[:, k] = buf[starts + k]
+        return rows
+
+    def dtype(self, name, top_level=True):
+        '''packed NumPy dtype for a format'''
+        key = (name, top_level)
+        if key in self._dtypes:
+            return self._dtypes[key]
+        fields = list(self.formats[name])
+        # trailing padding of a message is not written to the log
+        while top_level and fields and fields[-1][2].startswith('_padding'):
+            fields.pop()
+        spec = []
+        for ftype, length, fname in fields:
+            if ftype == 'char' and length is not None:
+                base = f'S{length}'
+                length = None
+            elif ftype in BASE_TYPES:
+                base = BASE_TYPES[ftype]
+            elif ftype in self.formats:
+                base = self.dtype(ftype, top_level=False)
+            else:
+                raise ULogError(f"unknown type '{ftype}' in format '{name}'")
+            spec.append((fname, base, (length,)) if length is not None else (fname, base))
+        dtype = np.dtype(spec)
+        self._dtypes[key] = dtype
+        return dtype
+
+    def topics(self):
+        '''{(topic, multi_id): msg_id}'''
+        return {v: k for k, v in self.subscriptions.items()}
+
+    def records(self, topic, multi_id=0):
+        '''file offsets of the data records of a topic'''
+        msg_ids = [k for k, v in self.subscriptions.items() if v == (topic, multi_id)]
+        if not msg_ids:
+            raise KeyError(f"topic {topic}/{multi_id} not in log")
+        return self.data_offsets[np.isin(self.data_ids, msg_ids)]
+
+    def extract(self, topic, multi_id=0):
+        '''all records of a topic as a structured NumPy array'''
+        dtype = self.dtype(topic)
+        offsets = self.records(topic, multi_id)
+        msg_ids = [k for k, v in self.subscriptions.items() if v == (topic, multi_id)]
+        sizes = self.data_sizes[np.isin(self.data_ids, msg_ids)].astype(np.int64) - 2
+        # skip records that do not match the format (e.g. a cut off last record)
+        offsets = offsets[sizes >= dtype.itemsize]
+        buf = np.frombuffer(self.mm, dtype=np.uint8)
+        rows = self._gather(buf, offsets + MSG_HEADER_LEN + 2, dtype.itemsize)
+        return rows.view(dtype).ravel()
+
+    def timestamps(self):
+        '''timestamp (first field) of every data record, in file order'''
+        buf = np.frombuffer(self.mm, dtype=np.uint8)
+        return self._gather(buf, self.data_offsets + MSG_HEADER_LEN + 2, 8).view('<u8').ravel()
+
+    def summary(self):
+        timestamps = self.timestamps()
+        start = int(timestamps.min()) if len(timestamps) else self.start_timestamp
+        end = int(timestamps.max()) if len(timestamps) else self.start_timestamp
+        duration = (end - start) / 1e6
+        # sort once by (msg_id, timestamp) and slice per topic
+        order = np.lexsort((timestamps, self.data_ids))
+        ids_sorted = self.data_ids[order]
+        ts_sorted = timestamps[order]
+        topics = []
+        for msg_id, (topic, multi_id) in sorted(self.subscriptions.items(), key=lambda item: item[1]):
+            lo, hi = np.searchsorted(ids_sorted, [msg_id, msg_id + 1])
+            ts = ts_sorted[lo:hi]
+            count = len(ts)
+            topic_duration = (int(ts[-1]) - int(ts[0])) / 1e6 if count > 1 else 0.0
+            max_gap = float(np.diff(ts).max()) / 1e3 if count > 2 else 0.0
+            topics.append({
+                "topic": topic,
+                "multi_id": multi_id,
+                "count": count,
+                "rate": (count - 1) / topic_duration if topic_duration > 0 else 0.0,
+                "max_gap_ms": max_gap,
+            })
+        return {
+            "file": self.path,
+            "file_size": self.file_size,
+            "version": self.version,
+            "sys_name": self.info.get("sys_name"),
+            "ver_hw": self.info.get("ver_hw"),
+            "duration": duration,
+            "data_records": len(self.data_offsets),
+            "dropouts": len(self.dropouts),
+            "dropout_ms": sum(d for _, d in self.dropouts),
+            "truncated": self.truncated,
+            "topics": topics,
+        }
+
+
+def print_summary(summary):
+    print(f"file: {summary['file']} ({summary['file_size']/1024/1024:.2f} MB)")
+    if summary['ver_hw']:
+        print(f"hardware: {summary['ver_hw']}")
+    print(f"duration: {summary['duration']:.1f} s, {summary['data_records']} data records")
+    print(f"dropouts: {summary['dropouts']} ({summary['dropout_ms']} ms)")
+    if summary['truncated']:
+        print("WARNING: log is truncated")
+    print()
+    print("topic".ljust(40) + "count".rjust(10) + "rate Hz".rjust(10) + "max gap ms".rjust(12))
+    for t in summary['topics']:
+        name = t['topic'] + (f"[{t['multi_id']}]" if t['multi_id'] else "")
+        print(name.ljust(40) + str(t['count']).rjust(10) + f"{t['rate']:10.1f}" + f"{t['max_gap_ms']:12.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('FILE', help='ULog file')
+    parser.add_argument('-t', '--topics', nargs='+', metavar='TOPIC', help='Topics to extract (TOPIC or TOPIC:MULTI_ID)')
+    parser.add_argument('-o', '--output', action="store", help='Write the extracted topics into this .npz file')
+    parser.add_argument('--json', action="store_true", help='Print the summary as JSON')
+    args = parser.parse_args()
+
+    with ULogIndex(args.FILE) as ulog:
+        if args.topics:
+            arrays = {}
+            for spec in args.topics:
+                topic, _, multi_id = spec.partition(':')
+                data = ulog.extract(topic, int(multi_id) if multi_id else 0)
+                arrays[spec.replace(':', '_')] = data
+                print(f"{spec}: {len(data)} records, fields: {', '.join(data.dtype.names)}")
+            if args.output:
+                np.savez(args.output, **arrays)
+                print(f"file: {args.output}")
+        elif args.json:
+            json.dump(ulog.summary(), sys.stdout, indent=2)
+            print()
+        else:
+            print_summary(ulog.summary())
+
+
+if __name__ == "__main__":
+    main()
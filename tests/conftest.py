@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The tools are flat scripts in src/, import them the way the benchmarks do
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
@@ -0,0 +1,16 @@
+from flight_env_config import FlightEnvChanger
+
+
+def test_read_config_params(tmp_path):
+    path = tmp_path / "config.txt"
+    path.write_text("# [ env: indoor ]\n"
+                    "param set MPC_XY_VEL_MAX 2.5\n"
+                    "  param   set  COM_ARM_WO_GPS 1  \n"
+                    "param show MPC_*\n"
+                    "# param set COMMENTED 1\n"
+                    "param set MPC_XY_VEL_MAX 3.0\n"
+                    "echo done\n")
+    assert FlightEnvChanger().read_config_params(str(path)) == {
+        "MPC_XY_VEL_MAX": "3.0",
+        "COM_ARM_WO_GPS": "1",
+    }
@@ -0,0 +1,42 @@
+from fog_record_bag import RingBuffer, TopicFilter
+
+
+def test_topic_filter_defaults_to_all():
+    f = TopicFilter()
+    assert f.accepts("/fmu/out/sensor_combined")
+    assert f.min_interval_ns("/fmu/out/sensor_combined") == 0
+
+
+def test_topic_filter_include_exclude():
+    f = TopicFilter(include=["/fmu/*", "/tf"], exclude=["/fmu/in/*"])
+    assert f.accepts("/fmu/out/vehicle_odometry")
+    assert f.accepts("/tf")
+    assert not f.accepts("/fmu/in/vehicle_command")
+    assert not f.accepts("/camera/image_raw")
+    assert not f.accepts("/tf_static")
+
+
+def test_topic_filter_first_rate_applies():
+    f = TopicFilter(rates=[("/fmu/out/sensor_combined", 10.0), ("/fmu/*", 50.0)])
+    assert f.min_interval_ns("/fmu/out/sensor_combined") == 100_000_000
+    assert f.min_interval_ns("/fmu/out/vehicle_odometry") == 20_000_000
+    assert f.min_interval_ns("/tf") == 0
+
+
+def test_ring_buffer_keeps_last_seconds():
+    ring = RingBuffer(1.0, 1 << 20)
+    for n in range(30):
+        ring.append(n * 100_000_000, "/a", b"x" * 10)
+    timestamps = [m[0] for m in ring.copy()]
+    assert timestamps[0] == 1_900_000_000
+    assert timestamps[-1] == 2_900_000_000
+    assert ring.nbytes == 10 * len(timestamps)
+    assert ring.seconds() == 1.0
+
+
+def test_ring_buffer_memory_limit():
+    ring = RingBuffer(60.0, 100)
+    for n in range(30):
+        ring.append(n, "/a", b"x" * 10)
+    assert ring.nbytes == 100
+    assert [m[0] for m in ring.copy()] == list(range(20, 30))
@@ -0,0 +1,158 @@
+import asyncio
+import types
+
+import pytest
+
+from ftp_session import FtpSession, normalize
+
+
+class NotFound(Exception):
+    result = "FILE_DOES_NOT_EXIST"
+
+
+class FakeFtp:
+    '''directory listings of a dict, counting the list requests'''
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.requests = []
+        # set to hold list requests until released
+        self.gate = None
+
+    async def list_directory(self, path):
+        self.requests.append(path)
+        # The reply reflects the tree when the request was sent
+        entries = list(self.tree[path]) if path in self.tree else None
+        if self.gate is not None:
+            await self.gate.wait()
+        if entries is None:
+            raise NotFound(path)
+        return entries
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def tree():
+    return {
+        "/": ["Dfs"],
+        "/fs": ["Dmicrosd"],
+        "/fs/microsd": ["Dlog", "Detc"],
+        "/fs/microsd/etc": ["Fconfig.txt\t120"],
+        "/fs/microsd/log": ["D2024-05-01"],
+    }
+
+
+def test_normalize():
+    assert normalize("fs/microsd/") == "/fs/microsd"
+    assert normalize("//fs//microsd") == "/fs/microsd"
+    assert normalize("/") == "/"
+
+
+def test_listings_are_cached():
+    async def main():
+        ftp = FakeFtp(tree())
+        session = FtpSession(ftp)
+        assert await session.list_directory("/fs/microsd") == ["Dlog", "Detc"]
+        assert await session.dir_exists("/fs/microsd/log")
+        assert await session.file_size("/fs/microsd/etc/config.txt") == 120
+        assert await session.file_exists("/fs/microsd/etc/config.txt")
+        assert not await session.file_exists("/fs/microsd/etc/other.txt")
+        assert await session.list_directory("fs/microsd/") == ["Dlog", "Detc"]
+        return ftp.requests
+    assert run(main()) == ["/fs/microsd", "/fs/microsd/etc"]
+
+
+def test_not_found_is_cached():
+    async def main():
+        ftp = FakeFtp(tree())
+        session = FtpSession(ftp)
+        for _ in range(2):
+            with pytest.raises(NotFound):
+                await session.list_directory("/missing")
+        assert not await session.dir_exists("/missing/dir")
+        return ftp.requests
+    assert run(main()) == ["/missing"]
+
+
+def test_concurrent_listings_share_one_request():
+    async def main():
+        ftp = FakeFtp(tree())
+        ftp.gate = asyncio.Event()
+        session = FtpSession(ftp)
+        tasks = [asyncio.ensure_future(session.list_directory("/fs")) for _ in range(5)]
+        await asyncio.sleep(0)
+        ftp.gate.set()
+        results = await asyncio.gather(*tasks)
+        return ftp.requests, results
+    requests, results = run(main())
+    assert requests == ["/fs"]
+    assert results == [["Dmicrosd"]] * 5
+
+
+def test_invalidate_drops_path_and_parent():
+    async def main():
+        ftp = FakeFtp(tree())
+        session = FtpSession(ftp)
+        await session.list_directory("/fs/microsd")
+        await session.list_directory("/fs/microsd/etc")
+        await session.list_directory("/fs")
+        session.invalidate("/fs/microsd/etc")
+        await session.list_directory("/fs/microsd")
+        await session.list_directory("/fs/microsd/etc")
+        await session.list_directory("/fs")
+        return ftp.requests
+    assert run(main()) == ["/fs/microsd", "/fs/microsd/etc", "/fs", "/fs/microsd", "/fs/microsd/etc"]
+
+
+def test_invalidate_all():
+    async def main():
+        ftp = FakeFtp(tree())
+        session = FtpSession(ftp)
+        await session.list_directory("/fs")
+        await session.list_directory("/fs/microsd")
+        session.invalidate_all()
+        await session.list_directory("/fs")
+        await session.list_directory("/fs/microsd")
+        return ftp.requests
+    assert run(main()) == ["/fs", "/fs/microsd"] * 2
+
+
+def test_invalidate_all_drops_listing_in_flight():
+    # A reply to a request sent before the invalidation must not be cached
+    async def main():
+        ftp = FakeFtp(tree())
+        ftp.gate = asyncio.Event()
+        session = FtpSession(ftp)
+        task = asyncio.ensure_future(session.list_directory("/fs/microsd/etc"))
+        while not ftp.requests:
+            await asyncio.sleep(0)
+        ftp.tree["/fs/microsd/etc"] = []
+        session.invalidate_all()
+        ftp.gate.set()
+        stale = await task
+        fresh = await session.list_directory("/fs/microsd/etc")
+        return stale, fresh, ftp.requests
+    stale, fresh, requests = run(main())
+    assert stale == ["Fconfig.txt\t120"]
+    assert fresh == []
+    assert requests == ["/fs/microsd/etc"] * 2
+
+
+def test_ttl_expires(monkeypatch):
+    import ftp_session
+    now = [1000.0]
+    # Not time.monotonic itself, the event loop uses it too
+    monkeypatch.setattr(ftp_session, "time", types.SimpleNamespace(monotonic=lambda: now[0]))
+
+    async def main():
+        ftp = FakeFtp(tree())
+        session = FtpSession(ftp, ttl=5.0)
+        await session.list_directory("/fs")
+        now[0] += 4.9
+        await session.list_directory("/fs")
+        now[0] += 0.2
+        await session.list_directory("/fs")
+        return ftp.requests
+    assert run(main()) == ["/fs", "/fs"]
@@ -0,0 +1,69 @@
+import argparse
+
+import pytest
+
+from fog_args import parse_size
+from mav_fleet import parse_fleet_file, vehicle_dir_name
+from mav_metrics import percentile
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("2000", 2000),
+    ("500k", 500 * 1024),
+    ("1.5M", int(1.5 * 1024 * 1024)),
+    ("2G", 2 * 1024 ** 3),
+    ("64kB", 64 * 1024),
+    (" 1m ", 1024 * 1024),
+])
+def test_parse_size(value, expected):
+    assert parse_size(value) == expected
+
+
+def test_parse_size_rejects_garbage():
+    with pytest.raises(ValueError):
+        parse_size("lots")
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 0) == 1
+    assert percentile(values, 50) == 51
+    assert percentile(values, 99) == 99
+    assert percentile(values, 100) == 100
+    assert percentile([3, 1, 2], 50) == 2
+
+
+def test_percentile_empty():
+    assert percentile([], 99) == 0.0
+
+
+def test_parse_fleet_file(tmp_path):
+    path = tmp_path / "fleet.txt"
+    path.write_text("# vehicles\n"
+                    "udp://:14541 drone1\n"
+                    "\n"
+                    "  udp://:14542   # no name\n"
+                    "serial:///dev/ttyACM0 drone3 extra\n")
+    assert parse_fleet_file(str(path)) == [("udp://:14541", "drone1"),
+                                           ("udp://:14542", None),
+                                           ("serial:///dev/ttyACM0", "drone3")]
+
+
+def test_parse_fleet_file_only_comments(tmp_path):
+    path = tmp_path / "fleet.txt"
+    path.write_text("# nothing here\n\n")
+    assert parse_fleet_file(str(path)) == []
+
+
+def test_vehicle_dir_name():
+    assert vehicle_dir_name("udp://:14541") == "udp_14541"
+    assert vehicle_dir_name("tcp://192.168.1.2:5760") == "tcp_192.168.1.2_5760"
+
+
+def test_parse_rate():
+    from fog_record_bag import parse_rate
+    assert parse_rate("/fmu/*=10") == ("/fmu/*", 10.0)
+    assert parse_rate("/a=b=0.5") == ("/a=b", 0.5)
+    for value in ("/fmu/*", "=10", "/fmu=0", "/fmu=x"):
+        with pytest.raises(argparse.ArgumentTypeError):
+            parse_rate(value)
@@ -0,0 +1,87 @@
+import types
+
+from download_px4_logfile import LogCatalog, LogFileDownloader
+
+
+def catalog():
+    cat = LogCatalog()
+    for date, time, size, enc in [("2024-05-02", "10_00_00", 2000, False),
+                                  ("2024-05-01", "12_30_00", 500, True),
+                                  ("2024-05-01", "09_15_00", 1500, False),
+                                  ("2024-05-03", "08_00_00", 100, False)]:
+        entry = cat.entry(date, time)
+        entry.size = size
+        entry.enc = enc
+        entry.datafile = f"/fs/microsd/log/{date}/{time}.{'ulgc' if enc else 'ulg'}"
+    return cat
+
+
+def keys(entries):
+    return [(e.date, e.time) for e in entries]
+
+
+def test_entry_is_reused():
+    cat = LogCatalog()
+    assert cat.entry("2024-05-01", "10_00_00") is cat.entry("2024-05-01", "10_00_00")
+    assert len(cat) == 1
+
+
+def test_query_sorted_oldest_first():
+    assert keys(catalog().query()) == [("2024-05-01", "09_15_00"), ("2024-05-01", "12_30_00"),
+                                       ("2024-05-02", "10_00_00"), ("2024-05-03", "08_00_00")]
+
+
+def test_query_filters():
+    cat = catalog()
+    assert keys(cat.query(since="2024-05-02")) == [("2024-05-02", "10_00_00"), ("2024-05-03", "08_00_00")]
+    assert keys(cat.query(until="2024-05-01")) == [("2024-05-01", "09_15_00"), ("2024-05-01", "12_30_00")]
+    assert keys(cat.query(since="2024-05-02", until="2024-05-02")) == [("2024-05-02", "10_00_00")]
+    assert keys(cat.query(min_size=1500)) == [("2024-05-01", "09_15_00"), ("2024-05-02", "10_00_00")]
+    assert keys(cat.query(encrypted_only=True)) == [("2024-05-01", "12_30_00")]
+
+
+def test_as_dict():
+    entry = catalog().entry("2024-05-02", "10_00_00")
+    d = entry.as_dict()
+    assert d["timestamp"] == "2024-05-02T10:00:00"
+    assert d["size"] == 2000
+    assert d["keyfile"] is None
+
+
+class FakeArchive:
+
+    def __init__(self, archived):
+        self.archived = archived
+
+    def has_log(self, vehicle, date, time, name):
+        return (date, time, name) in self.archived
+
+
+def downloader(cat, count=None, archived=()):
+    d = LogFileDownloader()
+    d.args = types.SimpleNamespace(count=count)
+    d.log_list = cat.query()
+    d.archive = FakeArchive(archived) if archived is not None else None
+    d.vehicle = "v1"
+    return d
+
+
+def test_select_bulk_skips_keyfile_only_and_archived():
+    cat = catalog()
+    # A key file without its log
+    cat.entry("2024-05-04", "07_00_00").keyfile = "/fs/microsd/log/2024-05-04/07_00_00.ulgk"
+    d = downloader(cat, archived={("2024-05-02", "10_00_00", "10_00_00.ulg")})
+    selected = [d.log_list[i] for i in d.select_bulk()]
+    assert keys(selected) == [("2024-05-01", "09_15_00"), ("2024-05-01", "12_30_00"), ("2024-05-03", "08_00_00")]
+
+
+def test_select_bulk_count():
+    d = downloader(catalog(), count=2, archived=None)
+    assert keys(d.log_list[i] for i in d.select_bulk()) == [("2024-05-02", "10_00_00"), ("2024-05-03", "08_00_00")]
+
+
+def test_keyfile_only_entry_is_not_archived():
+    cat = LogCatalog()
+    entry = cat.entry("2024-05-04", "07_00_00")
+    entry.keyfile = "/fs/microsd/log/2024-05-04/07_00_00.ulgk"
+    assert not downloader(cat, archived=set()).is_archived(entry)
@@ -0,0 +1,92 @@
+import pytest
+
+pytest.importorskip("pymavlink")
+
+from mav_link_probe import LinkProbe, RttProbe
+
+
+class Message:
+
+    def __init__(self, seq, system=1, component=1, msg_type='HEARTBEAT'):
+        self.seq = seq & 0xff
+        self.system = system
+        self.component = component
+        self.msg_type = msg_type
+
+    def get_type(self):
+        return self.msg_type
+
+    def get_srcSystem(self):
+        return self.system
+
+    def get_srcComponent(self):
+        return self.component
+
+    def get_seq(self):
+        return self.seq
+
+    def get_msgbuf(self):
+        return b'\0' * 20
+
+
+def receive(seqs, **kwargs):
+    probe = LinkProbe(None)
+    for seq in seqs:
+        probe.handle(Message(seq, **kwargs), 0.0)
+    return probe.sources[(kwargs.get("system", 1), kwargs.get("component", 1))]
+
+
+def test_no_loss():
+    source = receive(range(300))
+    assert source["lost"] == 0
+    assert source["received"] == 300
+
+
+def test_gap_is_loss():
+    assert receive([0, 1, 5, 6])["lost"] == 3
+
+
+def test_loss_across_wrap():
+    assert receive([254, 255, 2])["lost"] == 2
+
+
+def test_duplicates_and_reordering_are_not_loss():
+    source = receive([0, 1, 2, 2, 1, 3, 4])
+    assert source["lost"] == 0
+    assert source["last_seq"] == 4
+
+
+def test_outage_of_128_or_more_resyncs():
+    # 200 messages lost, later messages count from the new position
+    source = receive([0, 1, 202, 203, 204])
+    assert source["lost"] == 200
+    assert source["last_seq"] == 204
+
+
+def test_sources_are_counted_separately():
+    probe = LinkProbe(None)
+    for seq in (0, 1, 2):
+        probe.handle(Message(seq, system=1), 0.0)
+        probe.handle(Message(seq * 2, system=2), 0.0)
+    assert probe.sources[(1, 1)]["lost"] == 0
+    assert probe.sources[(2, 1)]["lost"] == 2
+
+
+def test_bad_data_is_counted_apart():
+    probe = LinkProbe(None)
+    probe.handle(Message(0, msg_type='BAD_DATA'), 0.0)
+    assert probe.bad_data == 1
+    assert probe.sources == {}
+
+
+def test_rtt_probe():
+    rtt = RttProbe()
+    rtt.pending = {1: 10.0, 2: 10.5, 3: 11.0}
+    rtt.sent = 3
+    rtt.answered(1, 10.1)
+    rtt.answered(1, 10.2)
+    rtt.expire(13.1, 2.0)
+    report = rtt.report()
+    assert report["received"] == 1
+    assert report["lost"] == 2
+    assert report["p50_ms"] == pytest.approx(100.0)